@@ -1,15 +1,27 @@
 # EPU Builder v1.3.2 – Streamlit + SQLite/Postgres
 
+import datetime
+import functools
 import io
+import json
 import re
+import socket
 import sqlite3  # ancora usato in locale
+import threading
+import time
+import uuid
+import zlib
+from collections import OrderedDict
 from contextlib import contextmanager
 from typing import Optional, Dict
 
+import numpy as np
 import pandas as pd
 import streamlit as st
 from sqlalchemy import create_engine, text
 
+from init_db import migrate as migrate_schema, migrate_postgres
+
 # -------------------------------------------------
 # Fix per errore "RuntimeError: Event loop is closed"
 # su Python 3.12/3.13 + Streamlit (Windows)
@@ -60,71 +72,467 @@ DB_PATH = (
     st.secrets.get("SQLITE_PATH") if hasattr(st, "secrets") else None
 ) or os.getenv("SQLITE_PATH") or "epu.db"
 
+# --- Pool Postgres (dimensioni configurabili da secrets) ---
+PG_POOL_MIN = int(st.secrets.get("PG_POOL_MIN", 1))
+PG_POOL_MAX = int(st.secrets.get("PG_POOL_MAX", 10))
+PG_POOL_TIMEOUT = float(st.secrets.get("PG_POOL_TIMEOUT", 10.0))  # secondi di attesa max per una connessione
+# PREPARE/EXECUTE per le query "calde": solo con connessione diretta o pooler in session mode
+# (con PgBouncer/Supabase in transaction mode la sessione server cambia tra una transazione e l'altra)
+PG_PREPARED_STATEMENTS = str(st.secrets.get("PG_PREPARED_STATEMENTS", "false")).lower() in ("1", "true", "on")
+
+# --- Profilo SQLite: PRAGMA applicati a ogni connessione del pool (configurabili da secrets) ---
+# WAL: i lettori non bloccano chi scrive (e viceversa); synchronous=NORMAL in WAL non fa
+# fsync a ogni commit ma solo ai checkpoint; busy_timeout: attesa del lock invece di
+# "database is locked" immediato. cache_size negativo = KiB.
+SQLITE_PRAGMAS = {
+    "journal_mode": st.secrets.get("SQLITE_JOURNAL_MODE", "WAL"),
+    "synchronous": st.secrets.get("SQLITE_SYNCHRONOUS", "NORMAL"),
+    "busy_timeout": int(st.secrets.get("SQLITE_BUSY_TIMEOUT_MS", 10000)),
+    "cache_size": int(st.secrets.get("SQLITE_CACHE_SIZE", -64000)),
+    "mmap_size": int(st.secrets.get("SQLITE_MMAP_SIZE", 256 * 1024 * 1024)),
+    "temp_store": st.secrets.get("SQLITE_TEMP_STORE", "MEMORY"),
+}
+SQLITE_MANUTENZIONE_S = float(st.secrets.get("SQLITE_MAINTENANCE_S", 300.0))  # 0 = disattivata
+
+# --- Letture: DataFrame numpy (default) o Arrow (READ_DTYPE_BACKEND="pyarrow" nei secrets) ---
+# Con Arrow le stringhe non sono oggetti Python e st.dataframe le serializza senza conversione.
+LETTURE_ARROW = str(st.secrets.get("READ_DTYPE_BACKEND", "numpy")).lower() == "pyarrow"
+
 def _normalize_pg_url(url: str) -> str:
     """Rende la URL utilizzabile da psycopg2 (toglie '+psycopg2' se presente)."""
     return url.replace("postgresql+psycopg2://", "postgresql://", 1)
 
-@contextmanager
-def get_con():
+class _PoolStats:
+    """Contatori del pool: hit (connessione riusata), miss (nuova connessione), attesa."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.wait_s = 0.0
+        self.max_wait_s = 0.0
+
+    def record(self, hit: bool, wait_s: float):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+            self.wait_s += wait_s
+            self.max_wait_s = max(self.max_wait_s, wait_s)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            n = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits / n) if n else 0.0,
+                "wait_ms_tot": round(self.wait_s * 1000.0, 2),
+                "wait_ms_max": round(self.max_wait_s * 1000.0, 2),
+            }
+
+class _SQLitePool:
     """
-    Connessione al DB:
-      - PROD  -> Postgres (Supabase) via psycopg2
-      - DEV   -> SQLite locale
+    Una connessione SQLite per thread, riusata tra le chiamate a get_con().
+    Le connessioni si chiudono da sole quando il thread (lo script run) termina.
     """
+
+    def __init__(self, db_path: str, pragmas: Optional[dict] = None):
+        self.db_path = db_path
+        self.pragmas = dict(pragmas or {})
+        self.stats = _PoolStats()
+        self.manutenzione_info: dict = {}
+        self._local = threading.local()
+
+    def _connect(self):
+        con = sqlite3.connect(self.db_path)
+        con.execute("PRAGMA foreign_keys = ON")  # FK attive su ogni connessione
+        for nome, valore in self.pragmas.items():  # profilo: una volta per connessione, non per query
+            con.execute(f"PRAGMA {nome} = {valore}")
+        return con
+
+    def acquire(self):
+        t0 = time.perf_counter()
+        con = getattr(self._local, "con", None)
+        hit = con is not None
+        if not hit:
+            con = self._connect()
+            self._local.con = con
+            self._local.depth = 0
+        self._local.depth += 1
+        self.stats.record(hit, time.perf_counter() - t0)
+        return con
+
+    def release(self, con):
+        self._local.depth -= 1
+        # come la vecchia close(): ciò che non è stato committato va perso
+        if self._local.depth == 0 and con.in_transaction:
+            con.rollback()
+
+    def manutenzione(self):
+        """Checkpoint del WAL (PASSIVE: non aspetta lettori/scrittori) + PRAGMA optimize."""
+        t0 = time.perf_counter()
+        with _pooled_con(self) as con:
+            busy, log, copiate = con.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchone()
+            con.execute("PRAGMA optimize")
+        self.manutenzione_info = {
+            "ultima": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "wal_pagine": log, "wal_pagine_copiate": copiate, "checkpoint_bloccato": bool(busy),
+            "durata_ms": round((time.perf_counter() - t0) * 1000.0, 2),
+        }
+
+def _ciclo_manutenzione_sqlite(pool: _SQLitePool, intervallo_s: float):
+    """Thread di servizio: manutenzione periodica del DB SQLite (errori -> riprova al giro dopo)."""
+    while True:
+        time.sleep(intervallo_s)
+        try:
+            pool.manutenzione()
+        except sqlite3.Error as e:
+            pool.manutenzione_info = {"ultima": time.strftime("%Y-%m-%d %H:%M:%S"), "errore": str(e)}
+
+class _PgPool:
+    """psycopg2 ThreadedConnectionPool condiviso tra le sessioni, con attesa se esaurito."""
+
+    def __init__(self, dsn: str, minconn: int, maxconn: int, timeout_s: float):
+        from psycopg2 import errors as pg_err
+        from psycopg2 import extensions as pg_ext
+        from psycopg2 import pool as pg_pool
+        # NUMERIC -> float già nel driver (niente Decimal da convertire dopo, riga per riga)
+        pg_ext.register_type(pg_ext.new_type(pg_ext.DECIMAL.values, "EPU_NUMERIC_FLOAT",
+                                             lambda v, cur: None if v is None else float(v)))
+        self._pool = pg_pool.ThreadedConnectionPool(minconn, maxconn, dsn=dsn)
+        self._pool_error = pg_pool.PoolError
+        # PREPARE/EXECUTE su una sessione server diversa da quella della PREPARE
+        self._errori_preparati = (pg_err.InvalidSqlStatementName, pg_err.DuplicatePreparedStatement)
+        self._idle = pg_ext.TRANSACTION_STATUS_IDLE
+        self._timeout_s = timeout_s
+        self._lock = threading.Lock()
+        self._aperte: set = set()  # id delle connessioni già consegnate (di nuovo consegnata = hit)
+        self._preparate: Dict[int, tuple] = {}  # id(connessione) -> (connessione, nomi preparati)
+        self.preparati_attivi = PG_PREPARED_STATEMENTS
+        self.stats = _PoolStats()
+
+    def acquire(self):
+        t0 = time.perf_counter()
+        while True:
+            try:
+                con = self._pool.getconn()
+                break
+            except self._pool_error:
+                # pool esaurito: aspetto che qualcuno rilasci
+                if time.perf_counter() - t0 > self._timeout_s:
+                    raise
+                time.sleep(0.02)
+        with self._lock:
+            hit = id(con) in self._aperte
+            self._aperte.add(id(con))
+        self.stats.record(hit, time.perf_counter() - t0)
+        return con
+
+    def release(self, con):
+        try:
+            if not con.closed:
+                con.rollback()  # chiude eventuali transazioni lasciate aperte
+        finally:
+            if con.closed:
+                with self._lock:
+                    self._aperte.discard(id(con))
+                    self._preparate.pop(id(con), None)
+            self._pool.putconn(con, close=bool(con.closed))
+
+    def esegui_preparato(self, con, nome: str, sql: str, params=None):
+        """
+        EXECUTE dello statement preparato per sql (vedi prepara) -> cursore; None = eseguire
+        in modo normale. Solo a inizio transazione: se PREPARE/EXECUTE falliscono perché la
+        sessione server non è quella della PREPARE (pooler in transaction mode) il rollback
+        non perde nulla, e gli statement preparati si spengono per tutto il pool.
+        """
+        if not self.preparati_attivi or con.info.transaction_status != self._idle:
+            return None
+        segnaposti = " ({})".format(", ".join(["%s"] * len(params))) if params else ""
+        try:
+            stmt = self.prepara(con, nome, sql)
+            cur = con.cursor()
+            cur.execute(f"EXECUTE {stmt}{segnaposti}", list(params) if params else None)
+            return cur
+        except self._errori_preparati:
+            con.rollback()
+            with self._lock:
+                self.preparati_attivi = False
+                self._preparate.clear()
+            return None
+
+    def prepara(self, con, nome: str, sql: str) -> str:
+        """
+        Nome dello statement preparato per sql su questa connessione: PREPARE solo la prima
+        volta (parse e piano una volta per connessione, poi solo EXECUTE). Le PREPARE non
+        sono transazionali: sopravvivono ai rollback di release().
+        """
+        testo = _compila_sql(sql, "postgres_server")
+        stmt = f"{nome}_{zlib.crc32(testo.encode()):08x}"  # varianti dello stesso nome = statement diversi
+        with self._lock:
+            voce = self._preparate.get(id(con))
+            if voce is None or voce[0] is not con:
+                voce = self._preparate[id(con)] = (con, set())
+            fatto = stmt in voce[1]
+        if not fatto:
+            with con.cursor() as cur:
+                cur.execute(f"PREPARE {stmt} AS {testo}")
+            with self._lock:
+                voce[1].add(stmt)
+        return stmt
+
+    def n_preparati(self) -> int:
+        with self._lock:
+            return sum(len(v[1]) for v in self._preparate.values())
+
+@st.cache_resource(show_spinner=False)
+def _sqlite_pool(db_path: str) -> _SQLitePool:
+    pool = _SQLitePool(db_path, SQLITE_PRAGMAS)
+    if SQLITE_MANUTENZIONE_S > 0:
+        threading.Thread(target=_ciclo_manutenzione_sqlite, args=(pool, SQLITE_MANUTENZIONE_S),
+                         name="sqlite-manutenzione", daemon=True).start()
+    return pool
+
+@st.cache_resource(show_spinner=False)
+def _pg_pool(dsn: str) -> _PgPool:
+    if psycopg2 is None:
+        raise RuntimeError("psycopg2 non disponibile: aggiungi 'psycopg2-binary' ai requirements.")
+    return _PgPool(dsn, PG_POOL_MIN, PG_POOL_MAX, PG_POOL_TIMEOUT)
+
+def _active_pool():
     if IS_PROD:
-        if psycopg2 is None:
-            raise RuntimeError("psycopg2 non disponibile: aggiungi 'psycopg2-binary' ai requirements.")
-        url = _normalize_pg_url(st.secrets["DATABASE_URL"])
-        con = psycopg2.connect(dsn=url)
+        return _pg_pool(_normalize_pg_url(st.secrets["DATABASE_URL"]))
+    return _sqlite_pool(DB_PATH)
+
+def pool_stats() -> dict:
+    """Statistiche del pool attivo (hit/miss, tempi di attesa; in Postgres statement preparati)."""
+    pool = _active_pool()
+    if isinstance(pool, _PgPool):
+        return {**pool.stats.snapshot(), "statement_preparati": pool.n_preparati(),
+                "preparati_attivi": pool.preparati_attivi}
+    return pool.stats.snapshot()
+
+@contextmanager
+def _pooled_con(pool):
+    con = pool.acquire()
+    try:
+        yield con
+    finally:
+        pool.release(con)
+
+@contextmanager
+def _con_lettura_lunga():
+    """
+    Connessione per una lettura lunga a blocchi. In SQLite non quella del thread: la sua
+    transazione di lettura resterebbe aperta e farebbe fallire le scritture fatte nel
+    frattempo (es. l'avanzamento dei job di export). In Postgres ogni get_con() è già a sé.
+    """
+    pool = _active_pool()
+    if isinstance(pool, _SQLitePool):
+        con = pool._connect()
         try:
             yield con
         finally:
             con.close()
     else:
-        con = sqlite3.connect(DB_PATH)
-        try:
-            # Abilita FK su ogni connessione SQLite
-            con.execute("PRAGMA foreign_keys = ON")
+        with _pooled_con(pool) as con:
             yield con
-        finally:
-            con.close()
 
-def _translate_sql_for_prod(sql: str) -> str:
+@contextmanager
+def get_con():
     """
-    Piccole differenze sintattiche SQLite -> Postgres:
-      - IFNULL(x,y)          -> COALESCE(x,y)
-      - datetime('now')      -> NOW()
-      - placeholder '?'      -> '%s'
+    Connessione al DB (dal pool, non una nuova connect per chiamata):
+      - PROD  -> Postgres (Supabase) via ThreadedConnectionPool condiviso
+      - DEV   -> SQLite locale, una connessione per thread
     """
-    sql2 = sql
-    sql2 = sql2.replace("IFNULL(", "COALESCE(")
-    sql2 = sql2.replace("datetime('now')", "NOW()")
-    sql2 = sql2.replace('datetime("now")', "NOW()")
-    # placeholder (nel tuo SQL non usi '?' dentro stringhe letterali)
-    sql2 = sql2.replace("?", "%s")
-    return sql2
+    with _pooled_con(_active_pool()) as con:
+        yield con
 
-def _exec(con, sql: str, params=None):
+# --- Dialetto SQL ---
+# Il codice scrive SQL in sintassi SQLite con placeholder '?'. Ogni testo SQL viene
+# compilato UNA volta per backend (cache, niente riscritture a ogni esecuzione); in
+# Postgres: '?' -> %s, '%' letterali -> %%, IFNULL -> COALESCE, datetime('now') -> ora UTC senza fuso,
+# LIKE -> ILIKE (in SQLite LIKE non distingue maiuscole), "a IS NOT b" -> IS DISTINCT FROM.
+_RE_SQL_TOKEN = re.compile(
+    r"'(?:[^']|'')*'"                                      # stringhe letterali (copiate, % raddoppiati)
+    r"|\?|%"
+    r"|\bIFNULL\(|datetime\('now'\)|\bLIKE\b"
+    r"|\bIS\s+NOT\b(?!\s+(?:NULL|DISTINCT|TRUE|FALSE)\b)",
+    re.IGNORECASE,
+)
+_PG_SOSTITUZIONI = {"?": "%s", "%": "%%", "ifnull(": "COALESCE(", "datetime('now')": "(NOW() AT TIME ZONE 'UTC')",
+                    "like": "ILIKE"}
+
+@functools.lru_cache(maxsize=4096)
+def _compila_sql(sql: str, dialetto: str) -> str:
+    """
+    Testo SQL (sintassi SQLite) -> testo per il dialetto indicato. "postgres_server":
+    testo eseguito così com'è dal server (PREPARE, COPY): placeholder $1..$n, '%' invariati.
+    """
+    if dialetto == "sqlite":
+        return sql
+    server = dialetto == "postgres_server"
+    n = [0]
+
+    def _sost(m):
+        t = m.group(0)
+        if t[0] == "'":
+            return t if server else t.replace("%", "%%")
+        if server and t == "?":
+            n[0] += 1
+            return f"${n[0]}"
+        if server and t == "%":
+            return t
+        return _PG_SOSTITUZIONI.get(t.lower(), "IS DISTINCT FROM")
+    return _RE_SQL_TOKEN.sub(_sost, sql)
+
+class _Dialetto:
+    """Differenze tra i backend in un solo punto: compilazione SQL e poche capacità."""
+
+    def __init__(self, nome: str):
+        self.nome = nome
+        self.postgres = nome == "postgres"
+        # INSERT ... RETURNING id: Postgres sempre, SQLite dalla 3.35
+        self.returning = self.postgres or sqlite3.sqlite_version_info >= (3, 35, 0)
+        # lock delle righe lette prima di aggiornarle (in SQLite basta BEGIN IMMEDIATE)
+        self.per_update = " FOR UPDATE" if self.postgres else ""
+
+    def sql(self, sql: str) -> str:
+        return _compila_sql(sql, self.nome)
+
+    def inizia_scrittura(self, con):
+        """SQLite: transazione col lock in scrittura già preso (niente upgrade lettura->scrittura
+        che fallisce con 'database is locked'). Postgres: la transazione è implicita."""
+        if not self.postgres and not con.in_transaction:
+            con.execute("BEGIN IMMEDIATE")
+
+DIALETTO = _Dialetto("postgres" if IS_PROD else "sqlite")
+
+# violazioni di vincoli (UNIQUE/FK) per entrambi i driver
+ERRORI_INTEGRITA = (sqlite3.IntegrityError,) + ((psycopg2.IntegrityError,) if psycopg2 is not None else ())
+
+def _exec(con, sql: str, params=None, nome: Optional[str] = None):
     """
-    Esegue SQL parametrizzato con compatibilità Postgres/SQLite.
+    Esegue SQL parametrizzato (sintassi SQLite, placeholder '?') sul backend attivo.
     Usa:
         _exec(con, "SELECT ... WHERE id = ?", (42,))
+    nome: query "calda" -> in Postgres, con PG_PREPARED_STATEMENTS, statement preparato sulla
+    connessione (vedi _PgPool.esegui_preparato); altrimenti eseguita come le altre.
     """
+    if nome and DIALETTO.postgres:
+        cur = _active_pool().esegui_preparato(con, nome, sql, params)
+        if cur is not None:
+            return cur
     cur = con.cursor()
-    if IS_PROD:
-        sql = _translate_sql_for_prod(sql)
-    cur.execute(sql, params or [])
+    cur.execute(DIALETTO.sql(sql), params or [])
     return cur
 
-# --- Patch di pandas.read_sql_query per tradurre SQL anche nelle SELECT ---
-_pd_read_sql_query_orig = pd.read_sql_query
+def _execmany(con, sql: str, rows):
+    """Come _exec, una volta per ogni tupla di parametri in rows."""
+    cur = con.cursor()
+    cur.executemany(DIALETTO.sql(sql), rows)
+    return cur
 
-def _pd_read_sql_query_patched(sql, con, params=None, *args, **kwargs):
-    if IS_PROD:
-        sql = _translate_sql_for_prod(sql)
-    return _pd_read_sql_query_orig(sql, con, params=params, *args, **kwargs)
+def _insert_id(con, sql: str, params=None) -> int:
+    """INSERT di una riga -> id generato (RETURNING id se il backend lo supporta)."""
+    if DIALETTO.returning:
+        return int(_exec(con, sql + " RETURNING id", params).fetchall()[0][0])
+    return int(_exec(con, sql, params).lastrowid)
 
-pd.read_sql_query = _pd_read_sql_query_patched
+def _read_sql(sql: str, con, params=None, chunksize: Optional[int] = None,
+              nome: Optional[str] = None, colonnare: bool = False, categoriche: tuple = ()):
+    """
+    pd.read_sql_query per il backend attivo (SQL compilato dal dialetto).
+    Con chunksize ritorna un iteratore di DataFrame. In Postgres: nome -> statement
+    preparato (come _exec); colonnare -> query senza parametri con molte righe letta
+    con COPY + pyarrow (vedi _pg_read_colonnare).
+    Con LETTURE_ARROW colonne Arrow e `categoriche` (pochi valori ripetuti: categoria,
+    fornitore, UM, capitolo) a dizionario.
+    """
+    if not DIALETTO.postgres:
+        df = pd.read_sql_query(sql, con, params=params, chunksize=chunksize,
+                               **({"dtype_backend": "pyarrow"} if LETTURE_ARROW else {}))
+        return df if chunksize else _a_dizionario(df, categoriche)
+    df = _pg_read_colonnare(con, sql) if colonnare and not params and not chunksize else None
+    if df is None:
+        if chunksize:
+            return _pg_read_blocchi(con, sql, params, chunksize)
+        cur = _exec(con, sql, params, nome=nome)
+        cols = [d[0] for d in cur.description]
+        df = _frame_letture(pd.DataFrame.from_records(cur.fetchall(), columns=cols, coerce_float=True))
+    return _a_dizionario(df, categoriche)
+
+def _pg_read_blocchi(con, sql: str, params, chunksize: int):
+    """
+    Risultato a blocchi da un cursore lato server: il cursore normale di psycopg2 scarica
+    tutte le righe in memoria all'execute, così in memoria c'è solo il blocco corrente.
+    """
+    cur = con.cursor(name=f"epu_blocchi_{uuid.uuid4().hex[:12]}")
+    cur.itersize = chunksize
+    try:
+        cur.execute(DIALETTO.sql(sql), params or [])
+        while True:
+            rows = cur.fetchmany(chunksize)
+            if not rows:
+                break
+            yield _frame_letture(pd.DataFrame.from_records(rows, columns=[d[0] for d in cur.description],
+                                                           coerce_float=True))
+    finally:
+        if not con.closed and con.info.transaction_status == psycopg2.extensions.TRANSACTION_STATUS_INTRANS:
+            cur.close()
+
+def _frame_letture(df: pd.DataFrame) -> pd.DataFrame:
+    """Frame costruito dal cursore -> colonne Arrow se LETTURE_ARROW."""
+    return df.convert_dtypes(dtype_backend="pyarrow") if LETTURE_ARROW else df
+
+def _a_dizionario(df: pd.DataFrame, categoriche: tuple) -> pd.DataFrame:
+    """Colonne a pochi valori ripetuti -> category (dizionario anche nella serializzazione Arrow)."""
+    if LETTURE_ARROW:
+        for c in categoriche:
+            if c in df.columns:
+                df[c] = df[c].astype("category")
+    return df
+
+# tipi Postgres (OID) -> tipi Arrow per la lettura colonnare; il resto arriva come testo
+_PG_TIPI_ARROW = {16: "bool", 20: "int64", 21: "int64", 23: "int64", 700: "float64", 701: "float64", 1700: "float64"}
+_pg_colonne: Dict[str, list] = {}  # testo SQL -> [(colonna, tipo Arrow)], letto una volta
+
+def _pg_read_colonnare(con, sql: str) -> Optional[pd.DataFrame]:
+    """
+    Risultato intero di una SELECT senza parametri via COPY ... TO STDOUT (CSV) letto da
+    pyarrow direttamente in colonne tipizzate: niente tupla Python per riga né Decimal.
+    None se pyarrow non è disponibile (si ripiega sul cursore).
+    """
+    try:
+        import pyarrow as pa
+        from pyarrow import csv as pa_csv
+    except ImportError:
+        return None
+    testo = _compila_sql(sql, "postgres_server")
+    colonne = _pg_colonne.get(testo)
+    if colonne is None:
+        with con.cursor() as cur:
+            cur.execute(f"SELECT * FROM ({testo}) q LIMIT 0")
+            colonne = _pg_colonne[testo] = [(d.name, _PG_TIPI_ARROW.get(d.type_code, "string"))
+                                            for d in cur.description]
+    buf = io.BytesIO()
+    with con.cursor() as cur:
+        cur.copy_expert(f"COPY ({testo}) TO STDOUT WITH (FORMAT csv)", buf)
+    if not buf.tell():
+        return pd.DataFrame(columns=[c for c, _ in colonne])
+    buf.seek(0)
+    tabella = pa_csv.read_csv(
+        buf,
+        read_options=pa_csv.ReadOptions(column_names=[c for c, _ in colonne]),
+        convert_options=pa_csv.ConvertOptions(
+            column_types={c: pa.type_for_alias(t) for c, t in colonne},
+            true_values=["t"], false_values=["f"],
+            null_values=[""], strings_can_be_null=True, quoted_strings_can_be_null=False,  # "" resta stringa vuota
+        ),
+    )
+    return tabella.to_pandas(types_mapper=pd.ArrowDtype if LETTURE_ARROW else None)
 # ===========================================================================
 
 # (facoltativo) Badge in sidebar per vedere il driver attivo
@@ -165,11 +573,6 @@ inject_global_css()
 # ------------------------------------------------------------------
 # Utils
 # ------------------------------------------------------------------
-def _exec(con, sql, params=None):
-    cur = con.cursor()
-    cur.execute(sql, params or [])
-    return cur
-
 def _to_float(x, default=0.0):
     """Cast robusto con supporto alla virgola decimale."""
     if pd.isna(x):
@@ -195,8 +598,8 @@ def _digits_only(x: str) -> str:
 def like_mask(series: pd.Series, needle: str) -> pd.Series:
     """Filtro 'contains' case-insensitive; True se needle è vuoto."""
     if not needle:
-        return pd.Series([True]*len(series))
-    return series.fillna("").astype(str).str.contains(str(needle), case=False, regex=False)
+        return pd.Series(True, index=series.index)  # stesso indice della serie (anche se già filtrata)
+    return series.astype(object).fillna("").astype(str).str.contains(str(needle), case=False, regex=False)
 
 def flash_msg(key="delete_msg"):
     """Mostra e consuma un messaggio 'flash' dalla sessione."""
@@ -211,232 +614,109 @@ def flash_msg(key="delete_msg"):
 # ------------------------------------------------------------------
 # DB init
 # ------------------------------------------------------------------
-def init_db():
-    with sqlite3.connect(DB_PATH) as con:
-        cur = con.cursor()
-
-        # Tabelle di dominio
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS categorie (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            nome TEXT NOT NULL UNIQUE
-        )""")
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS fornitori (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            nome TEXT NOT NULL UNIQUE,
-            piva TEXT,
-            indirizzo TEXT,
-            email TEXT,
-            telefono TEXT
-        )""")
-
-        # Materiali
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS materiali_base (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            categoria_id INTEGER NOT NULL,
-            fornitore_id INTEGER NOT NULL,
-            codice_fornitore TEXT NOT NULL,
-            descrizione TEXT NOT NULL,
-            unita_misura TEXT NOT NULL,
-            quantita_default REAL DEFAULT 1.0,
-            prezzo_unitario REAL NOT NULL,
-            FOREIGN KEY(categoria_id) REFERENCES categorie(id),
-            FOREIGN KEY(fornitore_id) REFERENCES fornitori(id),
-            UNIQUE(fornitore_id, codice_fornitore)
-        )""")
-        # MIGRA: aggiunge la colonna is_manodopera se manca
-        try:
-            cur.execute(
-                "ALTER TABLE materiali_base ADD COLUMN is_manodopera INTEGER NOT NULL DEFAULT 0"
-            )
-        except sqlite3.OperationalError:
-            pass  # già presente
-
-        # Capitoli con default %SG e %Utile
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS capitoli (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            codice TEXT NOT NULL UNIQUE,
-            nome TEXT NOT NULL,
-            cg_default_percentuale REAL DEFAULT 0.0,
-            utile_default_percentuale REAL DEFAULT 0.0
-        )""")
-
-        # Voci di analisi
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS voci_analisi (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            capitolo_id INTEGER NOT NULL,
-            codice TEXT NOT NULL,
-            descrizione TEXT NOT NULL,
-            costi_generali_percentuale REAL DEFAULT 0.0,
-            utile_percentuale REAL DEFAULT 0.0,
-            voce_unita_misura TEXT,
-            voce_quantita REAL DEFAULT 1.0,
-            FOREIGN KEY(capitolo_id) REFERENCES capitoli(id),
-            UNIQUE(capitolo_id, codice)
-        )""")
-
-        # MIGRAZIONE: aggiunge la colonna prezzo_riferimento se manca
-        try:
-            cur.execute(
-                "ALTER TABLE voci_analisi "
-                "ADD COLUMN prezzo_riferimento REAL DEFAULT 0.0"
-            )
-        except sqlite3.OperationalError:
-            pass  # già presente
-
-        # MIGRAZIONE: aggiunge la colonna descrizione_estesa se manca
-        try:
-            cur.execute(
-             "ALTER TABLE voci_analisi "
-            "ADD COLUMN descrizione_estesa TEXT"
-            )
-        except sqlite3.OperationalError:
-            pass  # già presente
-
-         # Righe distinta
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS righe_distinta (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            voce_analisi_id INTEGER NOT NULL,
-            materiale_id INTEGER NOT NULL,
-            quantita REAL NOT NULL,
-            FOREIGN KEY(voce_analisi_id) REFERENCES voci_analisi(id),
-            FOREIGN KEY(materiale_id) REFERENCES materiali_base(id)
-        )""")
-
-        # Clienti / Preventivi
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS clienti (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            nome TEXT NOT NULL,
-            piva TEXT, indirizzo TEXT, cap TEXT, citta TEXT, provincia TEXT, nazione TEXT,
-            email TEXT, telefono TEXT, note TEXT
-        )""")
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS preventivi (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            numero TEXT NOT NULL,
-            data TEXT NOT NULL,
-            cliente_id INTEGER NOT NULL,
-            note_finali TEXT,
-            iva_percentuale REAL DEFAULT 22.0,
-            imponibile REAL DEFAULT 0.0,
-            iva_importo REAL DEFAULT 0.0,
-            totale REAL DEFAULT 0.0,
-            FOREIGN KEY(cliente_id) REFERENCES clienti(id)
-        )""")
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS preventivo_righe (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            preventivo_id INTEGER NOT NULL,
-            capitolo_id INTEGER NOT NULL,
-            voce_id INTEGER NOT NULL,
-            descrizione TEXT NOT NULL,
-            note TEXT,
-            um TEXT NOT NULL,
-            quantita REAL NOT NULL,
-            prezzo_unitario REAL NOT NULL,
-            prezzo_totale REAL NOT NULL,
-            FOREIGN KEY(preventivo_id) REFERENCES preventivi(id),
-            FOREIGN KEY(capitolo_id) REFERENCES capitoli(id),
-            FOREIGN KEY(voce_id) REFERENCES voci_analisi(id)
-        )""")
-        # Storico prezzi materiali
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS materiali_prezzi_storico (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            materiale_id INTEGER NOT NULL,
-            prezzo_vecchio REAL NOT NULL,
-            prezzo_nuovo REAL NOT NULL,
-            changed_at TEXT NOT NULL DEFAULT (datetime('now')),
-            note TEXT,
-            FOREIGN KEY(materiale_id) REFERENCES materiali_base(id)
-        )""")
-        # Indici storico
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_sto_mat  ON materiali_prezzi_storico(materiale_id)")
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_sto_date ON materiali_prezzi_storico(changed_at)")
-        # Trigger: logga i cambi prezzo dei materiali
-        cur.execute("""
-        CREATE TRIGGER IF NOT EXISTS trg_log_prezzo_materiale
-        AFTER UPDATE OF prezzo_unitario ON materiali_base
-        FOR EACH ROW
-        WHEN NEW.prezzo_unitario IS NOT OLD.prezzo_unitario
-        BEGIN
-            INSERT INTO materiali_prezzi_storico (materiale_id, prezzo_vecchio, prezzo_nuovo, changed_at, note)
-            VALUES (OLD.id, OLD.prezzo_unitario, NEW.prezzo_unitario, datetime('now'), 'Update da UI materiali');
-        END;
-        """)
+@st.cache_resource(show_spinner=False)
+def _schema_pronto(db: str) -> int:
+    # cache_resource: una sola volta per processo e per DB (i rerun non rieseguono le DDL)
+    if DIALETTO.postgres:
+        return migrate_postgres(db)  # stesse versioni, DDL/trigger Postgres (vedi init_db.py)
+    return migrate_schema(db)
 
+def init_db():
+    """Schema + migrazioni versionate (vedi init_db.py)."""
+    return _schema_pronto(_normalize_pg_url(st.secrets["DATABASE_URL"]) if IS_PROD else DB_PATH)
 
-        con.commit()
-
-        # Seed iniziali
-        if _exec(con, "SELECT COUNT(*) FROM categorie").fetchone()[0] == 0:
-            _exec(con, "INSERT INTO categorie (nome) VALUES (?), (?), (?), (?)",
-                  ["Edile", "Ferramenta", "Noleggi", "Pose"])
-        if _exec(con, "SELECT COUNT(*) FROM fornitori").fetchone()[0] == 0:
-            _exec(con, "INSERT INTO fornitori (nome) VALUES (?)", ["Fornitore Sconosciuto"])
-        con.commit()
-
-        # --- Indici utili ---
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_materiali_base_cat ON materiali_base(categoria_id)")
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_materiali_base_forn ON materiali_base(fornitore_id)")
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_voci_cap ON voci_analisi(capitolo_id)")
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_righe_voce ON righe_distinta(voce_analisi_id)")
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_righe_mat ON righe_distinta(materiale_id)")
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_prev_cliente ON preventivi(cliente_id)")
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_prev_data ON preventivi(data)")
-        con.commit()
-
-@contextmanager
-def get_con():
-    con = sqlite3.connect(DB_PATH)
-    try:
-        con.execute("PRAGMA foreign_keys = ON")  # FK attive su ogni connessione
-        yield con
-    finally:
-        con.close()
-
-def ensure_is_manodopera_column():
-    # Crea la colonna se manca, senza rompere nulla se già c’è
-    with get_con() as con:
-        cols = [r[1] for r in _exec(con, "PRAGMA table_info(materiali_base)").fetchall()]
-        if "is_manodopera" not in cols:
-            _exec(con, "ALTER TABLE materiali_base ADD COLUMN is_manodopera INTEGER NOT NULL DEFAULT 0")
-            con.commit()
-def ensure_categoria(con, nome: str) -> int:
-    """Ritorna l'id categoria esistente o la crea e ritorna il nuovo id."""
-    row = _exec(con, "SELECT id FROM categorie WHERE nome=?", (nome,)).fetchone()
-    if row:
-        return int(row[0])
-    _exec(con, "INSERT INTO categorie (nome) VALUES (?)", (nome,))
-    return int(_exec(con, "SELECT last_insert_rowid()").fetchone()[0])
-
-def ensure_fornitore(con, nome: str) -> int:
-    """Ritorna l'id fornitore esistente o lo crea e ritorna il nuovo id."""
-    row = _exec(con, "SELECT id FROM fornitori WHERE nome=?", (nome,)).fetchone()
-    if row:
-        return int(row[0])
-    _exec(con, "INSERT INTO fornitori (nome) VALUES (?)", (nome,))
-    return int(_exec(con, "SELECT last_insert_rowid()").fetchone()[0])
-      
+# ------------------------------------------------------------------
+# Cache letture: chiave = (funzione, argomenti, generazione delle tabelle lette).
+# Le funzioni di scrittura chiamano _invalidate(tabelle) dopo il commit: le
+# generazioni salgono e le letture successive tornano al DB. La cache è di
+# processo (condivisa tra le sessioni, come il DB): una scrittura in una
+# sessione invalida le letture di tutte.
+# NB: i DataFrame restituiti sono condivisi -> non modificarli in place.
+# ------------------------------------------------------------------
+class _QueryCache:
+    def __init__(self, maxsize: int = 256):
+        self._lock = threading.Lock()
+        self._maxsize = maxsize
+        self._data: "OrderedDict[tuple, object]" = OrderedDict()
+        self._gen: Dict[str, int] = {}
+        self._stats: Dict[str, list] = {}  # funzione -> [hit, miss]
+
+    def generation(self, tables) -> tuple:
+        with self._lock:
+            return tuple(self._gen.get(t, 0) for t in tables)
+
+    def bump(self, tables):
+        with self._lock:
+            for t in tables:
+                self._gen[t] = self._gen.get(t, 0) + 1
+
+    def get(self, name: str, key: tuple):
+        with self._lock:
+            st_ = self._stats.setdefault(name, [0, 0])
+            if key in self._data:
+                self._data.move_to_end(key)
+                st_[0] += 1
+                return True, self._data[key]
+            st_[1] += 1
+            return False, None
+
+    def put(self, key: tuple, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self._maxsize:
+                self._data.popitem(last=False)
+
+    def stats(self) -> pd.DataFrame:
+        with self._lock:
+            rows = [{"funzione": k, "hit": h, "miss": m, "hit_rate": (h / (h + m)) if (h + m) else 0.0}
+                    for k, (h, m) in sorted(self._stats.items())]
+        return pd.DataFrame(rows, columns=["funzione", "hit", "miss", "hit_rate"])
+
+@st.cache_resource(show_spinner=False)
+def _query_cache(db_path: str) -> _QueryCache:
+    return _QueryCache()
+
+def _invalidate(*tables: str):
+    """Da chiamare dopo ogni commit che modifica le tabelle indicate."""
+    _query_cache(DB_PATH).bump(tables)
+
+def cached_query(*tables: str):
+    """Decoratore: memorizza il risultato finché le tabelle indicate non vengono scritte."""
+    def deco(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            qc = _query_cache(DB_PATH)
+            # generazione letta PRIMA della query: una scrittura concorrente rende la voce inutilizzabile
+            key = (fn.__name__, args, tuple(sorted(kwargs.items())), qc.generation(tables))
+            hit, value = qc.get(fn.__name__, key)
+            if hit:
+                return value
+            value = fn(*args, **kwargs)
+            qc.put(key, value)
+            return value
+        return wrapper
+    return deco
+
+def query_cache_stats() -> pd.DataFrame:
+    """Hit/miss per funzione di lettura."""
+    return _query_cache(DB_PATH).stats()
 
 # ------------------------------------------------------------------
 # Query helpers
 # ------------------------------------------------------------------
+@cached_query("categorie")
 def df_categorie():
     with get_con() as con:
-        return pd.read_sql_query("SELECT id, nome FROM categorie ORDER BY nome", con)
+        return _read_sql("SELECT id, nome FROM categorie ORDER BY nome", con)
 
+@cached_query("fornitori")
 def df_fornitori():
     with get_con() as con:
-        return pd.read_sql_query("""SELECT id, nome, piva, indirizzo, email, telefono
+        return _read_sql("""SELECT id, nome, piva, indirizzo, email, telefono
                                     FROM fornitori ORDER BY nome""", con)
 
+@cached_query("materiali_base", "categorie", "fornitori")
 def df_materiali():
     with get_con() as con:
         sql = """
@@ -452,23 +732,124 @@ def df_materiali():
             JOIN fornitori f  ON f.id = m.fornitore_id
             ORDER BY c.nome, f.nome, m.codice_fornitore
         """
-        try:
-            return pd.read_sql_query(sql, con)
-        except Exception as e:
-            if "no such column" in str(e).lower() and "is_manodopera" in str(e).lower():
-                ensure_is_manodopera_column()
-                return pd.read_sql_query(sql, con)
-            raise
+        return _read_sql(sql, con, colonnare=True, categoriche=("categoria", "fornitore", "unita_misura"))
+
+# Filtri "stile Excel" dell'archivio materiali: chiave filtro -> colonna SQL (contains, case-insensitive)
+MATERIALI_FILTRI_SQL = {
+    "categoria": "c.nome",
+    "fornitore": "f.nome",
+    "codice_fornitore": "m.codice_fornitore",
+    "descrizione": "m.descrizione",
+}
+
+def _like_contains(needle: str) -> str:
+    """Pattern LIKE 'contiene' letterale (% e _ dell'utente non sono jolly), da usare con ESCAPE '\\'."""
+    s = str(needle).strip().replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{s}%"
+
+def _where_materiali(filtri: tuple, testo: str = "") -> tuple:
+    """
+    WHERE parametrizzato per l'archivio materiali.
+    filtri: coppie (chiave di MATERIALI_FILTRI_SQL, testo); testo: ricerca a parole
+    (indice full-text se c'è, altrimenti LIKE su ogni parola).
+    """
+    cond, params = [], []
+    for chiave, needle in filtri:
+        if needle and str(needle).strip():
+            cond.append(f"{MATERIALI_FILTRI_SQL[chiave]} LIKE ? ESCAPE '\\'")
+            params.append(_like_contains(needle))
+    parole = re.findall(r"\w+", testo or "")
+    if parole and _fts_materiali(DB_PATH):
+        cond.append("m.id IN (SELECT rowid FROM materiali_fts WHERE materiali_fts MATCH ?)")
+        params.append(" ".join(f'"{p}"*' for p in parole))
+    elif parole:
+        cond += ["(m.descrizione || ' ' || m.codice_fornitore || ' ' || c.nome || ' ' || f.nome) LIKE ? ESCAPE '\\'"] * len(parole)
+        params += [_like_contains(p) for p in parole]
+    return (" WHERE " + " AND ".join(cond)) if cond else "", params
+
+@cached_query("materiali_base", "categorie", "fornitori")
+def conta_materiali(filtri: tuple = (), testo: str = "") -> int:
+    where, params = _where_materiali(filtri, testo)
+    with get_con() as con:
+        return int(_exec(con, f"""
+            SELECT COUNT(*) FROM materiali_base m
+            JOIN categorie c ON c.id = m.categoria_id
+            JOIN fornitori f ON f.id = m.fornitore_id
+            {where}""", params).fetchone()[0])
 
+@cached_query("materiali_base", "categorie", "fornitori")
+def pagina_materiali(filtri: tuple = (), testo: str = "", limit: int = 100, offset: int = 0) -> pd.DataFrame:
+    """Una pagina dell'archivio materiali (stesse colonne e ordine di df_materiali), filtrata in SQL."""
+    where, params = _where_materiali(filtri, testo)
+    with get_con() as con:
+        return _read_sql(f"""
+            SELECT m.id,
+                   m.categoria_id, c.nome AS categoria,
+                   m.fornitore_id, f.nome AS fornitore,
+                   m.codice_fornitore, m.descrizione, m.unita_misura,
+                   IFNULL(m.quantita_default,1.0) AS quantita_default,
+                   m.prezzo_unitario,
+                   IFNULL(m.is_manodopera,0) AS is_manodopera
+            FROM materiali_base m
+            JOIN categorie c  ON c.id = m.categoria_id
+            JOIN fornitori f  ON f.id = m.fornitore_id
+            {where}
+            ORDER BY c.nome, f.nome, m.codice_fornitore, m.id
+            LIMIT ? OFFSET ?""", con, params=params + [int(limit), int(offset)],
+            categoriche=("categoria", "fornitore"))  # unita_misura modificabile nell'editor: resta testo
+
+MATERIALI_PICKER_K = 50  # risultati mostrati nel picker materiali della distinta
+
+@st.cache_resource(show_spinner=False)
+def _fts_materiali(db_path: str) -> bool:
+    """True se il DB ha l'indice full-text dei materiali (migrazione 5, SQLite con FTS5)."""
+    if DIALETTO.postgres:
+        return False
+    with get_con() as con:
+        return _exec(con, "SELECT 1 FROM sqlite_master WHERE name='materiali_fts'").fetchone() is not None
+
+@cached_query("materiali_base", "categorie", "fornitori")
+def cerca_materiali(query: str, k: int = MATERIALI_PICKER_K) -> pd.DataFrame:
+    """
+    Primi k materiali per la ricerca: ogni parola è un prefisso e devono esserci tutte
+    (in descrizione, codice fornitore, categoria o fornitore); ordine per pertinenza
+    (bm25, il codice pesa di più). Senza testo: i primi k in ordine alfabetico.
+    Senza FTS5 ripiega su LIKE, stesso filtro ma ordine alfabetico.
+    """
+    parole = re.findall(r"\w+", query or "")
+    sel = """
+        SELECT m.id, c.nome AS categoria, f.nome AS fornitore, m.codice_fornitore,
+               m.descrizione, m.unita_misura, m.prezzo_unitario
+    """
+    join = """
+        JOIN categorie c ON c.id = m.categoria_id
+        JOIN fornitori f ON f.id = m.fornitore_id
+    """
+    ordine = " ORDER BY c.nome, f.nome, m.codice_fornitore LIMIT ?"
+    with get_con() as con:
+        if not parole:
+            return _read_sql(sel + " FROM materiali_base m " + join + ordine, con, params=[int(k)])
+        if _fts_materiali(DB_PATH):
+            match = " ".join(f'"{p}"*' for p in parole)
+            return _read_sql(
+                sel + " FROM materiali_fts JOIN materiali_base m ON m.id = materiali_fts.rowid " + join
+                + " WHERE materiali_fts MATCH ? ORDER BY bm25(materiali_fts, 1.0, 4.0, 0.5, 0.5) LIMIT ?",
+                con, params=[match, int(k)])
+        cond = " AND ".join(["(m.descrizione || ' ' || m.codice_fornitore || ' ' || c.nome || ' ' || f.nome) LIKE ? ESCAPE '\\'"] * len(parole))
+        return _read_sql(sel + " FROM materiali_base m " + join + " WHERE " + cond + ordine, con,
+                                 params=[_like_contains(p) for p in parole] + [int(k)])
+
+@cached_query("capitoli")
 def df_capitoli():
     with get_con() as con:
-        return pd.read_sql_query("""
+        return _read_sql("""
             SELECT id, codice, nome,
                    IFNULL(cg_default_percentuale,0) AS cg_def,
                    IFNULL(utile_default_percentuale,0) AS ut_def
             FROM capitoli ORDER BY codice
         """, con)
 
+@cached_query("voci_analisi", "capitoli")
 def df_voci(capitolo_id: Optional[int] = None):
     with get_con() as con:
         if capitolo_id:
@@ -485,7 +866,7 @@ def df_voci(capitolo_id: Optional[int] = None):
             WHERE v.capitolo_id = ?
             ORDER BY c.codice, v.codice
             """
-            return pd.read_sql_query(q, con, params=[capitolo_id])
+            return _read_sql(q, con, params=[capitolo_id], nome="voci_capitolo", categoriche=("capitolo_codice", "um_voce"))
         else:
             q = """
             SELECT v.id, v.capitolo_id, c.codice AS capitolo_codice, c.nome AS capitolo_nome,
@@ -499,11 +880,12 @@ def df_voci(capitolo_id: Optional[int] = None):
             JOIN capitoli c ON c.id = v.capitolo_id
             ORDER BY c.codice, v.codice
             """
-            return pd.read_sql_query(q, con)
+            return _read_sql(q, con, nome="voci", categoriche=("capitolo_codice", "um_voce"))
 
+@cached_query("righe_distinta", "materiali_base", "categorie", "fornitori")
 def df_righe(voce_id: int):
     with get_con() as con:
-        return pd.read_sql_query("""
+        return _read_sql("""
             SELECT r.id, r.voce_analisi_id, r.materiale_id, r.quantita,
                    m.descrizione AS materiale_descrizione,
                    m.unita_misura, m.prezzo_unitario,
@@ -516,7 +898,7 @@ def df_righe(voce_id: int):
             JOIN fornitori f ON f.id = m.fornitore_id
             WHERE r.voce_analisi_id = ?
             ORDER BY r.id
-        """, con, params=[voce_id])
+        """, con, params=[voce_id], nome="righe_voce", categoriche=("categoria", "fornitore", "unita_misura"))
 
 def get_voce(voce_id: int) -> Optional[dict]:
     with get_con() as con:
@@ -532,7 +914,7 @@ def get_voce(voce_id: int) -> Optional[dict]:
             FROM voci_analisi v
             JOIN capitoli c ON c.id = v.capitolo_id
             WHERE v.id = ?
-        """, (voce_id,)).fetchone()
+        """, (voce_id,), nome="voce").fetchone()
         if not row:
             return None
         return {
@@ -545,6 +927,41 @@ def get_voce(voce_id: int) -> Optional[dict]:
             "descrizione_estesa": row[11],
         }
 
+# --- Etichette dei selectbox: dizionari id -> etichetta, costruiti una volta per generazione delle tabelle ---
+# (format_func viene chiamata per ogni opzione a ogni rerun: deve essere una lookup O(1), non un filtro sul DataFrame)
+def _mappa_etichette(ids: pd.Series, etichette: pd.Series) -> Dict[int, str]:
+    return dict(zip(ids.astype("int64").tolist(), etichette.astype(str).tolist()))
+
+@cached_query("categorie")
+def etichette_categorie() -> Dict[int, str]:
+    df = df_categorie()
+    return _mappa_etichette(df["id"], df["nome"])
+
+@cached_query("fornitori")
+def etichette_fornitori() -> Dict[int, str]:
+    df = df_fornitori()
+    return _mappa_etichette(df["id"], df["nome"])
+
+@cached_query("clienti")
+def etichette_clienti() -> Dict[int, str]:
+    df = df_clienti()
+    return _mappa_etichette(df["id"], df["nome"])
+
+@cached_query("capitoli")
+def etichette_capitoli() -> Dict[int, str]:
+    df = df_capitoli()
+    return _mappa_etichette(df["id"], df["codice"].astype(str) + " – " + df["nome"].astype(str))
+
+@cached_query("voci_analisi", "capitoli")
+def etichette_voci(capitolo_id: Optional[int] = None, breve: bool = False) -> Dict[int, str]:
+    """breve=True: 'CAP CODICE – descrizione' troncata a 50 caratteri (elenco voci); altrimenti 'CODICE – descrizione'."""
+    df = df_voci(capitolo_id)
+    desc = df["descrizione"].astype(str)
+    if breve:
+        return _mappa_etichette(df["id"], df["capitolo_codice"].astype(str) + " " + df["codice"].astype(str)
+                                + " – " + desc.str[:50])
+    return _mappa_etichette(df["id"], df["codice"].astype(str) + " – " + desc)
+
 # ------------------------------------------------------------------
 # Calcoli
 # ------------------------------------------------------------------
@@ -594,6 +1011,181 @@ def compute_totali_voce(voce_id: int) -> Dict[str, float]:
         "diretto": diretto,
     }
 
+def _applica_cg_utile(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Versione vettoriale delle regole di compute_totali_voce (stessa semantica):
+    CG% sul diretto (materie+mdo), Utile% su (diretto+CG).
+    Richiede le colonne costo_materie, costo_manodopera, cg_pct, utile_pct.
+    """
+    diretto = df["costo_materie"] + df["costo_manodopera"]
+    cg = diretto * (df["cg_pct"] / 100.0)
+    base = diretto + cg
+    utile = base * (df["utile_pct"] / 100.0)
+    df["costi_generali"] = cg
+    df["utile"] = utile
+    df["totale"] = base + utile
+    df["diretto"] = diretto
+    return df
+
+def compute_totali_voci(voce_ids: Optional[list[int]] = None) -> pd.DataFrame:
+    """
+    Motore "batch": totali di tutte le voci (o solo di voce_ids) con UNA query
+    aggregata su righe_distinta + materiali_base e calcoli a colonne.
+    Una riga per voce (anche senza distinta -> totali a 0), ordinate per capitolo/voce.
+    """
+    filtro_v, filtro_r, params = "", "", []
+    if voce_ids is not None:
+        ids = [int(x) for x in voce_ids]
+        if not ids:
+            return _applica_cg_utile(pd.DataFrame(columns=[
+                "voce_id", "capitolo_id", "capitolo_codice", "capitolo_nome", "codice", "descrizione",
+                "cg_pct", "utile_pct", "um_voce", "q_voce", "prezzo_rif", "costo_materie", "costo_manodopera",
+            ]).astype({"cg_pct": float, "utile_pct": float, "costo_materie": float, "costo_manodopera": float}))
+        marks = ",".join(["?"] * len(ids))
+        filtro_r = f"WHERE r.voce_analisi_id IN ({marks})"
+        filtro_v = f"WHERE v.id IN ({marks})"
+        params = ids + ids
+
+    q = f"""
+        SELECT v.id AS voce_id, v.capitolo_id,
+               c.codice AS capitolo_codice, c.nome AS capitolo_nome,
+               v.codice, v.descrizione,
+               IFNULL(v.costi_generali_percentuale,0) AS cg_pct,
+               IFNULL(v.utile_percentuale,0) AS utile_pct,
+               v.voce_unita_misura AS um_voce,
+               IFNULL(v.voce_quantita,1.0) AS q_voce,
+               IFNULL(v.prezzo_riferimento,0.0) AS prezzo_rif,
+               IFNULL(d.costo_materie,0.0) AS costo_materie,
+               IFNULL(d.costo_manodopera,0.0) AS costo_manodopera
+        FROM voci_analisi v
+        JOIN capitoli c ON c.id = v.capitolo_id
+        LEFT JOIN (
+            SELECT r.voce_analisi_id,
+                   SUM(CASE WHEN IFNULL(m.is_manodopera,0) = 0
+                            THEN r.quantita * m.prezzo_unitario ELSE 0 END) AS costo_materie,
+                   SUM(CASE WHEN IFNULL(m.is_manodopera,0) = 0
+                            THEN 0 ELSE r.quantita * m.prezzo_unitario END) AS costo_manodopera
+            FROM righe_distinta r
+            JOIN materiali_base m ON m.id = r.materiale_id
+            JOIN categorie cat ON cat.id = m.categoria_id
+            JOIN fornitori f ON f.id = m.fornitore_id
+            {filtro_r}
+            GROUP BY r.voce_analisi_id
+        ) d ON d.voce_analisi_id = v.id
+        {filtro_v}
+        ORDER BY c.codice, v.codice
+    """
+    with get_con() as con:
+        df = _read_sql(q, con, params=params, colonnare=voce_ids is None)
+    for col in ("cg_pct", "utile_pct", "q_voce", "prezzo_rif", "costo_materie", "costo_manodopera"):
+        df[col] = df[col].astype(float)
+    return _applica_cg_utile(df)
+
+def df_righe_voci(voce_ids: Optional[list[int]] = None) -> pd.DataFrame:
+    """Come df_righe ma per più voci in una sola query (colonna voce_analisi_id per raggruppare)."""
+    filtro, params = "", []
+    if voce_ids is not None:
+        ids = [int(x) for x in voce_ids]
+        filtro = "WHERE r.voce_analisi_id IN ({})".format(",".join(["?"] * len(ids)) or "NULL")
+        params = ids
+    with get_con() as con:
+        return _read_sql(f"""
+            SELECT r.id, r.voce_analisi_id, r.materiale_id, r.quantita,
+                   m.descrizione AS materiale_descrizione,
+                   m.unita_misura, m.prezzo_unitario,
+                   c.nome AS categoria, f.nome AS fornitore, m.codice_fornitore,
+                   IFNULL(m.is_manodopera,0) AS is_manodopera,
+                   (r.quantita * m.prezzo_unitario) AS subtotale
+            FROM righe_distinta r
+            JOIN materiali_base m ON m.id = r.materiale_id
+            JOIN categorie c ON c.id = m.categoria_id
+            JOIN fornitori f ON f.id = m.fornitore_id
+            {filtro}
+            ORDER BY r.voce_analisi_id, r.id
+        """, con, params=params, categoriche=("categoria", "fornitore", "unita_misura"))
+
+def refresh_voci_totali() -> int:
+    """
+    Aggiorna la cache voci_totali: ricalcola (motore batch) solo le voci marcate
+    dirty dai trigger o non ancora presenti. Ritorna il numero di voci ricalcolate.
+    """
+    with get_con() as con:
+        # controllo in sola lettura: senza voci dirty o mancanti nessun lock in scrittura
+        # (le letture del Sommario/preventivi non si mettono in coda dietro chi scrive)
+        da_fare = _exec(con, """
+            SELECT EXISTS (SELECT 1 FROM voci_totali WHERE dirty <> 0)
+                OR EXISTS (SELECT 1 FROM voci_analisi v
+                           WHERE NOT EXISTS (SELECT 1 FROM voci_totali t WHERE t.voce_id = v.id))
+        """, nome="voci_totali_da_fare").fetchone()[0]
+        if not da_fare:
+            return 0
+        DIALETTO.inizia_scrittura(con)
+        # nuove voci -> riga dirty; poi "prenoto" le dirty (2 = in calcolo):
+        # se un trigger le rimarca a 1 durante il calcolo restano da ricalcolare
+        _exec(con, """
+            INSERT INTO voci_totali (voce_id, dirty)
+            SELECT v.id, 1 FROM voci_analisi v
+            WHERE NOT EXISTS (SELECT 1 FROM voci_totali t WHERE t.voce_id = v.id)
+        """)
+        _exec(con, "UPDATE voci_totali SET dirty = 2 WHERE dirty = 1")
+        ids = [int(r[0]) for r in _exec(con, "SELECT voce_id FROM voci_totali WHERE dirty = 2").fetchall()]
+        con.commit()
+    if not ids:
+        return 0
+
+    tot = compute_totali_voci(ids)
+    pu = tot["totale"] / tot["q_voce"].clip(lower=1e-9)
+    rows = list(zip(
+        tot["costo_materie"].tolist(), tot["costo_manodopera"].tolist(),
+        tot["costi_generali"].tolist(), tot["utile"].tolist(),
+        tot["totale"].tolist(), pu.tolist(), tot["voce_id"].astype(int).tolist(),
+    ))
+    with get_con() as con:
+        _execmany(con, """
+            UPDATE voci_totali
+            SET costo_materie=?, costo_manodopera=?, costi_generali=?, utile=?, totale=?,
+                prezzo_unitario=?, updated_at=datetime('now'),
+                dirty = CASE WHEN dirty = 2 THEN 0 ELSE dirty END
+            WHERE voce_id=?
+        """, rows)
+        con.commit()
+    return len(rows)
+
+def totali_voci(voce_ids: Optional[list[int]] = None) -> pd.DataFrame:
+    """
+    Totali voce letti dalla cache voci_totali (aggiornata prima della lettura).
+    Stesse colonne di compute_totali_voci (+ prezzo_unitario).
+    """
+    refresh_voci_totali()
+    filtro, params = "", []
+    if voce_ids is not None:
+        ids = [int(x) for x in voce_ids]
+        filtro = "WHERE v.id IN ({})".format(",".join(["?"] * len(ids)) or "NULL")
+        params = ids
+    with get_con() as con:
+        df = _read_sql(f"""
+            SELECT v.id AS voce_id, v.capitolo_id,
+                   c.codice AS capitolo_codice, c.nome AS capitolo_nome,
+                   v.codice, v.descrizione,
+                   IFNULL(v.costi_generali_percentuale,0) AS cg_pct,
+                   IFNULL(v.utile_percentuale,0) AS utile_pct,
+                   v.voce_unita_misura AS um_voce,
+                   IFNULL(v.voce_quantita,1.0) AS q_voce,
+                   IFNULL(v.prezzo_riferimento,0.0) AS prezzo_rif,
+                   t.costo_materie, t.costo_manodopera, t.costi_generali, t.utile, t.totale,
+                   (t.costo_materie + t.costo_manodopera) AS diretto,
+                   t.prezzo_unitario
+            FROM voci_analisi v
+            JOIN capitoli c ON c.id = v.capitolo_id
+            JOIN voci_totali t ON t.voce_id = v.id
+            {filtro}
+            ORDER BY c.codice, v.codice
+        """, con, params=params, categoriche=("capitolo_codice", "um_voce"))
+    for col in ("cg_pct", "utile_pct", "q_voce", "prezzo_rif", "costo_materie", "costo_manodopera",
+                "costi_generali", "utile", "totale", "diretto", "prezzo_unitario"):
+        df[col] = df[col].astype(float)
+    return df
+
 # -------- (2) Impatti da aggiornamento materiali --------
 def voci_impattate_da_materiali(material_ids: list[int]) -> pd.DataFrame:
     """Ritorna le voci che usano almeno uno dei materiali indicati."""
@@ -611,37 +1203,301 @@ def voci_impattate_da_materiali(material_ids: list[int]) -> pd.DataFrame:
         WHERE r.materiale_id IN ({})
         ORDER BY c.codice, v.codice
         """.format(",".join(["?"]*len(material_ids)))
-        return pd.read_sql_query(q, con, params=list(material_ids))
-
-def anteprima_impatti_materiali(material_ids: list[int]) -> pd.DataFrame:
-    """
-    Calcola il totale attuale della VOCE (con i prezzi base correnti) e lo
-    confronta con il prezzo di riferimento della voce (se presente).
-    """
-    voci_df = voci_impattate_da_materiali(material_ids)
-    rows = []
-    for _, r in voci_df.iterrows():
-        tot = compute_totali_voce(int(r.voce_id))["totale"]
-        rif = float(r.get("prezzo_rif", 0.0))
-        delta_pct = ((tot - rif) / rif * 100.0) if rif > 0 else None
-        rows.append({
-            "Capitolo": r.capitolo_codice,
-            "Voce": r.codice,
-            "Descrizione": r.descrizione,
-            "Totale attuale (€)": round(tot, 2),
-            "Prezzo riferimento (€)": (round(rif, 2) if rif > 0 else "-"),
-            "Δ vs riferimento (%)": (f"{delta_pct:+.2f}%" if delta_pct is not None else "-"),
-            "voce_id": int(r.voce_id),
-        })
-    return pd.DataFrame(rows)
+        return _read_sql(q, con, params=list(material_ids))
+
+def indice_materiali_voci(material_ids: list[int]) -> pd.DataFrame:
+    """
+    Indice inverso materiale -> voci (via idx_righe_mat): per ogni coppia
+    (materiale, voce) la quantità totale in distinta, con prezzo corrente e flag MDO.
+    """
+    ids = [int(x) for x in material_ids]
+    blocchi = [ids[i:i + 900] for i in range(0, len(ids), 900)] or [[]]  # limite parametri SQL
+    with get_con() as con:
+        df = pd.concat([_read_sql("""
+            SELECT r.materiale_id, r.voce_analisi_id AS voce_id, SUM(r.quantita) AS quantita,
+                   m.prezzo_unitario, IFNULL(m.is_manodopera,0) AS is_manodopera
+            FROM righe_distinta r
+            JOIN materiali_base m ON m.id = r.materiale_id
+            WHERE r.materiale_id IN ({})
+            GROUP BY r.materiale_id, r.voce_analisi_id, m.prezzo_unitario, m.is_manodopera
+        """.format(",".join(["?"] * len(b)) or "NULL"), con, params=b) for b in blocchi], ignore_index=True)
+    for col in ("quantita", "prezzo_unitario"):
+        df[col] = df[col].astype(float)
+    return df
+
+def _delta_costi_voce(idx: pd.DataFrame, delta_prezzo: pd.Series) -> pd.DataFrame:
+    """Σ(Δprezzo × quantità) per voce, separato materie / manodopera (indice = voce_id)."""
+    d = delta_prezzo.to_numpy(dtype=float) * idx["quantita"].to_numpy(dtype=float)
+    mdo = idx["is_manodopera"].to_numpy() != 0
+    return (pd.DataFrame({
+        "voce_id": idx["voce_id"].to_numpy(),
+        "d_materie": np.where(mdo, 0.0, d),
+        "d_manodopera": np.where(mdo, d, 0.0),
+    }).groupby("voce_id").sum())
+
+def _tabella_impatti(prima: pd.DataFrame, dopo: pd.DataFrame) -> pd.DataFrame:
+    """Tabella prima/dopo/Δ% (+ confronto col prezzo di riferimento) per la UI."""
+    rif = dopo["prezzo_rif"]
+    delta = (dopo["totale"] - prima["totale"]) / prima["totale"].where(prima["totale"] > 0) * 100.0
+    delta_rif = (dopo["totale"] - rif) / rif.where(rif > 0) * 100.0
+    _pct = lambda x: "-" if pd.isna(x) else f"{x:+.2f}%"
+    return pd.DataFrame({
+        "Capitolo": dopo["capitolo_codice"],
+        "Voce": dopo["codice"],
+        "Descrizione": dopo["descrizione"],
+        "Totale prima (€)": prima["totale"].round(2),
+        "Totale dopo (€)": dopo["totale"].round(2),
+        "Δ (%)": delta.map(_pct),
+        "Prezzo riferimento (€)": rif.round(2).where(rif > 0, "-"),
+        "Δ vs riferimento (%)": delta_rif.map(_pct),
+        "voce_id": dopo["voce_id"].astype(int),
+    }).reset_index(drop=True)
+
+def _applica_delta(tot: pd.DataFrame, d: pd.DataFrame, segno: float) -> pd.DataFrame:
+    """Totali voce con costi diretti spostati di segno×Δ, CG/Utile riapplicati."""
+    out = tot.copy()
+    dd = d.reindex(out["voce_id"].to_numpy()).fillna(0.0)
+    out["costo_materie"] = out["costo_materie"].to_numpy() + segno * dd["d_materie"].to_numpy()
+    out["costo_manodopera"] = out["costo_manodopera"].to_numpy() + segno * dd["d_manodopera"].to_numpy()
+    return _applica_cg_utile(out)
+
+def impatto_prezzi_materiali(nuovi_prezzi: Dict[int, float]) -> pd.DataFrame:
+    """
+    Anteprima incrementale (prima di salvare): totale nuovo = totale attuale
+    + Σ(Δprezzo × quantità) con CG/Utile riapplicati. Una query sull'indice
+    inverso + totali dalla cache voci_totali, niente ricalcolo completo delle voci.
+    """
+    idx = indice_materiali_voci(list(nuovi_prezzi))
+    if idx.empty:
+        return _tabella_impatti(*(2 * [totali_voci([])]))
+    nuovi = idx["materiale_id"].map({int(k): float(v) for k, v in nuovi_prezzi.items()})
+    d = _delta_costi_voce(idx, nuovi - idx["prezzo_unitario"])
+    prima = totali_voci(d.index.tolist())
+    return _tabella_impatti(prima, _applica_delta(prima, d, +1.0))
+
+def anteprima_impatti_materiali(material_ids: list[int],
+                                prezzi_precedenti: Optional[Dict[int, float]] = None) -> pd.DataFrame:
+    """
+    Voci che usano i materiali indicati: totale attuale (prezzi già salvati) a confronto
+    con il totale prima della modifica (ricostruito da prezzi_precedenti con l'indice
+    inverso, senza ricalcolare le voci) e con il prezzo di riferimento della voce.
+    """
+    idx = indice_materiali_voci(material_ids)
+    dopo = totali_voci(sorted(idx["voce_id"].unique().tolist()))
+    if not prezzi_precedenti or idx.empty:
+        return _tabella_impatti(dopo, dopo)
+    prec = idx["materiale_id"].map({int(k): float(v) for k, v in prezzi_precedenti.items()})
+    d = _delta_costi_voce(idx, (idx["prezzo_unitario"] - prec).fillna(0.0))
+    return _tabella_impatti(_applica_delta(dopo, d, -1.0), dopo)
+
+# -------- (3) Scenari what-if (solo in memoria, nessuna scrittura) --------
+@cached_query("righe_distinta", "materiali_base", "voci_analisi", "capitoli", "categorie", "fornitori")
+def modello_costi() -> dict:
+    """
+    Listino in forma di array per le simulazioni: voci (come compute_totali_voci),
+    materiali usati in distinta e righe come coppie di posizioni (voce, materiale)
+    + quantità. Condiviso in cache: non modificarne gli array.
+    """
+    with get_con() as con:
+        voci = _read_sql("""
+            SELECT v.id AS voce_id, v.capitolo_id,
+                   c.codice AS capitolo_codice, c.nome AS capitolo_nome,
+                   v.codice, v.descrizione,
+                   IFNULL(v.costi_generali_percentuale,0) AS cg_pct,
+                   IFNULL(v.utile_percentuale,0) AS utile_pct,
+                   v.voce_unita_misura AS um_voce,
+                   IFNULL(v.voce_quantita,1.0) AS q_voce,
+                   IFNULL(v.prezzo_riferimento,0.0) AS prezzo_rif
+            FROM voci_analisi v
+            JOIN capitoli c ON c.id = v.capitolo_id
+            ORDER BY c.codice, v.codice
+        """, con)
+        righe = _read_sql("""
+            SELECT r.voce_analisi_id AS voce_id, r.materiale_id, r.quantita,
+                   m.prezzo_unitario, IFNULL(m.is_manodopera,0) AS is_manodopera, m.categoria_id
+            FROM righe_distinta r
+            JOIN materiali_base m ON m.id = r.materiale_id
+            JOIN categorie cat ON cat.id = m.categoria_id
+            JOIN fornitori f ON f.id = m.fornitore_id
+        """, con, colonnare=True)
+    mat = righe.drop_duplicates("materiale_id")
+    pos_voce = pd.Index(voci["voce_id"].astype(int))
+    pos_mat = pd.Index(mat["materiale_id"].astype(int))
+    riga_voce = pos_voce.get_indexer(righe["voce_id"].astype(int))
+    ok = riga_voce >= 0  # righe di voci senza capitolo: escluse come nel motore batch
+    return {
+        "voci": voci,
+        "capitolo_id": voci["capitolo_id"].to_numpy(),
+        "cg_pct": voci["cg_pct"].to_numpy(dtype=float),
+        "utile_pct": voci["utile_pct"].to_numpy(dtype=float),
+        "materiali": pos_mat,
+        "prezzo": mat["prezzo_unitario"].to_numpy(dtype=float),
+        "categoria_id": mat["categoria_id"].to_numpy(),
+        "riga_voce": riga_voce[ok],
+        "riga_mat": pos_mat.get_indexer(righe["materiale_id"].astype(int))[ok],
+        "riga_mdo": righe["is_manodopera"].to_numpy()[ok] != 0,
+        "quantita": righe["quantita"].to_numpy(dtype=float)[ok],
+    }
+
+def valuta_scenario(mod: dict,
+                    prezzi: Optional[Dict[int, float]] = None,
+                    variazioni_categoria: Optional[Dict[int, float]] = None,
+                    cg_capitolo: Optional[Dict[int, float]] = None,
+                    utile_capitolo: Optional[Dict[int, float]] = None) -> dict:
+    """
+    Totali di tutte le voci del modello con le ipotesi indicate, a colonne (numpy):
+    - prezzi: materiale_id -> prezzo unitario ipotetico (prevale sulle variazioni);
+    - variazioni_categoria: categoria_id -> variazione % dei prezzi della categoria;
+    - cg_capitolo / utile_capitolo: capitolo_id -> CG% / Utile% al posto di quelli delle voci.
+    Stesse regole di compute_totali_voce (via _applica_cg_utile).
+    """
+    prezzo = mod["prezzo"]
+    if variazioni_categoria:
+        prezzo = prezzo.copy()
+        for cat_id, pct in variazioni_categoria.items():
+            prezzo[mod["categoria_id"] == int(cat_id)] *= 1.0 + float(pct) / 100.0
+    if prezzi:
+        pos = mod["materiali"].get_indexer([int(k) for k in prezzi])
+        val = np.fromiter((float(v) for v in prezzi.values()), dtype=float, count=len(prezzi))
+        if prezzo is mod["prezzo"]:
+            prezzo = prezzo.copy()
+        prezzo[pos[pos >= 0]] = val[pos >= 0]  # materiali non usati in distinta: irrilevanti
+
+    n = len(mod["voci"])
+    costo = mod["quantita"] * prezzo[mod["riga_mat"]]
+    mdo = mod["riga_mdo"]
+    cg_pct, utile_pct = mod["cg_pct"], mod["utile_pct"]
+    if cg_capitolo:
+        cg_pct = cg_pct.copy()
+        for cap_id, pct in cg_capitolo.items():
+            cg_pct[mod["capitolo_id"] == int(cap_id)] = float(pct)
+    if utile_capitolo:
+        utile_pct = utile_pct.copy()
+        for cap_id, pct in utile_capitolo.items():
+            utile_pct[mod["capitolo_id"] == int(cap_id)] = float(pct)
+    return _applica_cg_utile({
+        "costo_materie": np.bincount(mod["riga_voce"], weights=np.where(mdo, 0.0, costo), minlength=n),
+        "costo_manodopera": np.bincount(mod["riga_voce"], weights=np.where(mdo, costo, 0.0), minlength=n),
+        "cg_pct": cg_pct,
+        "utile_pct": utile_pct,
+    })
+
+def confronta_scenario(**ipotesi) -> tuple:
+    """
+    Scenario a confronto con il listino attuale (argomenti come valuta_scenario).
+    Ritorna (per_voce, per_capitolo): totali attuale/scenario e Δ, nessuna scrittura sul DB.
+    """
+    mod = modello_costi()
+    base = valuta_scenario(mod)
+    sim = valuta_scenario(mod, **ipotesi)
+    voci = mod["voci"]
+    per_voce = pd.DataFrame({
+        "voce_id": voci["voce_id"].to_numpy(),
+        "capitolo_id": mod["capitolo_id"],
+        "Capitolo": voci["capitolo_codice"].to_numpy(),
+        "CapitoloNome": voci["capitolo_nome"].to_numpy(),
+        "Cod. Voce": voci["codice"].to_numpy(),
+        "Descrizione": voci["descrizione"].to_numpy(),
+        "CG % scenario": sim["cg_pct"],
+        "Utile % scenario": sim["utile_pct"],
+        "Totale attuale (€)": base["totale"],
+        "Totale scenario (€)": sim["totale"],
+    })
+    per_voce["Δ (€)"] = per_voce["Totale scenario (€)"] - per_voce["Totale attuale (€)"]
+    att = per_voce["Totale attuale (€)"]
+    per_voce["Δ (%)"] = per_voce["Δ (€)"] / att.where(att > 0) * 100.0
+
+    per_capitolo = (per_voce.groupby(["capitolo_id", "Capitolo", "CapitoloNome"], sort=False)
+                    [["Totale attuale (€)", "Totale scenario (€)", "Δ (€)"]].sum().reset_index())
+    att = per_capitolo["Totale attuale (€)"]
+    per_capitolo["Δ (%)"] = per_capitolo["Δ (€)"] / att.where(att > 0) * 100.0
+    return per_voce, per_capitolo
+
+# -------- (4) Listino a una data (dallo storico prezzi) --------
+# Prezzo di un materiale all'istante T = prezzo_vecchio della prima variazione dopo T,
+# se c'è, altrimenti quello attuale: una query a finestra su idx_sto_mat_data.
+_SQL_PREZZI_AL = """
+    SELECT materiale_id, prezzo_vecchio
+    FROM (
+        SELECT materiale_id, prezzo_vecchio,
+               ROW_NUMBER() OVER (PARTITION BY materiale_id ORDER BY changed_at, id) AS rn
+        FROM materiali_prezzi_storico
+        WHERE changed_at > ?
+    ) s
+    WHERE rn = 1
+"""
+
+# date del preventivo scritte a mano oltre a 'YYYY-MM-DD' (giorno prima del mese)
+_FORMATI_DATA = ("%d/%m/%Y", "%d-%m-%Y", "%d.%m.%Y", "%d/%m/%y")
+
+def istante_listino(data) -> str:
+    """
+    Data -> istante nel formato di changed_at: solo data (date, 'YYYY-MM-DD', 'GG/MM/AAAA'...)
+    = fine di quel giorno; data+ora invariata. ValueError se non è una data: confrontata
+    come stringa grezza ('12/08/2025' con '2025-...') darebbe prezzi sbagliati senza errori.
+    """
+    if isinstance(data, datetime.datetime):  # anche pd.Timestamp
+        return data.strftime("%Y-%m-%d %H:%M:%S")
+    if isinstance(data, datetime.date):
+        return f"{data.isoformat()} 23:59:59"
+    s = str(data if data is not None else "").strip()
+    try:
+        t = datetime.datetime.fromisoformat(s)
+        return t.strftime("%Y-%m-%d %H:%M:%S") if len(s) > 10 else f"{t.date().isoformat()} 23:59:59"
+    except ValueError:
+        pass
+    for fmt in _FORMATI_DATA:
+        try:
+            return f"{datetime.datetime.strptime(s, fmt).date().isoformat()} 23:59:59"
+        except ValueError:
+            continue
+    raise ValueError(f"Data non valida: {repr(s) if s else '(vuota)'} (usa AAAA-MM-GG o GG/MM/AAAA).")
+
+@cached_query("materiali_base")  # lo storico lo scrive il trigger sugli UPDATE di materiali_base
+def prezzi_materiali_al(istante: str) -> Dict[int, float]:
+    """materiale_id -> prezzo all'istante, solo per i materiali variati dopo (gli altri: prezzo attuale)."""
+    with get_con() as con:
+        rows = _exec(con, _SQL_PREZZI_AL, (istante,)).fetchall()
+    return {int(m): float(p) for m, p in rows}
+
+def totali_voci_al(data) -> pd.DataFrame:
+    """
+    Totali di tutte le voci con i prezzi dei materiali alla data (stesse colonne di
+    compute_totali_voci), in batch sul modello in cache. Distinte e CG/Utile sono
+    quelli attuali: lo storico registra solo i prezzi.
+    """
+    mod = modello_costi()
+    tot = valuta_scenario(mod, prezzi=prezzi_materiali_al(istante_listino(data)))
+    out = mod["voci"].copy()
+    for col in ("cg_pct", "utile_pct", "q_voce", "prezzo_rif"):
+        out[col] = out[col].astype(float)
+    for col in ("costo_materie", "costo_manodopera", "costi_generali", "utile", "totale", "diretto"):
+        out[col] = tot[col]
+    return out
+
+def riprezza_preventivo_al(pid: int, data=None) -> pd.DataFrame:
+    """
+    Righe del preventivo con il prezzo unitario della voce ricalcolato col listino alla
+    data (default: la data del preventivo), accanto al prezzo salvato nella riga.
+    """
+    testa, righe = df_preventivo(int(pid))
+    cols = ["capitolo_codice", "voce_codice", "descrizione", "um", "quantita", "prezzo_unitario", "prezzo_totale"]
+    if testa.empty or righe.empty:
+        return pd.DataFrame(columns=cols + ["prezzo_unitario_al", "prezzo_totale_al", "differenza"])
+    tot = totali_voci_al(data if data is not None else testa["data"].iloc[0]).set_index("voce_id")
+    pu = tot["totale"] / tot["q_voce"].clip(lower=1e-9)  # come prezzo_unitario_voce
+    out = righe[cols].copy()
+    out["prezzo_unitario_al"] = pu.reindex(righe["voce_id"].astype(int)).to_numpy()
+    out["prezzo_totale_al"] = out["quantita"].astype(float) * out["prezzo_unitario_al"]
+    out["differenza"] = out["prezzo_totale_al"] - out["prezzo_totale"].astype(float)
+    return out
 
 def prezzo_unitario_voce(voce_id: int) -> float:
-    v = get_voce(voce_id)
-    if not v:
-        return 0.0
-    tot = compute_totali_voce(voce_id)["totale"]
-    q = max(float(v["q_voce"]), 1e-9)
-    return tot / q
+    """Prezzo unitario (totale / q.tà voce) letto dalla cache voci_totali."""
+    refresh_voci_totali()
+    with get_con() as con:
+        row = _exec(con, "SELECT prezzo_unitario FROM voci_totali WHERE voce_id=?", (int(voce_id),)).fetchone()
+    return float(row[0]) if row else 0.0
 
 # ------------------------------------------------------------------
 # Mutations (CRUD)
@@ -651,8 +1507,9 @@ def add_categoria(nome: str):
         try:
             _exec(con, "INSERT INTO categorie (nome) VALUES (?)", (nome.strip(),))
             con.commit()
+            _invalidate("categorie")
             st.success("Categoria aggiunta.")
-        except sqlite3.IntegrityError:
+        except ERRORI_INTEGRITA:
             st.warning("Categoria già esistente.")
 
 def delete_categoria(cid: int):
@@ -663,6 +1520,7 @@ def delete_categoria(cid: int):
             return
         _exec(con, "DELETE FROM categorie WHERE id=?", (cid,))
         con.commit()
+        _invalidate("categorie")
         st.success("Categoria eliminata.")
 
 # ------------------------------------------------------------------
@@ -686,8 +1544,8 @@ def ui_categorie():
         if not df.empty:
             del_id = st.selectbox(
                 "Elimina categoria",
-                options=[None] + df["id"].tolist(),
-                format_func=lambda x: "—" if x is None else df[df["id"] == x]["nome"].iloc[0],
+                options=[None] + list(etichette_categorie()),
+                format_func=lambda x: "—" if x is None else etichette_categorie()[x],
             )
             if del_id and st.button("Elimina"):
                 delete_categoria(int(del_id))
@@ -716,8 +1574,9 @@ def add_fornitore(nome, piva, indirizzo, email, telefono):
                           VALUES (?,?,?,?,?)""",
                   (nome.strip(), piva, indirizzo, email, telefono))
             con.commit()
+            _invalidate("fornitori")
             st.success("Fornitore aggiunto.")
-        except sqlite3.IntegrityError:
+        except ERRORI_INTEGRITA:
             st.warning("Fornitore già esistente (vincolo su Nome).")
 
 def delete_fornitore(fid: int):
@@ -728,6 +1587,7 @@ def delete_fornitore(fid: int):
             return
         _exec(con, "DELETE FROM fornitori WHERE id=?", (fid,))
         con.commit()
+        _invalidate("fornitori")
         st.success("Fornitore eliminato.")
 
 def add_materiale(categoria_id, fornitore_id, codice_fornitore, descrizione, um, qdef, prezzo, is_manodopera=0):
@@ -739,39 +1599,165 @@ def add_materiale(categoria_id, fornitore_id, codice_fornitore, descrizione, um,
             """, (int(categoria_id), int(fornitore_id), codice_fornitore.strip(), descrizione.strip(),
                   um, float(qdef or 1.0), float(prezzo), int(bool(is_manodopera))))
             con.commit()
+            _invalidate("materiali_base")
             st.success("Materiale inserito.")
-    except sqlite3.IntegrityError:
+    except ERRORI_INTEGRITA:
         st.error("Codice fornitore già presente per questo fornitore.")
 
 
+MATERIALI_CAMPI_EDITABILI = ["descrizione", "unita_misura", "quantita_default", "prezzo_unitario", "is_manodopera"]
+
+def diff_materiali(df_edit: pd.DataFrame, df_orig: pd.DataFrame) -> pd.DataFrame:
+    """
+    Confronto vettoriale editor vs originale (indicizzati per id): maschera booleana
+    id x campo. Numeri confrontati con tolleranza (niente falsi cambi da formattazione).
+    """
+    fields = MATERIALI_CAMPI_EDITABILI
+    new = df_edit.set_index("id")[fields]
+    old = df_orig.drop_duplicates("id").set_index("id")[fields].reindex(new.index)
+
+    changed = pd.DataFrame(False, index=new.index, columns=fields)
+    for f in ("quantita_default", "prezzo_unitario"):
+        n = pd.to_numeric(new[f], errors="coerce").to_numpy(dtype=float, na_value=np.nan)
+        o = pd.to_numeric(old[f], errors="coerce").to_numpy(dtype=float, na_value=np.nan)
+        changed[f] = ~np.isclose(n, o, rtol=1e-9, atol=1e-9, equal_nan=True)
+    for f in ("descrizione", "unita_misura"):
+        changed[f] = new[f].fillna("").astype(str) != old[f].fillna("").astype(str)
+    changed["is_manodopera"] = (pd.to_numeric(new["is_manodopera"], errors="coerce").fillna(0) != 0) != \
+                               (pd.to_numeric(old["is_manodopera"], errors="coerce").fillna(0) != 0)
+
+    # id non presenti nell'originale: niente da confrontare
+    changed.loc[old.index[old.isna().all(axis=1)]] = False
+    return changed
+
 def update_materiali_bulk(df_edit: pd.DataFrame, df_orig: pd.DataFrame):
-    changes = []
-    for _, row in df_edit.iterrows():
-        orig = df_orig[df_orig["id"] == row["id"]].iloc[0]
-        fields = ["descrizione", "unita_misura", "quantita_default", "prezzo_unitario", "is_manodopera"]  # ⬅️ aggiunto
-        updates = {}
-        for f in fields:
-            nv = row[f]
-            ov = orig[f]
-            if f == "is_manodopera":
-                nv = int(bool(nv))
-                ov = int(bool(ov))
-            if str(nv) != str(ov):
-                updates[f] = nv
-        if updates:
-            changes.append((int(row["id"]), updates))
-    ...
-
-    if not changes:
+    changed = diff_materiali(df_edit, df_orig)
+    changed = changed[changed.any(axis=1)]
+    if changed.empty:
         st.info("Nessuna modifica da salvare.")
         return
+
+    fields = MATERIALI_CAMPI_EDITABILI
+    new = df_edit.drop_duplicates("id").set_index("id").loc[changed.index, fields]
+    new["is_manodopera"] = (pd.to_numeric(new["is_manodopera"], errors="coerce").fillna(0) != 0).astype(int)
+    prezzi_prec = df_orig.drop_duplicates("id").set_index("id")["prezzo_unitario"]
+
+    # un executemany per ogni "firma" di colonne modificate (bitmask per riga)
+    firma = changed.to_numpy().astype(np.int64) @ (1 << np.arange(len(fields), dtype=np.int64))
+    with get_con() as con:
+        for code, ids in pd.Series(changed.index, index=firma).groupby(level=0):
+            cols = [f for i, f in enumerate(fields) if code & (1 << i)]
+            sub = new.loc[ids.to_numpy(), cols]
+            params = list(zip(*[sub[c].tolist() for c in cols], [int(i) for i in ids]))
+            sets = ", ".join(f"{c}=?" for c in cols)
+            _execmany(con, f"UPDATE materiali_base SET {sets} WHERE id=?", params)
+        con.commit()
+        _invalidate("materiali_base")
+
+    # materiali con prezzo cambiato -> anteprima impatti in ui_materiali
+    price_ids = changed.index[changed["prezzo_unitario"]]
+    st.session_state["last_changed_material_ids"] = [int(i) for i in price_ids]
+    st.session_state["last_changed_material_prices"] = {int(i): float(prezzi_prec.loc[i]) for i in price_ids}
+    st.success(f"Salvate {len(changed)} modifiche.")
+
+# -------- Rivalutazione prezzi (aumenti per fornitore/categoria, indici ISTAT...) --------
+RIVALUTAZIONE_DECIMALI = 4  # prezzi rivalutati a 4 decimali (prezzi unitari piccoli, es. €/pz)
+
+def _sql_rivalutazione(filtro: dict, regola: dict) -> tuple:
+    """
+    (espressione nuovo prezzo, WHERE sui materiali che cambiano, parametri espressione, parametri WHERE).
+    filtro: categoria_id, fornitore_id, is_manodopera (0/1), codice (jolly *), tutti facoltativi.
+    regola: {"tipo": "percentuale", "valore": 4.5} | {"tipo": "assoluto", "valore": 0.30}
+            | {"tipo": "fattori_categoria", "fattori": {categoria_id: 1.045, ...}} (solo quelle categorie).
+    """
+    cond, p_where = [], []
+    if filtro.get("categoria_id") is not None:
+        cond.append("categoria_id = ?"); p_where.append(int(filtro["categoria_id"]))
+    if filtro.get("fornitore_id") is not None:
+        cond.append("fornitore_id = ?"); p_where.append(int(filtro["fornitore_id"]))
+    if filtro.get("is_manodopera") is not None:
+        cond.append("IFNULL(is_manodopera,0) = ?"); p_where.append(1 if filtro["is_manodopera"] else 0)
+    if str(filtro.get("codice") or "").strip():
+        # '*' jolly dell'utente; % e _ letterali
+        cond.append("codice_fornitore LIKE ? ESCAPE '\\'")
+        p_where.append(_like_contains(filtro["codice"])[1:-1].replace("*", "%"))
+
+    tipo = regola.get("tipo")
+    if tipo == "percentuale":
+        expr, p_expr = "prezzo_unitario * (1 + ? / 100.0)", [float(regola["valore"])]
+    elif tipo == "assoluto":
+        expr, p_expr = "prezzo_unitario + ?", [float(regola["valore"])]
+    elif tipo == "fattori_categoria":
+        fattori = {int(k): float(v) for k, v in (regola.get("fattori") or {}).items()}
+        if not fattori:
+            raise ValueError("Nessun fattore per categoria indicato.")
+        expr = "prezzo_unitario * CASE categoria_id " + " ".join(["WHEN ? THEN ?"] * len(fattori)) + " ELSE 1 END"
+        p_expr = [x for kv in fattori.items() for x in kv]
+        cond.append("categoria_id IN ({})".format(",".join(["?"] * len(fattori))))
+        p_where += list(fattori)
+    else:
+        raise ValueError(f"Regola di rivalutazione non valida: {tipo!r}")
+    # mai prezzi negativi
+    expr = f"CASE WHEN ({expr}) < 0 THEN 0 ELSE ({expr}) END"
+    p_expr = p_expr * 2
+    # solo i materiali il cui prezzo cambia davvero (niente storico/trigger per i no-op): confronto
+    # col valore non arrotondato, scarti sotto il mezzo decimale salvato non contano
+    cond.append(f"ABS(({expr}) - prezzo_unitario) >= {0.5 / 10 ** RIVALUTAZIONE_DECIMALI}")
+    p_where = p_where + p_expr
+    # arrotondato solo il valore scritto; ROUND(numeric) anche in Postgres
+    expr = f"ROUND(CAST({expr} AS NUMERIC), {RIVALUTAZIONE_DECIMALI})"
+    return expr, " WHERE " + " AND ".join(cond), p_expr, p_where
+
+def _regola_nulla(regola: dict) -> bool:
+    """Regola che non cambia nessun prezzo (+0%, +0 €, fattori tutti 1)."""
+    if regola.get("tipo") == "fattori_categoria":
+        return all(float(v) == 1.0 for v in (regola.get("fattori") or {}).values())
+    return float(regola.get("valore") or 0) == 0.0
+
+def anteprima_rivalutazione(filtro: dict, regola: dict) -> tuple:
+    """(n. materiali che cambierebbero prezzo, tabella impatti sulle voci) senza scrivere nulla."""
+    expr, where, p_expr, p_where = _sql_rivalutazione(filtro, regola)
+    if _regola_nulla(regola):
+        return 0, impatto_prezzi_materiali({})
     with get_con() as con:
-        for mid, upd in changes:
-            sets = ", ".join([f"{k}=?" for k in upd.keys()])
-            vals = list(upd.values()) + [mid]
-            _exec(con, f"UPDATE materiali_base SET {sets} WHERE id=?", vals)
+        df = _read_sql(f"SELECT id, prezzo_unitario, {expr} AS nuovo FROM materiali_base{where}",
+                               con, params=p_expr + p_where)
+    return len(df), impatto_prezzi_materiali(dict(zip(df["id"].astype(int), df["nuovo"].astype(float))))
+
+def rivaluta_prezzi(filtro: dict, regola: dict, nota: str = "") -> dict:
+    """
+    Applica la rivalutazione con un solo UPDATE in una transazione; lo storico si
+    scrive col trigger trg_log_prezzo_materiale (righe etichettate con `nota`).
+    Ritorna {"materiali": n, "prezzi_precedenti": {id: prezzo}, "impatti": tabella voci}.
+    """
+    expr, where, p_expr, p_where = _sql_rivalutazione(filtro, regola)
+    if _regola_nulla(regola):
+        return {"materiali": 0, "prezzi_precedenti": {}, "impatti": anteprima_impatti_materiali([])}
+    with get_con() as con:
+        DIALETTO.inizia_scrittura(con)  # lock in scrittura prima di leggere i prezzi di partenza
+        if nota and DIALETTO.postgres:
+            # la nota la scrive il trigger, letta dalla variabile locale a questa transazione:
+            # le modifiche concorrenti (id di sequenza non in ordine di commit) non la ricevono
+            _exec(con, "SELECT set_config('epu.nota_prezzi', ?, true)", (nota,))
+        max_sto = _exec(con, "SELECT IFNULL(MAX(id),0) FROM materiali_prezzi_storico").fetchone()[0]
+        prec = dict(_exec(con, f"SELECT id, prezzo_unitario FROM materiali_base{where}{DIALETTO.per_update}",
+                          p_where).fetchall())
+        _exec(con, f"UPDATE materiali_base SET prezzo_unitario = {expr}{where}", p_expr + p_where)
+        if nota and not DIALETTO.postgres:
+            # SQLite: BEGIN IMMEDIATE esclude gli altri scrittori fino al commit, quindi le righe
+            # di storico dopo max_sto sono tutte di questo UPDATE (e solo dei materiali aggiornati)
+            _exec(con, """UPDATE materiali_prezzi_storico SET note=?
+                          WHERE id > ? AND materiale_id IN (SELECT value FROM json_each(?))""",
+                  (nota, max_sto, json.dumps([int(k) for k in prec])))
         con.commit()
-    st.success(f"Salvate {len(changes)} modifiche.")
+        _invalidate("materiali_base")
+
+    prec = {int(k): float(v) for k, v in prec.items()}
+    return {
+        "materiali": len(prec),
+        "prezzi_precedenti": prec,
+        "impatti": anteprima_impatti_materiali(list(prec), prec),
+    }
 
 def add_capitolo(codice, nome, cg_def, ut_def):
     try:
@@ -779,8 +1765,9 @@ def add_capitolo(codice, nome, cg_def, ut_def):
             _exec(con, "INSERT INTO capitoli (codice, nome, cg_default_percentuale, utile_default_percentuale) VALUES (?,?,?,?)",
                   (codice.strip(), nome.strip(), float(cg_def or 0.0), float(ut_def or 0.0)))
             con.commit()
+            _invalidate("capitoli")
             st.success("Capitolo inserito.")
-    except sqlite3.IntegrityError:
+    except ERRORI_INTEGRITA:
         st.error("Codice capitolo già esistente.")
 
 def update_capitolo_defaults(cid: int, cg_def: float, ut_def: float):
@@ -788,6 +1775,7 @@ def update_capitolo_defaults(cid: int, cg_def: float, ut_def: float):
         _exec(con, "UPDATE capitoli SET cg_default_percentuale=?, utile_default_percentuale=? WHERE id=?",
               (float(cg_def or 0.0), float(ut_def or 0.0), int(cid)))
         con.commit()
+        _invalidate("capitoli")
         st.success("Aggiornati i valori di Spese generali e Utile per il capitolo (influenza nuove voci; le esistenti restano invariate).")
 
 def delete_capitolo(cid: int):
@@ -798,6 +1786,7 @@ def delete_capitolo(cid: int):
             return
         _exec(con, "DELETE FROM capitoli WHERE id=?", (cid,))
         con.commit()
+        _invalidate("capitoli")
         st.success("Capitolo eliminato.")
 
 def add_voce(capitolo_id, codice, descrizione, cg_pct, utile_pct, um_voce, q_voce,
@@ -824,8 +1813,9 @@ def add_voce(capitolo_id, codice, descrizione, cg_pct, utile_pct, um_voce, q_voc
                 float(prezzo_rif or 0.0),
             ))
             con.commit()
+            _invalidate("voci_analisi")
             st.success("Voce creata.")
-    except sqlite3.IntegrityError:
+    except ERRORI_INTEGRITA:
         st.error("Codice voce già esistente nel capitolo.")
 
 
@@ -834,6 +1824,7 @@ def update_voce_perc(vid: int, cg_pct: float, utile_pct: float):
         _exec(con, "UPDATE voci_analisi SET costi_generali_percentuale=?, utile_percentuale=? WHERE id=?",
               (float(cg_pct or 0.0), float(utile_pct or 0.0), int(vid)))
         con.commit()
+        _invalidate("voci_analisi")
         st.success("Percentuali aggiornate.")
 
 def update_voce_perc_umqty(vid: int, cg_pct: float, utile_pct: float, um_voce: str, q_voce: float, prezzo_rif: float):
@@ -844,6 +1835,7 @@ def update_voce_perc_umqty(vid: int, cg_pct: float, utile_pct: float, um_voce: s
               (float(cg_pct or 0.0), float(utile_pct or 0.0), um_voce, float(q_voce or 1.0),
                float(prezzo_rif or 0.0), int(vid)))
         con.commit()
+        _invalidate("voci_analisi")
         st.success("Voce aggiornata.")
 
 def add_riga_distinta(voce_id: int, materiale_id: int, quantita: float):
@@ -851,6 +1843,7 @@ def add_riga_distinta(voce_id: int, materiale_id: int, quantita: float):
         _exec(con, "INSERT INTO righe_distinta (voce_analisi_id, materiale_id, quantita) VALUES (?,?,?)",
               (int(voce_id), int(materiale_id), float(quantita)))
         con.commit()
+        _invalidate("righe_distinta")
         st.success("Riga aggiunta.")
 
 def update_quantita_righe(voce_id: int, edited: pd.DataFrame, original: pd.DataFrame):
@@ -866,12 +1859,14 @@ def update_quantita_righe(voce_id: int, edited: pd.DataFrame, original: pd.DataF
         for q, rid in diffs:
             _exec(con, "UPDATE righe_distinta SET quantita=? WHERE id=?", (q, rid))
         con.commit()
+        _invalidate("righe_distinta")
     st.success(f"Aggiornate {len(diffs)} righe.")
 
 def delete_riga(riga_id: int):
     with get_con() as con:
         _exec(con, "DELETE FROM righe_distinta WHERE id=?", (riga_id,))
         con.commit()
+        _invalidate("righe_distinta")
         st.success("Riga eliminata.")
 
 def delete_voce(vid: int):
@@ -903,6 +1898,7 @@ def delete_voce(vid: int):
 
         _exec(con, "DELETE FROM voci_analisi WHERE id=?", (int(vid),))
         con.commit()
+        _invalidate("voci_analisi")
         st.session_state["delete_msg"] = "✅ Voce eliminata correttamente."
         st.rerun()   # ⬅️ idem in caso di successo
 
@@ -915,17 +1911,17 @@ def clone_voce(vid: int):
     new_code = f"{v['codice']}-COPY"
     with get_con() as con:
         try:
-            _exec(con, """INSERT INTO voci_analisi (capitolo_id, codice, descrizione, costi_generali_percentuale, utile_percentuale, voce_unita_misura, voce_quantita, prezzo_riferimento)
+            new_id = _insert_id(con, """INSERT INTO voci_analisi (capitolo_id, codice, descrizione, costi_generali_percentuale, utile_percentuale, voce_unita_misura, voce_quantita, prezzo_riferimento)
                           VALUES (?,?,?,?,?,?,?,?)""",
                   (v["capitolo_id"], new_code, v["descrizione"], v["cg_pct"], v["utile_pct"], v["um_voce"], v["q_voce"], v.get("prezzo_rif", 0.0)))
-            new_id = _exec(con, "SELECT last_insert_rowid()").fetchone()[0]
             rows = _exec(con, "SELECT materiale_id, quantita FROM righe_distinta WHERE voce_analisi_id=?", (vid,)).fetchall()
             for m_id, q in rows:
                 _exec(con, "INSERT INTO righe_distinta (voce_analisi_id, materiale_id, quantita) VALUES (?,?,?)",
                       (new_id, m_id, q))
             con.commit()
+            _invalidate("voci_analisi", "righe_distinta")
             st.success(f"Voce clonata come codice {new_code}.")
-        except sqlite3.IntegrityError:
+        except ERRORI_INTEGRITA:
             st.error("Esiste già una voce con quel codice; riprova.")
 
 # --- Eliminazioni con controlli di collegamenti ---
@@ -937,6 +1933,7 @@ def delete_cliente(cid: int):
             return
         _exec(con, "DELETE FROM clienti WHERE id=?", (cid,))
         con.commit()
+        _invalidate("clienti")
         st.success("Cliente eliminato.")
 
 def delete_materiale(mid: int):
@@ -947,66 +1944,199 @@ def delete_materiale(mid: int):
             return
         _exec(con, "DELETE FROM materiali_base WHERE id=?", (mid,))
         con.commit()
+        _invalidate("materiali_base")
         st.success("Materiale eliminato.")
 
 # ------------------------------------------------------------------
 # Import/Export
 # ------------------------------------------------------------------
-def import_materiali_csv(file):
+MATERIALI_COLONNE_OBBLIGATORIE = ["categoria", "fornitore", "codice_fornitore", "descrizione", "unita_misura", "prezzo_unitario"]
+# celle che non possono restare vuote (UM vuota = UM non valida, prezzo vuoto = 0)
+MATERIALI_CAMPI_OBBLIGATORI = ["categoria", "fornitore", "codice_fornitore", "descrizione"]
+
+def _leggi_tabella(file) -> pd.DataFrame:
+    """CSV o Excel in base all'estensione (se manca, prova CSV e poi Excel)."""
+    fname = str(getattr(file, "name", "")).lower()
+    if fname.endswith(".xlsx"):
+        return pd.read_excel(file)
     try:
-        df = pd.read_csv(file)
+        return pd.read_csv(file)
     except Exception:
         file.seek(0)
-        df = pd.read_excel(file)
+        return pd.read_excel(file)
 
-    required = {"categoria","fornitore","codice_fornitore","descrizione","unita_misura","prezzo_unitario"}
-    cols_lower = {c.lower(): c for c in df.columns}
-    if not required.issubset(set(cols_lower.keys())):
-        missing = required - set(cols_lower.keys())
-        st.error(f"Colonne mancanti: {', '.join(missing)}")
-        return
+def _txt_col(series: pd.Series) -> pd.Series:
+    """Testo ripulito; celle vuote/NaN -> "" (non "nan" né NULL, a seconda della versione di pandas)."""
+    return series.astype(object).where(series.notna(), "").astype(str).str.strip()
 
-    df = df.rename(columns={v: k.lower() for k, v in cols_lower.items()})
-    if "quantita_default" not in df.columns:
-        df["quantita_default"] = 1.0
+def _num_col(series: pd.Series, default: float) -> pd.Series:
+    """_to_float su una colonna intera (virgola decimale, default per vuoti/non numerici)."""
+    return pd.to_numeric(series.astype(str).str.replace(",", ".", regex=False), errors="coerce").fillna(default)
 
-    with get_con() as con:
-        for _, r in df.iterrows():
-            um = str(r["unita_misura"]).strip()
-            if um not in UM_CHOICES:
-                st.warning(f"UM non valida '{um}' per codice {r['codice_fornitore']} → saltato.")
-                continue
+def _flag_col(series: pd.Series) -> pd.Series:
+    """0/1 da numeri o testi tipo 1/si/sì/true/x."""
+    num = pd.to_numeric(series, errors="coerce")
+    txt = series.astype(str).str.strip().str.lower().isin(["si", "sì", "true", "x", "yes", "y"])
+    return ((num.fillna(0) != 0) | txt).astype(int)
 
-            cat = str(r["categoria"]).strip()
-            row = _exec(con, "SELECT id FROM categorie WHERE nome=?", (cat,)).fetchone()
-            if not row:
-                _exec(con, "INSERT INTO categorie (nome) VALUES (?)", (cat,))
-                cat_id = _exec(con, "SELECT last_insert_rowid()").fetchone()[0]
-            else:
-                cat_id = row[0]
+def import_materiali_bulk(df: pd.DataFrame, upsert: bool = False) -> dict:
+    """
+    Import materiali set-based: categorie/fornitori risolti con dizionari in memoria
+    (i mancanti creati con un executemany), materiali inseriti con executemany,
+    tutto in UNA transazione. Niente messaggi UI: ritorna un report
+      {"inseriti", "aggiornati", "duplicati", "righe_non_valide", "um_non_valide",
+       "categorie_create", "fornitori_creati", "materiali_modificati", "prezzi_modificati"}
+    dove duplicati/righe_non_valide/um_non_valide sono liste di dict (fornitore, codice_fornitore, ...);
+    righe_non_valide = righe con campi obbligatori vuoti, saltate (le altre vengono importate).
+
+    upsert=True (listino fornitore completo): i codici già presenti non sono duplicati
+    ma aggiornano prezzo_unitario, descrizione e unita_misura con un unico batch
+    INSERT ... ON CONFLICT DO UPDATE; lo storico prezzi lo scrive trg_log_prezzo_materiale.
+    "prezzi_modificati" = {materiale_id: prezzo precedente} dei soli prezzi cambiati.
+    Una violazione di vincoli (ERRORI_INTEGRITA) annulla tutto l'import e viene rilanciata.
+    """
+    df = df.rename(columns={c: str(c).strip().lower() for c in df.columns})
+    missing = [c for c in MATERIALI_COLONNE_OBBLIGATORIE if c not in df.columns]
+    if missing:
+        raise ValueError(f"Colonne mancanti: {', '.join(missing)}")
+
+    data = pd.DataFrame({
+        "categoria": _txt_col(df["categoria"]),
+        "fornitore": _txt_col(df["fornitore"]),
+        "codice_fornitore": _txt_col(df["codice_fornitore"]),
+        "descrizione": _txt_col(df["descrizione"]),
+        "unita_misura": _txt_col(df["unita_misura"]),
+        "quantita_default": _num_col(df["quantita_default"], 1.0) if "quantita_default" in df.columns else 1.0,
+        "prezzo_unitario": _num_col(df["prezzo_unitario"], 0.0),
+        "is_manodopera": _flag_col(df["is_manodopera"]) if "is_manodopera" in df.columns else 0,
+    })
+
+    vuoti = data[MATERIALI_CAMPI_OBBLIGATORI].eq("")
+    non_valide = vuoti.any(axis=1)
+    righe_non_valide = data.loc[non_valide, ["fornitore", "codice_fornitore", "descrizione"]].assign(
+        campi_vuoti=[", ".join(vuoti.columns[r]) for r in vuoti[non_valide].to_numpy()]).to_dict("records")
+    data = data[~non_valide]
+
+    um_ok = data["unita_misura"].isin(UM_CHOICES)
+    um_non_valide = data.loc[~um_ok, ["fornitore", "codice_fornitore", "unita_misura"]].to_dict("records")
+    data = data[um_ok]
 
-            forn = str(r["fornitore"]).strip()
-            row = _exec(con, "SELECT id FROM fornitori WHERE nome=?", (forn,)).fetchone()
-            if not row:
-                _exec(con, "INSERT INTO fornitori (nome) VALUES (?)", (forn,))
-                forn_id = _exec(con, "SELECT last_insert_rowid()").fetchone()[0]
-            else:
-                forn_id = row[0]
+    with get_con() as con:
+        # (fornitore, codice) -> (id, prezzo, descrizione, um) dei materiali già in archivio
+        esistenti = {(f, c): (mid, p, d, um) for mid, f, c, p, d, um in _exec(con, """
+            SELECT m.id, f.nome, m.codice_fornitore, m.prezzo_unitario, m.descrizione, m.unita_misura
+            FROM materiali_base m JOIN fornitori f ON f.id = m.fornitore_id
+        """).fetchall()}
+        chiavi = list(zip(data["fornitore"], data["codice_fornitore"]))
+        presente = pd.Series([k in esistenti for k in chiavi], index=data.index, dtype=bool)
+
+        # duplicati: ripetuti nel file e (senza upsert) già in archivio
+        dup = data.duplicated(subset=["fornitore", "codice_fornitore"], keep="first")
+        if not upsert:
+            dup |= presente
+        duplicati = data.loc[dup, ["fornitore", "codice_fornitore", "descrizione"]].to_dict("records")
+        data, presente = data[~dup], presente[~dup]
+
+        # con upsert: quali materiali esistenti cambiano davvero
+        modificati, prezzi_modificati = [], {}
+        for r in data[presente].itertuples(index=False):
+            mid, p_old, d_old, um_old = esistenti[(r.fornitore, r.codice_fornitore)]
+            prezzo_cambiato = abs(float(p_old) - float(r.prezzo_unitario)) > 1e-9
+            if prezzo_cambiato or d_old != r.descrizione or um_old != r.unita_misura:
+                modificati.append(int(mid))
+            if prezzo_cambiato:
+                prezzi_modificati[int(mid)] = float(p_old)
+
+        cat_map = {n: i for i, n in _exec(con, "SELECT id, nome FROM categorie").fetchall()}
+        forn_map = {n: i for i, n in _exec(con, "SELECT id, nome FROM fornitori").fetchall()}
+        nuove_cat = sorted(set(data["categoria"]) - set(cat_map))
+        nuovi_forn = sorted(set(data["fornitore"]) - set(forn_map))
+        try:
+            if nuove_cat:
+                _execmany(con, "INSERT INTO categorie (nome) VALUES (?)", [(n,) for n in nuove_cat])
+                cat_map = {n: i for i, n in _exec(con, "SELECT id, nome FROM categorie").fetchall()}
+            if nuovi_forn:
+                _execmany(con, "INSERT INTO fornitori (nome) VALUES (?)", [(n,) for n in nuovi_forn])
+                forn_map = {n: i for i, n in _exec(con, "SELECT id, nome FROM fornitori").fetchall()}
+
+            rows = list(zip(
+                data["categoria"].map(cat_map).astype(int).tolist(),
+                data["fornitore"].map(forn_map).astype(int).tolist(),
+                data["codice_fornitore"].tolist(),
+                data["descrizione"].tolist(),
+                data["unita_misura"].tolist(),
+                data["quantita_default"].astype(float).tolist(),
+                data["prezzo_unitario"].astype(float).tolist(),
+                data["is_manodopera"].astype(int).tolist(),
+            ))
+            sql_ins = """INSERT INTO materiali_base
+                         (categoria_id, fornitore_id, codice_fornitore, descrizione, unita_misura,
+                          quantita_default, prezzo_unitario, is_manodopera)
+                         VALUES (?,?,?,?,?,?,?,?)"""
+            if upsert:
+                sql_ins += """
+                         ON CONFLICT(fornitore_id, codice_fornitore) DO UPDATE SET
+                             prezzo_unitario = excluded.prezzo_unitario,
+                             descrizione = excluded.descrizione,
+                             unita_misura = excluded.unita_misura
+                         WHERE materiali_base.prezzo_unitario IS NOT excluded.prezzo_unitario
+                            OR materiali_base.descrizione IS NOT excluded.descrizione
+                            OR materiali_base.unita_misura IS NOT excluded.unita_misura"""
+            _execmany(con, sql_ins, rows)
+            con.commit()
+        except Exception:
+            con.rollback()
+            raise
+    _invalidate("categorie", "fornitori", "materiali_base")
 
-            try:
-                _exec(con, """INSERT INTO materiali_base
-                              (categoria_id, fornitore_id, codice_fornitore, descrizione, unita_misura, quantita_default, prezzo_unitario)
-                              VALUES (?,?,?,?,?,?,?)""",
-                      (cat_id, forn_id,
-                       str(r["codice_fornitore"]).strip(),
-                       str(r["descrizione"]).strip(),
-                       um,
-                       _to_float(r.get("quantita_default", 1.0), 1.0),
-                       _to_float(r["prezzo_unitario"], 0.0)))
-                con.commit()
-            except sqlite3.IntegrityError:
-                st.warning(f"Duplicato: {forn} / {r['codice_fornitore']} → saltato.")
-    st.success("Import materiali completato.")
+    return {
+        "inseriti": int((~presente).sum()),
+        "aggiornati": len(modificati),
+        "duplicati": duplicati,
+        "righe_non_valide": righe_non_valide,
+        "um_non_valide": um_non_valide,
+        "categorie_create": nuove_cat,
+        "fornitori_creati": nuovi_forn,
+        "materiali_modificati": modificati,
+        "prezzi_modificati": prezzi_modificati,
+    }
+
+def import_materiali_csv(file, upsert: bool = False) -> Optional[dict]:
+    """Legge CSV/Excel e lancia l'import bulk; ritorna il report (None se il file non è valido)."""
+    try:
+        df = _leggi_tabella(file)
+        rep = import_materiali_bulk(df, upsert=upsert)
+    except ValueError as e:
+        st.error(str(e))
+        return None
+    except ERRORI_INTEGRITA as e:
+        # import_materiali_bulk ha già fatto rollback: nessuna riga del file è stata scritta
+        st.error(f"Import annullato, nessun materiale salvato (vincolo violato: {e}).")
+        return None
+    if rep["prezzi_modificati"]:
+        # un solo ricalcolo impatti per tutto il listino (vedi ui_materiali)
+        st.session_state["last_changed_material_ids"] = list(rep["prezzi_modificati"])
+        st.session_state["last_changed_material_prices"] = dict(rep["prezzi_modificati"])
+    return rep
+
+def mostra_report_import(rep: dict):
+    """Riepilogo import materiali (un messaggio per categoria di esito, non uno per riga)."""
+    st.success(f"Import materiali completato. Inseriti: {rep['inseriti']}, aggiornati: {rep.get('aggiornati', 0)}.")
+    if rep.get("prezzi_modificati"):
+        st.info(f"Prezzi cambiati: {len(rep['prezzi_modificati'])} (storico aggiornato). "
+                "Usa «Ricalcola/mostra impatti» per vedere le voci colpite.")
+    if rep["categorie_create"] or rep["fornitori_creati"]:
+        st.info(f"Create {len(rep['categorie_create'])} categorie e {len(rep['fornitori_creati'])} fornitori nuovi.")
+    if rep["duplicati"]:
+        st.warning(f"Duplicati saltati (fornitore + codice già presenti): {len(rep['duplicati'])}")
+        st.dataframe(pd.DataFrame(rep["duplicati"]), use_container_width=True, hide_index=True, height=200)
+    if rep["righe_non_valide"]:
+        st.warning(f"Righe con campi obbligatori vuoti saltate: {len(rep['righe_non_valide'])} "
+                   f"({', '.join(MATERIALI_CAMPI_OBBLIGATORI)})")
+        st.dataframe(pd.DataFrame(rep["righe_non_valide"]), use_container_width=True, hide_index=True, height=200)
+    if rep["um_non_valide"]:
+        st.warning(f"Righe con UM non valida saltate: {len(rep['um_non_valide'])} (ammesse: {', '.join(UM_CHOICES)})")
+        st.dataframe(pd.DataFrame(rep["um_non_valide"]), use_container_width=True, hide_index=True, height=200)
 
 def import_fornitori_csv(file):
     try:
@@ -1038,45 +2168,122 @@ def import_fornitori_csv(file):
                    str(r.get("email") or ""), str(r.get("telefono") or "")))
             inserted += 1
         con.commit()
+        _invalidate("fornitori")
     st.success(f"Import fornitori completato. Inseriti: {inserted}, saltati: {skipped}.")
 
-def export_excel():  # SOLO Sommario EPU con Nome Capitolo (come richiesto)
+def _sommario_da_totali(tot: pd.DataFrame) -> pd.DataFrame:
+    """Tabella 'Sommario EPU' (colonne UI) a partire dall'output di compute_totali_voci."""
+    return pd.DataFrame({
+        "Capitolo": tot["capitolo_codice"],
+        "CapitoloNome": tot["capitolo_nome"],
+        "Cod. Voce": tot["codice"],
+        "Descrizione": tot["descrizione"],
+        "UM Voce": tot["um_voce"],
+        "Q.tà Voce": tot["q_voce"],
+        "CG %": tot["cg_pct"],
+        "Utile %": tot["utile_pct"],
+        "Materie (€)": tot["costo_materie"].round(2),
+        "Manodopera (€)": tot["costo_manodopera"].round(2),
+        "Spese generali (€)": tot["costi_generali"].round(2),
+        "Utile (€)": tot["utile"].round(2),
+        "Totale (€)": tot["totale"].round(2),
+        "voce_id": tot["voce_id"].astype(int),
+    })
+
+SOMMARIO_COLONNE_EXPORT = {  # colonna UI -> intestazione Excel (None = stessa)
+    "Capitolo": "Codice Capitolo", "CapitoloNome": "Nome Capitolo", "Cod. Voce": None,
+    "Descrizione": "Descrizione Voce", "UM Voce": None, "Q.tà Voce": None, "CG %": None, "Utile %": None,
+    "Materie (€)": None, "Manodopera (€)": None, "Spese generali (€)": None, "Utile (€)": None, "Totale (€)": None,
+}
+
+DETTAGLIO_COLONNE_EXPORT = [
+    "Codice Capitolo", "Cod. Voce", "Descrizione Voce", "Codice fornitore", "Materiale", "Categoria",
+    "Fornitore", "UM", "Quantità", "Prezzo unitario (€)", "Importo (€)", "Manodopera",
+]
+
+def _righe_sommario_export(data=None):
+    """Generatore delle righe del foglio Sommario (dai totali batch, già ordinate); data = listino a quella data."""
+    tot = totali_voci() if data is None else totali_voci_al(data)
+    df = _sommario_da_totali(tot).sort_values(["Capitolo", "Cod. Voce"])
+    df = df[list(SOMMARIO_COLONNE_EXPORT)].astype(object)
+    for row in df.where(df.notna(), None).itertuples(index=False, name=None):
+        yield row
+
+def _righe_dettaglio_export(blocco: int = 5000, data=None):
+    """Generatore delle righe di tutte le distinte, lette a blocchi (fetchmany) dal DB; data = prezzi a quella data."""
+    prezzo, join_al, params = "m.prezzo_unitario", "", ()
+    if data is not None:
+        prezzo = "COALESCE(p.prezzo_vecchio, m.prezzo_unitario)"
+        join_al = f"LEFT JOIN ({_SQL_PREZZI_AL}) p ON p.materiale_id = m.id"
+        params = (istante_listino(data),)
+    with get_con() as con:
+        cur = _exec(con, f"""
+            SELECT cap.codice, v.codice, v.descrizione, m.codice_fornitore, m.descrizione,
+                   c.nome, f.nome, m.unita_misura, r.quantita, {prezzo},
+                   r.quantita * {prezzo},
+                   CASE WHEN IFNULL(m.is_manodopera, 0) = 1 THEN 'sì' ELSE '' END
+            FROM righe_distinta r
+            JOIN voci_analisi v ON v.id = r.voce_analisi_id
+            JOIN capitoli cap ON cap.id = v.capitolo_id
+            JOIN materiali_base m ON m.id = r.materiale_id
+            LEFT JOIN categorie c ON c.id = m.categoria_id
+            LEFT JOIN fornitori f ON f.id = m.fornitore_id
+            {join_al}
+            ORDER BY cap.codice, v.codice, r.id
+        """, params)
+        while True:
+            rows = cur.fetchmany(blocco)
+            if not rows:
+                break
+            yield from rows
+
+def build_sommario_xlsx(righe_sommario, righe_dettaglio=None) -> bytes:
+    """
+    XLSX del Sommario EPU in streaming (openpyxl write_only): le righe arrivano da
+    generatori e vanno dritte nel file, senza DataFrame né DOM del foglio in memoria.
+    righe_dettaglio (opzionale) aggiunge il foglio 'Dettaglio distinte'.
+    """
+    from openpyxl import Workbook
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.styles import Font
+
+    wb = Workbook(write_only=True)
+
+    def _foglio(titolo, intestazioni, righe):
+        ws = wb.create_sheet(titolo)
+        ws.freeze_panes = "A2"
+        hdr = []
+        for h in intestazioni:
+            c = WriteOnlyCell(ws, value=h)
+            c.font = Font(bold=True)
+            hdr.append(c)
+        ws.append(hdr)
+        for row in righe:
+            ws.append(row)
+
+    _foglio("Sommario EPU", [v or k for k, v in SOMMARIO_COLONNE_EXPORT.items()], righe_sommario)
+    if righe_dettaglio is not None:
+        _foglio("Dettaglio distinte", DETTAGLIO_COLONNE_EXPORT, righe_dettaglio)
+    buf = io.BytesIO()
+    wb.save(buf)
+    return buf.getvalue()
+
+def export_excel(dettaglio: bool = False, data_listino=None):  # SOLO Sommario EPU con Nome Capitolo (come richiesto)
     voci = df_voci()
     if voci.empty:
         st.warning("Non ci sono voci da esportare.")
         return None
-
-    buffer = io.BytesIO()
-    with pd.ExcelWriter(buffer, engine="openpyxl") as writer:
-        rows = []
-        for _, r in voci.iterrows():
-            tot = compute_totali_voce(int(r.id))
-            rows.append({
-                "Codice Capitolo": r.capitolo_codice,
-                "Nome Capitolo": r.capitolo_nome,
-                "Cod. Voce": r.codice,
-                "Descrizione Voce": r.descrizione,
-                "UM Voce": r.um_voce,
-                "Q.tà Voce": r.q_voce,
-                "CG %": r.cg_pct,
-                "Utile %": r.utile_pct,
-                "Materie (€)": round(tot["costo_materie"], 2),
-                "Manodopera (€)": round(tot["costo_manodopera"], 2),
-                "Spese generali (€)": round(tot["costi_generali"], 2),
-                "Utile (€)": round(tot["utile"], 2),
-                "Totale (€)": round(tot["totale"], 2),
-            })
-        df_sommario = pd.DataFrame(rows).sort_values(["Codice Capitolo", "Cod. Voce"])
-        df_sommario.to_excel(writer, index=False, sheet_name="Sommario EPU")
-    buffer.seek(0)
-    return buffer
+    data = build_sommario_xlsx(_righe_sommario_export(data_listino),
+                               _righe_dettaglio_export(data=data_listino) if dettaglio else None)
+    return io.BytesIO(data)
 
 # ------------------------------------------------------------------
 # CLIENTI / PREVENTIVI
 # ------------------------------------------------------------------
+@cached_query("clienti")
 def df_clienti():
     with get_con() as con:
-        return pd.read_sql_query("""
+        return _read_sql("""
             SELECT id, nome, piva, indirizzo, cap, citta, provincia, nazione, email, telefono, note
             FROM clienti ORDER BY nome
         """, con)
@@ -1089,14 +2296,14 @@ def add_cliente(**kwargs):
                kwargs.get("cap",""), kwargs.get("citta",""), kwargs.get("provincia",""), kwargs.get("nazione",""),
                kwargs.get("email",""), kwargs.get("telefono",""), kwargs.get("note","")))
         con.commit()
+        _invalidate("clienti")
         st.success("Cliente inserito.")
 
 def create_preventivo(numero: str, data_iso: str, cliente_id: int, note_finali: str, iva_percent: float) -> int:
     with get_con() as con:
-        _exec(con, """INSERT INTO preventivi (numero,data,cliente_id,note_finali,iva_percentuale,imponibile,iva_importo,totale)
+        pid = _insert_id(con, """INSERT INTO preventivi (numero,data,cliente_id,note_finali,iva_percentuale,imponibile,iva_importo,totale)
                       VALUES (?,?,?,?,?,?,?,?)""",
               (numero.strip(), data_iso, int(cliente_id), note_finali, float(iva_percent or 0.0), 0.0, 0.0, 0.0))
-        pid = _exec(con, "SELECT last_insert_rowid()").fetchone()[0]
         con.commit()
         return int(pid)
 
@@ -1109,33 +2316,48 @@ def add_riga_preventivo(pid: int, capitolo_id: int, voce_id: int, descrizione: s
                       VALUES (?,?,?,?,?,?,?,?,?)""",
               (int(pid), int(capitolo_id), int(voce_id), descrizione.strip(), note, um, float(quantita),
                float(prezzo_unitario), prezzo_totale))
+        _exec(con, "UPDATE preventivi SET revisione = revisione + 1 WHERE id=?", (int(pid),))
         con.commit()
 
+_SQL_RIGHE_PREVENTIVO = """
+    SELECT
+        r.id, r.preventivo_id, r.capitolo_id,
+        cap.codice AS capitolo_codice, cap.nome AS capitolo_nome,
+        r.voce_id, v.codice AS voce_codice,
+        r.descrizione,                      -- descrizione SALVATA nella riga (quella "base")
+        v.descrizione_estesa AS voce_descrizione_estesa,  -- <- AGGIUNTO (per la stampa)
+        r.note, r.um, r.quantita, r.prezzo_unitario, r.prezzo_totale
+    FROM preventivo_righe r
+    JOIN capitoli cap ON cap.id = r.capitolo_id
+    JOIN voci_analisi v ON v.id = r.voce_id
+    WHERE r.preventivo_id = ?
+    ORDER BY cap.codice, v.codice, r.id
+"""
+
+_SQL_TESTA_PREVENTIVO = """
+    SELECT p.id, p.numero, p.data, p.cliente_id, p.note_finali, p.iva_percentuale, p.imponibile, p.iva_importo, p.totale,
+           p.revisione, p.totali_revisione,
+           c.nome AS cliente_nome, c.piva, c.indirizzo, c.cap, c.citta, c.provincia, c.nazione, c.email, c.telefono
+    FROM preventivi p
+    JOIN clienti c ON c.id = p.cliente_id
+    WHERE p.id = ?
+"""
+
+def df_preventivo_testa(pid: int) -> pd.DataFrame:
+    with get_con() as con:
+        return _read_sql(_SQL_TESTA_PREVENTIVO, con, params=[int(pid)], nome="preventivo_testa")
+
 def df_preventivo(pid: int):
     with get_con() as con:
-        testa = pd.read_sql_query("""
-            SELECT p.id, p.numero, p.data, p.cliente_id, p.note_finali, p.iva_percentuale, p.imponibile, p.iva_importo, p.totale,
-                   c.nome AS cliente_nome, c.piva, c.indirizzo, c.cap, c.citta, c.provincia, c.nazione, c.email, c.telefono
-            FROM preventivi p
-            JOIN clienti c ON c.id = p.cliente_id
-            WHERE p.id = ?
-        """, con, params=[pid])
-        righe = pd.read_sql_query("""
-            SELECT
-                r.id, r.preventivo_id, r.capitolo_id,
-                cap.codice AS capitolo_codice, cap.nome AS capitolo_nome,
-                r.voce_id, v.codice AS voce_codice,
-                r.descrizione,                      -- descrizione SALVATA nella riga (quella "base")
-                v.descrizione_estesa AS voce_descrizione_estesa,  -- <- AGGIUNTO (per la stampa)
-                r.note, r.um, r.quantita, r.prezzo_unitario, r.prezzo_totale
-            FROM preventivo_righe r
-            JOIN capitoli cap ON cap.id = r.capitolo_id
-            JOIN voci_analisi v ON v.id = r.voce_id
-            WHERE r.preventivo_id = ?
-            ORDER BY cap.codice, v.codice, r.id
-        """, con, params=[pid])
+        testa = _read_sql(_SQL_TESTA_PREVENTIVO, con, params=[pid], nome="preventivo_testa")
+        righe = _read_sql(_SQL_RIGHE_PREVENTIVO, con, params=[pid], nome="preventivo_righe")
         return testa, righe
 
+def righe_preventivo_a_blocchi(pid: int, chunksize: int = 2000):
+    """Righe del preventivo (come df_preventivo) a blocchi di chunksize, per export molto grandi."""
+    with _con_lettura_lunga() as con:
+        yield from _read_sql(_SQL_RIGHE_PREVENTIVO, con, params=[int(pid)], chunksize=chunksize)
+
 def ricalcola_totali_preventivo(pid: int, iva_percent: Optional[float] = None):
     with get_con() as con:
         imp = _exec(con, "SELECT IFNULL(SUM(prezzo_totale),0) FROM preventivo_righe WHERE preventivo_id=?", (pid,)).fetchone()[0]
@@ -1143,30 +2365,75 @@ def ricalcola_totali_preventivo(pid: int, iva_percent: Optional[float] = None):
             iva_percent = _exec(con, "SELECT iva_percentuale FROM preventivi WHERE id=?", (pid,)).fetchone()[0]
         iva_imp = imp * float(iva_percent) / 100.0
         tot = imp + iva_imp
-        _exec(con, "UPDATE preventivi SET imponibile=?, iva_percentuale=?, iva_importo=?, totale=? WHERE id=?",
+        _exec(con, """UPDATE preventivi
+                      SET imponibile=?, iva_percentuale=?, iva_importo=?, totale=?, totali_revisione=revisione
+                      WHERE id=?""",
               (imp, float(iva_percent), iva_imp, tot, pid))
         con.commit()
 
-def export_preventivo_excel(pid: int):
-    testa, righe = df_preventivo(pid)
-    if testa.empty:
-        return None
+def aggiorna_totali_preventivo(pid: int) -> bool:
+    """Ricalcola i totali salvati solo se righe/IVA sono cambiate dall'ultimo calcolo."""
+    with get_con() as con:
+        row = _exec(con, "SELECT revisione, totali_revisione FROM preventivi WHERE id=?", (int(pid),)).fetchone()
+    if not row or row[0] == row[1]:
+        return False
+    ricalcola_totali_preventivo(int(pid))
+    return True
+
+def set_iva_preventivo(pid: int, iva_percent: float) -> bool:
+    """Cambia l'IVA del preventivo (nuova revisione + totali); nulla se è già quella."""
+    with get_con() as con:
+        cur = _exec(con, """UPDATE preventivi SET iva_percentuale=?, revisione = revisione + 1
+                            WHERE id=? AND iva_percentuale IS NOT ?""",
+                    (float(iva_percent), int(pid), float(iva_percent)))
+        changed = cur.rowcount > 0
+        con.commit()
+    if changed:
+        ricalcola_totali_preventivo(int(pid))
+    return changed
+
+def totali_documento(testa: pd.DataFrame, righe: pd.DataFrame) -> tuple:
+    """
+    (imponibile, iva %, iva €, totale) per la UI, senza scritture: valori salvati se
+    aggiornati, altrimenti calcolati al volo dalle righe (preventivi con totali vecchi).
+    """
+    iva_p = float(testa["iva_percentuale"].iloc[0] or 0.0)
+    if int(testa["revisione"].iloc[0]) == int(testa["totali_revisione"].iloc[0]):
+        return (float(testa["imponibile"].iloc[0]), iva_p,
+                float(testa["iva_importo"].iloc[0]), float(testa["totale"].iloc[0]))
+    imp = float(righe["prezzo_totale"].sum()) if not righe.empty else 0.0
+    iva_imp = imp * iva_p / 100.0
+    return imp, iva_p, iva_imp, imp + iva_imp
+
+def totali_per_capitolo(righe: pd.DataFrame, colonna: str = "Totale capitolo (€)") -> pd.DataFrame:
+    """Subtotali per capitolo (stesso raggruppamento in UI, Excel, Word e PDF)."""
+    if righe is None or righe.empty:
+        return pd.DataFrame(columns=["capitolo_codice", "capitolo_nome", colonna])
+    return (righe.groupby(["capitolo_codice", "capitolo_nome"])["prezzo_totale"]
+            .sum().reset_index().rename(columns={"prezzo_totale": colonna}))
+
+def build_preventivo_xlsx(testa: pd.DataFrame, righe: pd.DataFrame, progress=None) -> bytes:
+    """XLSX del preventivo dai dati già letti (nessuna chiamata st: usabile nei job in background)."""
+    imp, iva_p, iva_imp, tot = totali_documento(testa, righe)
     buffer = io.BytesIO()
     with pd.ExcelWriter(buffer, engine="openpyxl") as w:
-        testa.to_excel(w, index=False, sheet_name="Testata")
+        testa.drop(columns=["revisione", "totali_revisione"], errors="ignore").to_excel(w, index=False, sheet_name="Testata")
         righe.to_excel(w, index=False, sheet_name="Righe")
-        if not righe.empty:
-            bycap = (righe.groupby(["capitolo_codice","capitolo_nome"])["prezzo_totale"]
-                     .sum().reset_index().rename(columns={"prezzo_totale":"Totale capitolo (€)"}))
-        else:
-            bycap = pd.DataFrame(columns=["capitolo_codice","capitolo_nome","Totale capitolo (€)"])
-        bycap.to_excel(w, index=False, sheet_name="Totali capitoli")
-        riepilogo = testa[["numero","data","cliente_nome","imponibile","iva_percentuale","iva_importo","totale"]].copy()
-        riepilogo = riepilogo.rename(columns={"numero":"Numero","data":"Data","cliente_nome":"Cliente",
-                                              "imponibile":"Imponibile (€)","iva_percentuale":"IVA %","iva_importo":"IVA (€)","totale":"Totale (€)"})
+        if progress:
+            progress(0.7)
+        totali_per_capitolo(righe).to_excel(w, index=False, sheet_name="Totali capitoli")
+        riepilogo = pd.DataFrame([{
+            "Numero": testa["numero"].iloc[0], "Data": testa["data"].iloc[0], "Cliente": testa["cliente_nome"].iloc[0],
+            "Imponibile (€)": imp, "IVA %": iva_p, "IVA (€)": iva_imp, "Totale (€)": tot,
+        }])
         riepilogo.to_excel(w, index=False, sheet_name="Riepilogo")
-    buffer.seek(0)
-    return buffer
+    return buffer.getvalue()
+
+def export_preventivo_excel(pid: int):
+    testa, righe = df_preventivo(pid)
+    if testa.empty:
+        return None
+    return io.BytesIO(build_preventivo_xlsx(testa, righe))
 
 def df_preventivi_archivio(numero_like: str = "", data_like: str = "", cliente_id: Optional[int] = None):
     with get_con() as con:
@@ -1186,7 +2453,7 @@ def df_preventivi_archivio(numero_like: str = "", data_like: str = "", cliente_i
         if cliente_id:
             q += " AND p.cliente_id = ?"; params.append(int(cliente_id))
         q += " ORDER BY p.data DESC, p.numero DESC"
-        return pd.read_sql_query(q, con, params=params)
+        return _read_sql(q, con, params=params)
 def delete_preventivo(pid: int):
     """Elimina il preventivo e tutte le sue righe collegate."""
     with get_con() as con:
@@ -1198,6 +2465,7 @@ def delete_preventivo(pid: int):
 
         # Prima righe, poi testata (non usiamo ON DELETE CASCADE)
         _exec(con, "DELETE FROM preventivo_righe WHERE preventivo_id=?", (int(pid),))
+        _exec(con, "DELETE FROM export_jobs WHERE preventivo_id=?", (int(pid),))
         _exec(con, "DELETE FROM preventivi WHERE id=?", (int(pid),))
         con.commit()
 
@@ -1207,20 +2475,46 @@ def delete_preventivo(pid: int):
     st.success(f"Preventivo {numero} (ID {pid}) eliminato.")
 
 
-def export_preventivo_docx(pid: int):
-    # Import sicuro: se manca python-docx, non bloccare l’app
-    try:
-        from docx import Document
-        from docx.shared import Pt, Cm
-    except ModuleNotFoundError:
-        st.warning("Export DOCX non disponibile: installa il pacchetto 'python-docx' (requirements.txt).")
-        return None
+_XML_NON_VALIDI = re.compile("[\x00-\x08\x0b\x0c\x0d\x0e-\x1f]")
 
-    # Recupera testata e righe del preventivo
-    testa, righe = df_preventivo(pid)
-    if testa is None or testa.empty:
-        st.warning("Preventivo non trovato o senza testata.")
-        return None
+def _w_cella(testo: str, larghezza: str) -> str:
+    """XML di una cella w:tc con un paragrafo (\n -> w:br, \t -> w:tab come cell.text di python-docx)."""
+    from xml.sax.saxutils import escape
+    t = escape(_XML_NON_VALIDI.sub("", testo.replace("\r\n", "\n")))
+    t = (t.replace("\t", '</w:t><w:tab/><w:t xml:space="preserve">')
+          .replace("\n", '</w:t><w:br/><w:t xml:space="preserve">'))
+    return (f'<w:tc><w:tcPr><w:tcW w:w="{larghezza}" w:type="dxa"/></w:tcPr>'
+            f'<w:p><w:r><w:t xml:space="preserve">{t}</w:t></w:r></w:p></w:tc>')
+
+def _accoda_righe_tabella_docx(table, righe_testo, n: int, progress=None, blocco: int = 1000):
+    """
+    Accoda a una tabella python-docx le righe (tuple di stringhe, una per colonna)
+    generando il XML w:tr a blocchi e inserendolo nel corpo con un solo parse per
+    blocco: evita add_row()/.cells/.text per cella, che su migliaia di righe
+    costano secondi. Larghezze colonne prese dalla riga di intestazione.
+    """
+    from docx.oxml import parse_xml
+    from docx.oxml.ns import nsdecls
+
+    tbl = table._tbl
+    larghezze = [(tc.xpath("./w:tcPr/w:tcW/@w:w") or ["0"])[0] for tc in tbl.tr_lst[0].tc_lst]
+    buf, fatte = [], 0
+    for valori in righe_testo:
+        buf.append("<w:tr>" + "".join(_w_cella(v, w) for v, w in zip(valori, larghezze)) + "</w:tr>")
+        if len(buf) >= blocco:
+            tbl.extend(list(parse_xml(f'<w:tbl {nsdecls("w")}>{"".join(buf)}</w:tbl>')))
+            fatte += len(buf)
+            buf = []
+            if progress:
+                progress(fatte / n)
+    if buf:
+        tbl.extend(list(parse_xml(f'<w:tbl {nsdecls("w")}>{"".join(buf)}</w:tbl>')))
+    if progress:
+        progress(1.0)
+
+def build_preventivo_docx(testa: pd.DataFrame, righe: pd.DataFrame, progress=None) -> bytes:
+    """DOCX del preventivo dai dati già letti (nessuna chiamata st: usabile nei job in background)."""
+    from docx import Document
 
     # helper per leggere valori in modo sicuro
     def _val(df, col, default=""):
@@ -1261,22 +2555,27 @@ def export_preventivo_docx(pid: int):
     hdr[6].text = "Totale (€)"
 
     if righe is not None and not righe.empty:
-        for _, r in righe.iterrows():
-            row = table.add_row().cells
-            row[0].text = f"{r.get('capitolo_codice','')} {r.get('capitolo_nome','')}"
-            row[1].text = str(r.get("voce_codice","")) 
-            
-            # Descrizione base + descrizione estesa
-            desc_base = str(r.get("descrizione", "") or "")
-            desc_ext  = str(r.get("voce_descrizione_estesa", "") or "")
-            descr_full = desc_base + (" – " + desc_ext if desc_ext.strip() else "")
-            row[2].text = descr_full
-            row[3].text = str(r.get("um",""))
-            row[4].text = f"{float(r.get('quantita',0.0)):.2f}"
-            row[5].text = f"{float(r.get('prezzo_unitario',0.0)):.2f}"
-            row[6].text = f"{float(r.get('prezzo_totale',0.0)):.2f}"
-
-            note_val = r.get("note", "")
+        # colonne già formattate (vettoriale), poi XML delle righe in blocco
+        def _txt(col):
+            return righe[col].fillna("").astype(str) if col in righe.columns else pd.Series("", index=righe.index)
+
+        # Descrizione base + descrizione estesa
+        desc_ext = _txt("voce_descrizione_estesa")
+        descr_full = _txt("descrizione") + (" – " + desc_ext).where(desc_ext.str.strip() != "", "")
+        celle = [
+            _txt("capitolo_codice") + " " + _txt("capitolo_nome"),
+            _txt("voce_codice"),
+            descr_full,
+            _txt("um"),
+            righe["quantita"].astype(float).map("{:.2f}".format),
+            righe["prezzo_unitario"].astype(float).map("{:.2f}".format),
+            righe["prezzo_totale"].astype(float).map("{:.2f}".format),
+        ]
+        _accoda_righe_tabella_docx(table, zip(*celle), len(righe),
+                                   progress=(lambda f: progress(0.9 * f)) if progress else None)
+
+        # note delle righe: paragrafi dopo la tabella, nell'ordine delle righe
+        for note_val in righe["note"]:
             if pd.notna(note_val) and str(note_val).strip():
                 d.add_paragraph(f"Note: {note_val}")
     else:
@@ -1286,10 +2585,7 @@ def export_preventivo_docx(pid: int):
 
     # Totali per capitolo
     if righe is not None and not righe.empty:
-        bycap = (
-            righe.groupby(["capitolo_codice","capitolo_nome"])["prezzo_totale"]
-            .sum().reset_index().rename(columns={"prezzo_totale":"Totale capitolo (€)"})
-        )
+        bycap = totali_per_capitolo(righe)
         d.add_paragraph("Totali per capitolo:")
         for _, rr in bycap.iterrows():
             d.add_paragraph(f"- {rr['capitolo_codice']} {rr['capitolo_nome']}: € {float(rr['Totale capitolo (€)']):.2f}")
@@ -1297,10 +2593,7 @@ def export_preventivo_docx(pid: int):
     d.add_paragraph("")
 
     # Riepilogo documento
-    imp   = float(_val(testa, "imponibile", 0.0) or 0.0)
-    iva_p = float(_val(testa, "iva_percentuale", 22.0) or 0.0)
-    iva_imp = float(_val(testa, "iva_importo", 0.0) or 0.0)
-    tot   = float(_val(testa, "totale", 0.0) or 0.0)
+    imp, iva_p, iva_imp, tot = totali_documento(testa, righe)
 
     d.add_paragraph(f"Imponibile: € {imp:.2f}")
     d.add_paragraph(f"IVA {iva_p:.0f}%: € {iva_imp:.2f}")
@@ -1313,8 +2606,353 @@ def export_preventivo_docx(pid: int):
 
     buf = io.BytesIO()
     d.save(buf)
-    buf.seek(0)
-    return buf
+    return buf.getvalue()
+
+def export_preventivo_docx(pid: int):
+    # Import sicuro: se manca python-docx, non bloccare l’app
+    try:
+        import docx  # noqa: F401
+    except ModuleNotFoundError:
+        st.warning("Export DOCX non disponibile: installa il pacchetto 'python-docx' (requirements.txt).")
+        return None
+
+    # Recupera testata e righe del preventivo
+    testa, righe = df_preventivo(pid)
+    if testa is None or testa.empty:
+        st.warning("Preventivo non trovato o senza testata.")
+        return None
+    return io.BytesIO(build_preventivo_docx(testa, righe))
+
+PDF_RIGHE_PER_TABELLA = 500  # righe per LongTable (e per blocco letto dal DB nei job)
+
+def build_preventivo_pdf(testa: pd.DataFrame, righe, progress=None, n_righe: Optional[int] = None) -> bytes:
+    """
+    PDF del preventivo (reportlab/platypus, nessuna chiamata st).
+    righe: DataFrame oppure iterabile di DataFrame a blocchi (righe_preventivo_a_blocchi).
+    Ogni blocco diventa una LongTable a sé (intestazione ripetuta a ogni pagina):
+    lo split di una tabella unica da migliaia di righe costa molto di più.
+    n_righe serve solo per l'avanzamento quando righe è un iterabile.
+    """
+    from xml.sax.saxutils import escape
+    from reportlab.lib import colors
+    from reportlab.lib.pagesizes import A4
+    from reportlab.lib.styles import getSampleStyleSheet
+    from reportlab.lib.units import cm
+    from reportlab.lib.utils import simpleSplit
+    from reportlab.platypus import LongTable, Paragraph, SimpleDocTemplate, Spacer, TableStyle
+
+    if isinstance(righe, pd.DataFrame):
+        df, n_righe = righe, len(righe)
+        righe = (df.iloc[i:i + PDF_RIGHE_PER_TABELLA] for i in range(0, n_righe, PDF_RIGHE_PER_TABELLA))
+
+    def _val(col, default=""):
+        v = testa[col].iloc[0] if col in testa.columns else None
+        return escape(str(v)) if (v is not None and pd.notna(v) and str(v).strip()) else default
+
+    stili = getSampleStyleSheet()
+    normale, piccolo = stili["Normal"], stili["Normal"].clone("piccolo", fontSize=8, leading=10)
+    story = [
+        Paragraph(f"Preventivo {_val('numero', '-')} del {_val('data', '-')}", stili["Heading1"]),
+        Paragraph(f"Cliente: {_val('cliente_nome', '-')}", normale),
+        Paragraph(f"P.IVA/CF: {_val('piva', '-')}", normale),
+        Paragraph(f"Indirizzo: {_val('indirizzo', '-')}", normale),
+        Paragraph(f"Città: {_val('cap')} {_val('citta')} ({_val('provincia')})", normale),
+        Paragraph(f"Nazione: {_val('nazione', '-')}", normale),
+        Paragraph(f"Email: {_val('email', '-')}  Tel: {_val('telefono', '-')}", normale),
+        Spacer(1, 0.5 * cm),
+    ]
+
+    intestazione = ["Capitolo", "Voce", "Descrizione", "UM", "Q.tà", "Prezzo U (€)", "Totale (€)"]
+    larghezze = [2.6 * cm, 2.0 * cm, 6.2 * cm, 1.1 * cm, 1.5 * cm, 2.2 * cm, 2.4 * cm]
+    stile_tabella = TableStyle([
+        ("FONTSIZE", (0, 0), (-1, -1), 8),
+        ("LEADING", (0, 0), (-1, -1), 10),
+        ("BACKGROUND", (0, 0), (-1, 0), colors.lightgrey),
+        ("FONTNAME", (0, 0), (-1, 0), "Helvetica-Bold"),
+        ("VALIGN", (0, 0), (-1, -1), "TOP"),
+        ("ALIGN", (4, 0), (-1, -1), "RIGHT"),
+        ("LINEBELOW", (0, 0), (-1, -1), 0.25, colors.grey),
+    ])
+    # celle a capo con simpleSplit (testo semplice su più righe): un Paragraph per cella
+    # costa ~10x in layout; le etichette capitolo si ripetono -> memorizzate
+    def _a_capo(testo: str, larghezza: float) -> str:
+        return "\n".join(simpleSplit(testo, "Helvetica", 8, larghezza - 6))
+
+    etichette_cap: Dict[tuple, str] = {}
+    parziali, note, fatte = [], [], 0
+    for blocco in righe:
+        if blocco.empty:
+            continue
+        dati = [intestazione]
+        for r in blocco.itertuples(index=False):
+            desc = str(r.descrizione or "")
+            ext = str(r.voce_descrizione_estesa or "") if pd.notna(r.voce_descrizione_estesa) else ""
+            if ext.strip():
+                desc += " – " + ext
+            k_cap = (r.capitolo_codice, r.capitolo_nome)
+            if k_cap not in etichette_cap:
+                etichette_cap[k_cap] = _a_capo(f"{r.capitolo_codice} {r.capitolo_nome}", larghezze[0])
+            dati.append([
+                etichette_cap[k_cap],
+                str(r.voce_codice),
+                _a_capo(desc, larghezze[2]),
+                str(r.um),
+                f"{float(r.quantita):.2f}",
+                f"{float(r.prezzo_unitario):.2f}",
+                f"{float(r.prezzo_totale):.2f}",
+            ])
+            if pd.notna(r.note) and str(r.note).strip():
+                note.append(f"{r.voce_codice}: {r.note}")
+        story.append(LongTable(dati, colWidths=larghezze, repeatRows=1, style=stile_tabella))
+        parziali.append(totali_per_capitolo(blocco, "prezzo_totale"))
+        fatte += len(blocco)
+        if progress and n_righe:
+            progress(0.8 * fatte / n_righe)
+
+    if not fatte:
+        story.append(Paragraph("Nessuna riga nel preventivo.", normale))
+    for nota in note:
+        story.append(Paragraph(escape(f"Note {nota}"), piccolo))
+    story.append(Spacer(1, 0.5 * cm))
+
+    # Totali per capitolo: stesso raggruppamento degli altri export, sommando i parziali dei blocchi
+    if parziali:
+        bycap = totali_per_capitolo(pd.concat(parziali, ignore_index=True))
+        story.append(Paragraph("Totali per capitolo:", normale))
+        for rr in bycap.itertuples(index=False):
+            story.append(Paragraph(escape(f"- {rr[0]} {rr[1]}: € {float(rr[2]):.2f}"), normale))
+        story.append(Spacer(1, 0.5 * cm))
+
+    # Riepilogo documento (totali salvati se aggiornati, altrimenti dai subtotali letti)
+    if int(testa["revisione"].iloc[0]) == int(testa["totali_revisione"].iloc[0]) or not parziali:
+        imp, iva_p, iva_imp, tot = totali_documento(testa, pd.DataFrame(columns=["prezzo_totale"]))
+    else:
+        iva_p = float(testa["iva_percentuale"].iloc[0] or 0.0)
+        imp = float(bycap["Totale capitolo (€)"].sum())
+        iva_imp = imp * iva_p / 100.0
+        tot = imp + iva_imp
+    story += [
+        Paragraph(f"Imponibile: € {imp:.2f}", normale),
+        Paragraph(f"IVA {iva_p:.0f}%: € {iva_imp:.2f}", normale),
+        Paragraph(f"<b>Totale documento: € {tot:.2f}</b>", normale),
+    ]
+    note_finali = _val("note_finali")
+    if note_finali:
+        story += [Spacer(1, 0.5 * cm), Paragraph(f"Note finali: {note_finali}", normale)]
+
+    def _numero_pagina(canvas, doc):
+        canvas.setFont("Helvetica", 8)
+        canvas.drawRightString(A4[0] - 1.5 * cm, 1 * cm, f"Pagina {doc.page}")
+
+    buf = io.BytesIO()
+    doc = SimpleDocTemplate(buf, pagesize=A4, leftMargin=1.5 * cm, rightMargin=1.5 * cm,
+                            topMargin=1.5 * cm, bottomMargin=1.5 * cm,
+                            title=f"Preventivo {testa['numero'].iloc[0]}")
+    doc.build(story, onFirstPage=_numero_pagina, onLaterPages=_numero_pagina)
+    if progress:
+        progress(1.0)
+    return buf.getvalue()
+
+def export_preventivo_pdf(pid: int):
+    # Import sicuro: se manca reportlab, non bloccare l’app
+    try:
+        import reportlab  # noqa: F401
+    except ModuleNotFoundError:
+        st.warning("Export PDF non disponibile: installa il pacchetto 'reportlab' (requirements.txt).")
+        return None
+
+    # testata subito, righe a blocchi dal DB: mai tutto il preventivo in un DataFrame
+    testa = df_preventivo_testa(int(pid))
+    if testa.empty:
+        st.warning("Preventivo non trovato o senza testata.")
+        return None
+    return io.BytesIO(build_preventivo_pdf(testa, righe_preventivo_a_blocchi(int(pid), PDF_RIGHE_PER_TABELLA)))
+
+# ------------------------------------------------------------------
+# Cache file esportati: i documenti si generano solo su richiesta e si
+# riservono finché i dati da cui derivano non cambiano (chiave = revisione
+# del preventivo / generazioni delle tabelle del listino).
+# ------------------------------------------------------------------
+MIME_XLSX = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+MIME_DOCX = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+MIME_PDF = "application/pdf"
+
+# tabelle lette dal Sommario EPU (voci_totali segue queste via trigger)
+TABELLE_LISTINO = ("materiali_base", "categorie", "fornitori", "capitoli", "voci_analisi", "righe_distinta")
+
+@st.cache_resource(show_spinner=False)
+def _export_cache(db_path: str) -> _QueryCache:
+    return _QueryCache(maxsize=16)  # pochi file, anche grossi
+
+def chiave_export_preventivo(testa: pd.DataFrame) -> tuple:
+    """Revisione righe/IVA + revisione totali + anagrafiche mostrate nel documento."""
+    qc = _query_cache(DB_PATH)
+    return (int(testa["id"].iloc[0]), int(testa["revisione"].iloc[0]), int(testa["totali_revisione"].iloc[0]),
+            qc.generation(("clienti", "capitoli", "voci_analisi")))
+
+def chiave_export_sommario() -> tuple:
+    return _query_cache(DB_PATH).generation(TABELLE_LISTINO)
+
+def download_export(container, label: str, nome: str, chiave: tuple, build, file_name: str, mime: str, key: str):
+    """
+    Pulsante 'Genera' finché il file non è in cache; poi download_button con i byte
+    in cache (stessa chiave = nessuna rigenerazione, anche da altre sessioni).
+    """
+    ec = _export_cache(DB_PATH)
+    full_key = (nome,) + tuple(chiave)
+    hit, data = ec.get(nome, full_key)
+    if not hit:
+        if not container.button(f"⚙️ Genera {label}", key=f"gen_{key}"):
+            return
+        with st.spinner(f"Generazione {label}..."):
+            buf = build()
+        data = buf.getvalue() if buf else None
+        if data is None:
+            return  # niente da esportare: non memorizzare, il messaggio l'ha già dato build()
+        ec.put(full_key, data)
+    container.download_button(f"⬇️ {label}", data=data, file_name=file_name, mime=mime, key=f"dl_{key}")
+
+# ------------------------------------------------------------------
+# Export in background: job in tabella export_jobs (stato, avanzamento, file),
+# eseguiti da un pool di thread di processo. Lo script Streamlit non aspetta:
+# la UI interroga la tabella (fragment con run_every) finché i job sono attivi.
+# NB: thread e non processi: App.py gira come __main__ di Streamlit e le sue
+# funzioni non sono importabili da un worker di ProcessPoolExecutor. Limite: i
+# builder DOCX/PDF/XLSX sono Python puro e tengono il GIL, quindi più export
+# insieme NON usano più core (in parallelo solo le letture dal DB): i job tolgono
+# il lavoro allo script Streamlit, ma in totale durano quanto eseguiti in fila.
+# ------------------------------------------------------------------
+# job contemporanei (pochi: oltre il primo si sovrappone solo l'I/O)
+EXPORT_WORKERS = int(st.secrets.get("EXPORT_WORKERS", min(4, os.cpu_count() or 1)))
+# pulizia all'avvio: job attivi più vecchi di così = processo morto; finiti più vecchi = eliminati
+EXPORT_JOB_TIMEOUT_S = float(st.secrets.get("EXPORT_JOB_TIMEOUT_S", 3600.0))
+EXPORT_JOB_TTL_S = float(st.secrets.get("EXPORT_JOB_TTL_S", 86400.0))
+
+# formato -> etichetta UI, estensione, mime, builder(testa, righe, progress) -> bytes;
+# a_blocchi: il builder accetta le righe a blocchi (+ n_righe) lette dal job stesso
+FORMATI_EXPORT = {
+    "xlsx": {"label": "Excel", "ext": "xlsx", "mime": MIME_XLSX, "build": build_preventivo_xlsx},
+    "docx": {"label": "Word (DOCX)", "ext": "docx", "mime": MIME_DOCX, "build": build_preventivo_docx},
+    "pdf": {"label": "PDF", "ext": "pdf", "mime": MIME_PDF, "build": build_preventivo_pdf, "a_blocchi": True},
+}
+
+JOB_ATTIVI = ("in_coda", "in_corso")
+
+@st.cache_resource(show_spinner=False)
+def _processo_export() -> str:
+    """
+    Processo server proprietario dei job: le chiavi contengono generazioni di cache locali
+    al processo, quindi un job si riusa/mostra solo nel processo che l'ha creato.
+    """
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+def _utc_fa(secondi: float) -> str:
+    """Istante UTC di `secondi` fa nel formato di datetime('now') (created_at/finished_at)."""
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(time.time() - secondi))
+
+@st.cache_resource(show_spinner=False)
+def _export_executor(db_path: str):
+    from concurrent.futures import ThreadPoolExecutor
+    # i job degli altri processi (repliche sullo stesso DB, riavvii precedenti) non si
+    # toccano finché sono recenti: attivi da troppo -> il loro processo è morto; finiti da
+    # più del TTL -> via i file
+    with get_con() as con:
+        _exec(con, """UPDATE export_jobs SET stato='errore', errore='Interrotto (processo terminato)',
+                                             finished_at=datetime('now')
+                      WHERE stato IN ('in_coda','in_corso') AND created_at < ?""", (_utc_fa(EXPORT_JOB_TIMEOUT_S),))
+        _exec(con, """DELETE FROM export_jobs
+                      WHERE stato NOT IN ('in_coda','in_corso') AND IFNULL(finished_at, created_at) < ?""",
+              (_utc_fa(EXPORT_JOB_TTL_S),))
+        con.commit()
+    return ThreadPoolExecutor(max_workers=EXPORT_WORKERS, thread_name_prefix="export")
+
+def _esegui_export_job(job_id: int, formato: str, testa: pd.DataFrame, righe: Optional[pd.DataFrame]):
+    """
+    Corpo del job (thread del pool): genera il file e salva esito e avanzamento su export_jobs.
+    righe None (formati a_blocchi): righe lette qui dal DB a blocchi, mai tutte in memoria.
+    """
+    ultimo = [0.0]
+
+    def progress(frac: float):
+        if frac - ultimo[0] >= 0.05:  # niente commit a ogni riga
+            ultimo[0] = frac
+            with get_con() as con:
+                _exec(con, "UPDATE export_jobs SET progresso=? WHERE id=?", (float(frac), job_id))
+                con.commit()
+
+    with get_con() as con:
+        _exec(con, "UPDATE export_jobs SET stato='in_corso' WHERE id=?", (job_id,))
+        con.commit()
+    try:
+        build = FORMATI_EXPORT[formato]["build"]
+        if righe is None:
+            pid = int(testa["id"].iloc[0])
+            with get_con() as con:
+                n = _exec(con, "SELECT COUNT(*) FROM preventivo_righe WHERE preventivo_id=?", (pid,)).fetchone()[0]
+            data = build(testa, righe_preventivo_a_blocchi(pid, PDF_RIGHE_PER_TABELLA), progress, n_righe=int(n))
+        else:
+            data = build(testa, righe, progress)
+    except Exception as e:
+        with get_con() as con:
+            _exec(con, """UPDATE export_jobs SET stato='errore', errore=?, finished_at=datetime('now')
+                          WHERE id=?""", (f"{type(e).__name__}: {e}", job_id))
+            con.commit()
+        return
+    with get_con() as con:
+        _exec(con, """UPDATE export_jobs SET stato='completato', progresso=1.0, risultato=?, finished_at=datetime('now')
+                      WHERE id=?""", (data, job_id))
+        # i file di revisioni precedenti (di questo processo) non servono più
+        _exec(con, """DELETE FROM export_jobs
+                      WHERE preventivo_id=(SELECT preventivo_id FROM export_jobs WHERE id=?)
+                        AND formato=? AND id<>? AND processo=? AND stato NOT IN ('in_coda','in_corso')""",
+              (job_id, formato, job_id, _processo_export()))
+        con.commit()
+
+def avvia_export_job(pid: int, formato: str) -> Optional[int]:
+    """
+    Accoda l'export del preventivo e ritorna l'id del job. Se esiste già un job attivo o
+    completato per la stessa revisione dei dati, ritorna quello (niente rigenerazione).
+    """
+    # istantanea dei dati, tranne le righe dei formati a_blocchi (le legge il job): se il
+    # preventivo cambia prima, la chiave del job è già superata e il file non si mostra
+    if FORMATI_EXPORT[formato].get("a_blocchi"):
+        testa, righe = df_preventivo_testa(int(pid)), None
+    else:
+        testa, righe = df_preventivo(int(pid))
+    if testa.empty:
+        return None
+    chiave = repr(chiave_export_preventivo(testa))
+    executor = _export_executor(DB_PATH)
+    with get_con() as con:
+        r = _exec(con, """SELECT id FROM export_jobs
+                          WHERE preventivo_id=? AND formato=? AND chiave=? AND processo=? AND stato<>'errore'
+                          ORDER BY id DESC LIMIT 1""", (int(pid), formato, chiave, _processo_export())).fetchone()
+        if r:
+            return int(r[0])
+        file_name = f"Preventivo_{testa['numero'].iloc[0]}.{FORMATI_EXPORT[formato]['ext']}"
+        job_id = _insert_id(con, """INSERT INTO export_jobs (preventivo_id, formato, chiave, file_name, processo)
+                                    VALUES (?,?,?,?,?)""",
+                            (int(pid), formato, chiave, file_name, _processo_export()))
+        con.commit()
+    executor.submit(_esegui_export_job, job_id, formato, testa, righe)
+    return job_id
+
+def export_jobs_preventivo(pid: int) -> pd.DataFrame:
+    """Ultimo job per formato del preventivo creato da questo processo (senza il file)."""
+    _export_executor(DB_PATH)  # al primo uso nel processo ripulisce i job scaduti
+    with get_con() as con:
+        return _read_sql("""
+            SELECT id, formato, chiave, stato, progresso, file_name, errore, created_at, finished_at,
+                   LENGTH(risultato) AS dimensione
+            FROM export_jobs
+            WHERE id IN (SELECT MAX(id) FROM export_jobs WHERE preventivo_id=? AND processo=? GROUP BY formato)
+            ORDER BY formato
+        """, con, params=(int(pid), _processo_export()))
+
+def risultato_export_job(job_id: int) -> Optional[bytes]:
+    with get_con() as con:
+        r = _exec(con, "SELECT risultato FROM export_jobs WHERE id=? AND stato='completato'", (int(job_id),)).fetchone()
+    return bytes(r[0]) if r and r[0] is not None else None
 
 # ------------------------------------------------------------------
 # UI – Fornitori
@@ -1340,8 +2978,9 @@ def ui_fornitori():
             import_fornitori_csv(up); st.rerun()
 
     if not df.empty:
-        fid = st.selectbox("Elimina fornitore", options=[None]+df["id"].tolist(),
-                           format_func=lambda x: "—" if x is None else df[df["id"]==x]["nome"].iloc[0])
+        forn_map = etichette_fornitori()
+        fid = st.selectbox("Elimina fornitore", options=[None]+list(forn_map),
+                           format_func=lambda x: "—" if x is None else forn_map[x])
         if fid and st.button("Elimina fornitore"):
             delete_fornitore(int(fid)); st.rerun()
 
@@ -1352,6 +2991,7 @@ def ui_materiali():
     st.subheader("Archivio prezzi base (Materiali)")
 
     cat_df = df_categorie(); forn_df = df_fornitori()
+    cat_map = etichette_categorie(); forn_map = etichette_fornitori()
     if cat_df.empty or forn_df.empty:
         st.info("Servono almeno 1 Categoria e 1 Fornitore.")
         return
@@ -1363,14 +3003,14 @@ def ui_materiali():
         c1, c2, c3, c4 = st.columns([1.2, 1.2, 1.2, 1.6])
         categoria_id = c1.selectbox(
             "Categoria",
-            options=cat_df["id"],
-            format_func=lambda i: cat_df[cat_df["id"] == i]["nome"].iloc[0],
+            options=list(cat_map),
+            format_func=lambda i: cat_map[i],
             key="mat_cat"
         )
         fornitore_id = c2.selectbox(
             "Fornitore",
-            options=forn_df["id"],
-            format_func=lambda i: forn_df[forn_df["id"] == i]["nome"].iloc[0],
+            options=list(forn_map),
+            format_func=lambda i: forn_map[i],
             key="mat_forn"
         )
         codice_fornitore = c3.text_input("Codice fornitore *", key="mat_cod")
@@ -1394,32 +3034,41 @@ def ui_materiali():
     # ---------------------------
     # Tabella + filtri stile Excel
     # ---------------------------
-    df_all = df_materiali()
-    if df_all is None or df_all.empty:
+    n_archivio = conta_materiali()
+    if n_archivio == 0:
         st.info("Nessun materiale in archivio.")
         return
 
-    # Filtri per colonna (in testa)
+    # Filtri per colonna (in testa) -> WHERE in SQL; al browser va solo la pagina corrente
     fc1, fc2, fc3, fc4 = st.columns([1, 1, 1, 2])
     f_categoria = fc1.text_input("Filtro Categoria", key="flt_mat_categoria")
     f_fornitore = fc2.text_input("Filtro Fornitore", key="flt_mat_fornitore")
     f_codforn   = fc3.text_input("Filtro Cod. Fornitore", key="flt_mat_codforn")
     f_descr     = fc4.text_input("Filtro Descrizione", key="flt_mat_descr")
-
-    dfv = df_all.copy()
-    mask = (
-        like_mask(dfv["categoria"], f_categoria)
-        & like_mask(dfv["fornitore"], f_fornitore)
-        & like_mask(dfv["codice_fornitore"], f_codforn)
-        & like_mask(dfv["descrizione"], f_descr)
-    )
-    dfv = dfv[mask]
-
-    st.caption(f"{len(dfv)} materiali (totale archivio: {len(df_all)})")
+    f_testo     = st.text_input("Cerca per parole (inizio parola, in tutti i campi)", key="flt_mat_testo")
+
+    filtri = (("categoria", f_categoria), ("fornitore", f_fornitore),
+              ("codice_fornitore", f_codforn), ("descrizione", f_descr))
+    n_filtrati = conta_materiali(filtri, f_testo)
+
+    pc1, pc2, pc3 = st.columns([1, 1, 3])
+    per_pagina = pc1.selectbox("Righe per pagina", [50, 100, 250, 500], index=1, key="mat_per_pagina")
+    n_pagine = max(1, -(-n_filtrati // per_pagina))
+    # filtri cambiati -> si riparte dalla prima pagina; pagina oltre la fine (es. dopo un filtro) -> ultima
+    stato_filtri = (filtri, f_testo, per_pagina)
+    if st.session_state.get("mat_filtri_prec") != stato_filtri:
+        st.session_state["mat_filtri_prec"] = stato_filtri
+        st.session_state["mat_pagina"] = 1
+    if st.session_state.get("mat_pagina", 1) > n_pagine:
+        st.session_state["mat_pagina"] = n_pagine
+    pagina = pc2.number_input("Pagina", min_value=1, max_value=n_pagine, step=1, key="mat_pagina")
+
+    dfv = pagina_materiali(filtri, f_testo, per_pagina, (int(pagina) - 1) * per_pagina)
+    pc3.caption(f"{n_filtrati} materiali (totale archivio: {n_archivio}) – pagina {int(pagina)} di {n_pagine}")
 
     # Vista + editor (solo alcune colonne modificabili)
     view_cols = ["id","categoria","fornitore","codice_fornitore","descrizione","unita_misura","quantita_default","prezzo_unitario","is_manodopera"]
-    view = dfv[view_cols].copy()
+    view = dfv[view_cols]
 
     edited = st.data_editor(
         view,
@@ -1434,41 +3083,108 @@ def ui_materiali():
         },
         disabled=["id","categoria","fornitore","codice_fornitore"],  # ⬅️ NOTA: is_manodopera ora è editabile
         height=600,
-        key="mat_editor"
+        # le modifiche dell'editor sono per posizione di riga: chiave diversa per ogni pagina/filtro
+        key=f"mat_editor_{hash(stato_filtri)}_{int(pagina)}",
     )
 
 
     if st.button("💾 Salva modifiche materiali"):
-        # Passo il DF originale delle righe visibili (per confronto)
-        orig_for_edited = df_all[df_all["id"].isin(edited["id"])]
-        update_materiali_bulk(edited, orig_for_edited)
+        # Confronto con la pagina originale (le righe visibili)
+        update_materiali_bulk(edited, dfv)
         st.rerun()
      
     # Anteprima impatti manuale (se ci sono modifiche prezzo recenti)
     if st.session_state.get("last_changed_material_ids"):
         if st.button("🔁 Ricalcola/mostra impatti voci colpite"):
-            df_imp = anteprima_impatti_materiali(st.session_state["last_changed_material_ids"])
+            df_imp = anteprima_impatti_materiali(
+                st.session_state["last_changed_material_ids"],
+                st.session_state.get("last_changed_material_prices"),
+            )
             st.caption(f"Voci impattate: {len(df_imp)}")
             if df_imp.empty:
                 st.info("Nessuna voce legata ai materiali modificati.")
+            else:
+                st.dataframe(
+                    df_imp.drop(columns=["voce_id"]),
+                    use_container_width=True, hide_index=True, height=380
+                )
+
+    # ---------------------------
+    # Rivalutazione prezzi in blocco
+    # ---------------------------
+    with st.expander("📈 Rivalutazione prezzi (percentuale, importo, fattori per categoria)"):
+        r1, r2, r3, r4 = st.columns([1, 1, 1, 1])
+        riv_cat = r1.selectbox("Categoria", [None] + list(cat_map), key="riv_cat",
+                               format_func=lambda i: "Tutte" if i is None else cat_map[i])
+        riv_forn = r2.selectbox("Fornitore", [None] + list(forn_map), key="riv_forn",
+                                format_func=lambda i: "Tutti" if i is None else forn_map[i])
+        riv_mdo = r3.selectbox("Tipo", [None, 0, 1], key="riv_mdo",
+                               format_func=lambda x: {None: "Tutti", 0: "Solo materiali", 1: "Solo manodopera"}[x])
+        riv_cod = r4.text_input("Codice fornitore (jolly *)", key="riv_cod", placeholder="es. CLS*")
+
+        tipo = st.radio("Regola", ["percentuale", "assoluto", "fattori_categoria"], horizontal=True, key="riv_tipo",
+                        format_func={"percentuale": "Percentuale", "assoluto": "Importo fisso (€)",
+                                     "fattori_categoria": "Fattore per categoria"}.get)
+        if tipo == "fattori_categoria":
+            fatt = st.data_editor(
+                pd.DataFrame({"categoria_id": list(cat_map), "Categoria": list(cat_map.values()), "Fattore": 1.0}),
+                hide_index=True, disabled=["categoria_id", "Categoria"], key="riv_fattori",
+                column_config={"categoria_id": None,
+                               "Fattore": st.column_config.NumberColumn("Fattore", min_value=0.0, step=0.001, format="%.4f")},
+            )
+            regola = {"tipo": tipo, "fattori": {int(r.categoria_id): float(r.Fattore)
+                                                for r in fatt.itertuples() if float(r.Fattore) != 1.0}}
         else:
-            st.dataframe(
-                df_imp.drop(columns=["voce_id"]),
-                use_container_width=True, hide_index=True, height=380
-            ) 
-            
-            # Import CSV/Excel
+            valore = st.number_input("Variazione %" if tipo == "percentuale" else "Variazione (€)",
+                                     value=0.0, step=0.5 if tipo == "percentuale" else 0.01, key="riv_valore")
+            regola = {"tipo": tipo, "valore": valore}
+        filtro = {"categoria_id": riv_cat, "fornitore_id": riv_forn, "is_manodopera": riv_mdo, "codice": riv_cod}
+
+        b1, b2 = st.columns(2)
+        try:
+            if b1.button("👁️ Anteprima impatti", key="riv_anteprima"):
+                n, imp = anteprima_rivalutazione(filtro, regola)
+                st.caption(f"Materiali che cambierebbero prezzo: {n} – voci impattate: {len(imp)}")
+                if not imp.empty:
+                    st.dataframe(imp.drop(columns=["voce_id"]), use_container_width=True, hide_index=True, height=320)
+            if b2.button("✅ Applica rivalutazione", key="riv_applica"):
+                descr = (f"{regola['valore']:+g}%" if tipo == "percentuale" else
+                         f"{regola['valore']:+.2f} €" if tipo == "assoluto" else "fattori per categoria")
+                rep = rivaluta_prezzi(filtro, regola, nota=f"Rivalutazione {descr}")
+                st.session_state["last_changed_material_ids"] = list(rep["prezzi_precedenti"])
+                st.session_state["last_changed_material_prices"] = rep["prezzi_precedenti"]
+                st.session_state["rivalutazione_report"] = rep
+                st.rerun()
+        except ValueError as e:
+            st.warning(str(e))
+        rep = st.session_state.pop("rivalutazione_report", None)
+        if rep:
+            st.success(f"Prezzi aggiornati: {rep['materiali']} materiali, {len(rep['impatti'])} voci impattate.")
+            if not rep["impatti"].empty:
+                st.dataframe(rep["impatti"].drop(columns=["voce_id"]), use_container_width=True, hide_index=True, height=320)
+
+    # ---------------------------
+    # Import CSV/Excel
     # ---------------------------
     with st.expander("📥 Import materiali da CSV/Excel"):
         st.markdown("Colonne richieste: **categoria, fornitore, codice_fornitore, descrizione, unita_misura, prezzo_unitario** (+ opz. `quantita_default`, `is_manodopera`).")
         up = st.file_uploader("Carica file .csv o .xlsx", type=["csv","xlsx"], key="up_materiali")
-        if up is not None:
-            import_materiali_csv(up)
-            st.rerun()
+        upsert = st.checkbox(
+            "Aggiorna i codici già presenti (listino fornitore: prezzo, descrizione, UM)",
+            value=False, key="import_materiali_upsert",
+        )
+        if up is not None and st.button("📥 Importa materiali", key="btn_import_materiali"):
+            rep = import_materiali_csv(up, upsert=upsert)
+            if rep is not None:
+                st.session_state["import_materiali_report"] = rep
+                st.rerun()
+        rep = st.session_state.pop("import_materiali_report", None)
+        if rep:
+            mostra_report_import(rep)
 
     with st.expander("🕘 Storico prezzi materiali"):
         with get_con() as con:
-            df = pd.read_sql_query("""
+            df = _read_sql("""
                 SELECT s.changed_at, m.descrizione AS materiale,
                        s.prezzo_vecchio, s.prezzo_nuovo, s.note
                 FROM materiali_prezzi_storico s
@@ -1478,63 +3194,6 @@ def ui_materiali():
             """, con)
             st.dataframe(df, use_container_width=True, hide_index=True, height=240)
 
-# ------------------------------------------------------------------
-# Funzione import CSV/Excel con supporto a "is_manodopera"
-# ------------------------------------------------------------------
-def import_materiali_csv(file):
-    import pandas as pd
-
-    # Riconosci estensione
-    fname = file.name.lower()
-    if fname.endswith(".csv"):
-        df = pd.read_csv(file)
-    elif fname.endswith(".xlsx"):
-        df = pd.read_excel(file)
-    else:
-        st.error("Formato non supportato (solo CSV o Excel).")
-        return
-
-    # Normalizza nomi colonne
-    df.columns = [c.strip().lower() for c in df.columns]
-
-    # Controllo colonne obbligatorie
-    required = ["categoria","fornitore","codice_fornitore","descrizione","unita_misura","prezzo_unitario"]
-    for col in required:
-        if col not in df.columns:
-            st.error(f"Manca la colonna obbligatoria: {col}")
-            return
-
-    # Colonne opzionali
-    if "quantita_default" not in df.columns:
-        df["quantita_default"] = 1.0
-    if "is_manodopera" not in df.columns:
-        df["is_manodopera"] = 0
-
-    # Inserimento riga per riga
-    with get_con() as con:
-        for _, r in df.iterrows():
-            cat_id = ensure_categoria(con, str(r["categoria"]).strip())
-            forn_id = ensure_fornitore(con, str(r["fornitore"]).strip())
-            um = str(r["unita_misura"]).strip()
-
-            try:
-                _exec(con, """INSERT INTO materiali_base
-                              (categoria_id, fornitore_id, codice_fornitore, descrizione, unita_misura, quantita_default, prezzo_unitario, is_manodopera)
-                              VALUES (?,?,?,?,?,?,?,?)""",
-                      (cat_id, forn_id,
-                       str(r["codice_fornitore"]).strip(),
-                       str(r["descrizione"]).strip(),
-                       um,
-                       _to_float(r.get("quantita_default", 1.0), 1.0),
-                       _to_float(r["prezzo_unitario"], 0.0),
-                       int(bool(r.get("is_manodopera", 0)))))
-            except sqlite3.IntegrityError:
-                st.warning(f"Codice già presente: {r['codice_fornitore']} per fornitore {r['fornitore']}")
-        con.commit()
-
-    st.success(f"Importati {len(df)} materiali.")
-
-
 # ------------------------------------------------------------------
 # UI – Capitoli
 # ------------------------------------------------------------------
@@ -1560,8 +3219,9 @@ def ui_capitoli():
     if not df.empty:
         st.divider()
         st.markdown("**Aggiorna default capitolo (influenza nuove voci; le esistenti restano invariate)**")
-        cid = st.selectbox("Capitolo", options=[None]+df["id"].tolist(),
-                           format_func=lambda x: "—" if x is None else f"{df[df['id']==x]['codice'].iloc[0]} – {df[df['id']==x]['nome'].iloc[0]}")
+        cap_map = etichette_capitoli()
+        cid = st.selectbox("Capitolo", options=[None]+list(cap_map),
+                           format_func=lambda x: "—" if x is None else cap_map[x])
         if cid:
             row = df[df["id"]==cid].iloc[0]
             c1, c2, c3 = st.columns(3)
@@ -1570,8 +3230,8 @@ def ui_capitoli():
             if c3.button("💾 Aggiorna default"):
                 update_capitolo_defaults(int(cid), new_cg, new_ut); st.rerun()
 
-        del_id = st.selectbox("Elimina capitolo", options=[None]+df["id"].tolist(),
-                              format_func=lambda x: "—" if x is None else f"{df[df['id']==x]['codice'].iloc[0]} – {df[df['id']==x]['nome'].iloc[0]}")
+        del_id = st.selectbox("Elimina capitolo", options=[None]+list(cap_map),
+                              format_func=lambda x: "—" if x is None else cap_map[x])
         if del_id and st.button("Elimina"):
             delete_capitolo(int(del_id)); st.rerun()
 
@@ -1582,12 +3242,11 @@ def ui_voci():
     st.subheader("Voci di analisi")
 
     cap = df_capitoli()
-    mats_all = df_materiali()
 
     if cap.empty:
         st.info("Crea almeno un capitolo.")
         return
-    if mats_all.empty:
+    if conta_materiali() == 0:
         st.info("Aggiungi almeno un materiale nell'Archivio.")
         return
 
@@ -1602,7 +3261,7 @@ def ui_voci():
     with st.form("form_voce_new"):
         c1, c2 = st.columns([2, 3])
 
-        cap_map = {int(r.id): f"{r.codice} – {r.nome}" for _, r in cap.iterrows()}
+        cap_map = etichette_capitoli()
         capitolo_id = c1.selectbox(
             "Capitolo",
             options=list(cap_map.keys()),
@@ -1651,7 +3310,7 @@ def ui_voci():
     # -----------------------------
     # FILTRO per capitolo (dropdown) + filtri stile Excel
     # -----------------------------
-    cap_map = {int(r.id): f"{r.codice} – {r.nome}" for _, r in cap.iterrows()}
+    cap_map = etichette_capitoli()
     filtro_list = st.selectbox(
         "Filtra per capitolo",
         options=[0] + list(cap_map.keys()),
@@ -1669,10 +3328,8 @@ def ui_voci():
     f_cap  = fv1.text_input("Filtro Capitolo (codice/nome)", key="flt_voci_cap")
     f_desc = fv2.text_input("Filtro Descrizione", key="flt_voci_desc")
 
-    vv = voci.copy()
-    cap_full = vv["capitolo_codice"].astype(str) + " " + vv["capitolo_nome"].astype(str)
-    mask = like_mask(cap_full, f_cap) & like_mask(vv["descrizione"], f_desc)
-    vv = vv[mask]
+    cap_full = voci["capitolo_codice"].astype(str) + " " + voci["capitolo_nome"].astype(str)
+    vv = voci[like_mask(cap_full, f_cap) & like_mask(voci["descrizione"], f_desc)]
 
     # -----------------------------
     # Lista a sinistra, dettaglio a destra
@@ -1690,12 +3347,11 @@ def ui_voci():
             use_container_width=True, hide_index=True, height=620  # +scroll (>> 3 righe)
         )
 
-        ids = vv["id"].tolist()
-        labels = [f"{r.capitolo_codice} {r.codice} – {r.descrizione[:50]}" for _, r in vv.iterrows()]
+        voce_map = etichette_voci(breve=True)
         voce_sel = st.selectbox(
             "Seleziona voce",
-            options=[None] + ids,
-            format_func=lambda x: "—" if x is None else labels[ids.index(x)],
+            options=[None] + vv["id"].astype("int64").tolist(),
+            format_func=lambda x: "—" if x is None else voce_map[x],
             key="voce_sel_list"  # key dedicata
         )
 
@@ -1730,27 +3386,25 @@ def ui_voci():
             st.divider()
             st.write("Distinta base – aggiungi riga")
 
-            mats = df_materiali()
-            mat_map = {int(r.id): f"{r.categoria} | {r.fornitore} | {r.codice_fornitore} – {str(r.descrizione)[:50]}"
-                       for _, r in mats.iterrows()}
             co1, co2, co3 = st.columns([3, 1, 1])
 
-            # piccola ricerca rapida sul select dei materiali
+            # ricerca sull'indice full-text: nel select vanno solo i primi risultati, non l'archivio intero
             search = st.text_input("Cerca materiale (categoria/fornitore/codice/descrizione)", key=f"search_{voce_sel}")
-            filtered_ids = list(mat_map.keys())
-            if search:
-                s = search.strip().lower()
-                def match(txt): return s in str(txt).lower()
-                filtered_ids = [mid for mid in mat_map if match(mat_map[mid])]
-                if not filtered_ids:
-                    st.info("Nessun materiale corrispondente alla ricerca.")
-                    filtered_ids = list(mat_map.keys())
-
-            mat_id = co1.selectbox("Materiale", options=filtered_ids,
+            hits = cerca_materiali(search)
+            mat_map = {int(r.id): f"{r.categoria} | {r.fornitore} | {r.codice_fornitore} – {str(r.descrizione)[:50]}"
+                       for r in hits.itertuples(index=False)}
+            if search and not mat_map:
+                st.info("Nessun materiale corrispondente alla ricerca.")
+            elif len(mat_map) >= MATERIALI_PICKER_K:
+                st.caption(f"Mostrati i primi {MATERIALI_PICKER_K} risultati: affina la ricerca per trovarne altri.")
+
+            mat_id = co1.selectbox("Materiale", options=list(mat_map.keys()),
                                    format_func=lambda x: mat_map[x], key=f"m_{voce_sel}")
             qta = co2.number_input("Quantità", min_value=0.0, value=1.0, step=0.1, key=f"q_{voce_sel}")
             if co3.button("➕ Aggiungi", key=f"add_{voce_sel}"):
-                if qta <= 0:
+                if mat_id is None:
+                    st.warning("Seleziona un materiale.")
+                elif qta <= 0:
                     st.warning("Quantità > 0")
                 else:
                     add_riga_distinta(int(voce_sel), int(mat_id), float(qta))
@@ -1764,7 +3418,7 @@ def ui_voci():
                     "id", "categoria", "fornitore", "codice_fornitore",
                     "materiale_descrizione", "unita_misura", "prezzo_unitario",
                     "quantita", "subtotale"
-                ]].copy()
+                ]]
                 edited = st.data_editor(
                     view, use_container_width=True, num_rows="fixed",
                     column_config={"quantita": st.column_config.NumberColumn("quantita", step=0.1)}
@@ -1808,29 +3462,14 @@ def ui_sommario():
         return
 
     # -----------------------------
-    # Costruzione tabella sintetica
+    # Costruzione tabella sintetica (totali precalcolati in voci_totali,
+    # oppure ricalcolati col listino a una data passata dallo storico prezzi)
     # -----------------------------
-    rows = []
-    for _, r in voci.iterrows():
-        tot = compute_totali_voce(int(r.id))
-        rows.append({
-            "Capitolo": r.capitolo_codice,
-            "CapitoloNome": r.capitolo_nome,
-            "Cod. Voce": r.codice,
-            "Descrizione": r.descrizione,
-            "UM Voce": r.um_voce,
-            "Q.tà Voce": r.q_voce,
-            "CG %": r.cg_pct,
-            "Utile %": r.utile_pct,
-            "Materie (€)": round(tot["costo_materie"], 2),
-            "Manodopera (€)": round(tot["costo_manodopera"], 2),
-            "Spese generali (€)": round(tot["costi_generali"], 2),
-            "Utile (€)": round(tot["utile"], 2),
-            "Totale (€)": round(tot["totale"], 2),
-            "voce_id": int(r.id),
-        })
-
-    df_sum = pd.DataFrame(rows).sort_values(["Capitolo", "Cod. Voce"]).reset_index(drop=True)
+    a1, a2 = st.columns([1.6, 2])
+    al_data = a1.checkbox("Prezzi materiali a una data passata", key="som_asof")
+    data_listino = str(a2.date_input("Data listino", key="som_data", disabled=not al_data)) if al_data else None
+    tot = totali_voci() if data_listino is None else totali_voci_al(data_listino)
+    df_sum = _sommario_da_totali(tot).sort_values(["Capitolo", "Cod. Voce"]).reset_index(drop=True)
 
     # -----------------------------
     # Filtri "stile Excel"
@@ -1863,7 +3502,14 @@ def ui_sommario():
     # Dettaglio a livelli (con scroll)
     # -----------------------------
     st.markdown("### Dettaglio a livelli")
-    for (cap_code, cap_name), grp in df_sum.groupby(["Capitolo", "CapitoloNome"], sort=False):
+    # righe di tutte le voci in elenco con una sola query (non una per voce)
+    righe_tutte = df_righe_voci(df_sum["voce_id"].tolist())
+    if data_listino is not None:
+        prezzi_al = righe_tutte["materiale_id"].map(prezzi_materiali_al(istante_listino(data_listino)))
+        righe_tutte["prezzo_unitario"] = prezzi_al.fillna(righe_tutte["prezzo_unitario"])
+        righe_tutte["subtotale"] = righe_tutte["quantita"] * righe_tutte["prezzo_unitario"]
+    righe_per_voce = {int(k): g for k, g in righe_tutte.groupby("voce_analisi_id")}
+    for (cap_code, cap_name), grp in df_sum.groupby(["Capitolo", "CapitoloNome"], sort=False, observed=True):
         with st.expander(f"📁 Capitolo {cap_code} — {cap_name} | Voci: {len(grp)}", expanded=False):
             # elenco voci completo; nessun limite a 3 — verranno mostrate tutte
             for _, r in grp.iterrows():
@@ -1872,8 +3518,8 @@ def ui_sommario():
                     f"({r['Q.tà Voce']} {r['UM Voce']}) | Totale € {r['Totale (€)']:.2f}"
                 )
                 with st.expander(titolo_voce, expanded=False):
-                    righe = df_righe(int(r["voce_id"]))
-                    if righe.empty:
+                    righe = righe_per_voce.get(int(r["voce_id"]))
+                    if righe is None or righe.empty:
                         st.info("Nessuna riga.")
                     else:
                         show = righe[[
@@ -1894,14 +3540,115 @@ def ui_sommario():
     # -----------------------------
     # Export Excel (Sommario EPU)
     # -----------------------------
-    buf = export_excel()
-    if buf:
-        st.download_button(
-            "⬇️ Esporta Excel (Sommario EPU)",
-            data=buf.getvalue(),
-            file_name="EPU_sommario.xlsx",
-            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-        )
+    dettaglio = st.checkbox("Includi foglio con il dettaglio delle distinte", key="som_xlsx_dettaglio")
+    suff = ("_dettaglio" if dettaglio else "") + (f"_al_{data_listino}" if data_listino else "")
+    download_export(st, "Excel (Sommario EPU)", f"sommario_xlsx{suff}", chiave_export_sommario(),
+                    lambda: export_excel(dettaglio=dettaglio, data_listino=data_listino),
+                    file_name=f"EPU_sommario{suff}.xlsx", mime=MIME_XLSX, key=f"sommario_xlsx{suff}")
+
+# ------------------------------------------------------------------
+# UI – Scenari what-if (ipotesi in session_state, DB non toccato)
+# ------------------------------------------------------------------
+def ui_scenari():
+    st.subheader("Scenari what-if")
+    st.caption("Ipotesi su prezzi e percentuali tenute solo in questa sessione: il listino non viene modificato.")
+
+    if df_voci().empty:
+        st.info("Nessuna voce disponibile.")
+        return
+
+    prezzi = st.session_state.setdefault("scn_prezzi", {})  # materiale_id -> (etichetta, prezzo)
+    if st.button("↺ Azzera scenario", key="scn_reset"):
+        for k in [k for k in st.session_state if str(k).startswith("scn_")]:
+            del st.session_state[k]
+        st.rerun()
+
+    # --- Variazioni % per categoria ---
+    cats = df_categorie()
+    with st.expander("📦 Variazioni % per categoria", expanded=True):
+        cols = st.columns(3)
+        variazioni = {}
+        for i, r in enumerate(cats.itertuples(index=False)):
+            pct = cols[i % 3].slider(str(r.nome), min_value=-50.0, max_value=50.0, value=0.0, step=0.5,
+                                     format="%+.1f%%", key=f"scn_cat_{int(r.id)}")
+            if pct:
+                variazioni[int(r.id)] = pct
+
+    # --- Prezzi ipotetici di singoli materiali ---
+    with st.expander(f"🔧 Prezzi ipotetici di singoli materiali ({len(prezzi)})", expanded=False):
+        search = st.text_input("Cerca materiale (categoria/fornitore/codice/descrizione)", key="scn_mat_search")
+        hits = cerca_materiali(search)
+        mat_map = {int(r.id): (f"{r.categoria} | {r.fornitore} | {r.codice_fornitore} – {str(r.descrizione)[:50]}",
+                               float(r.prezzo_unitario or 0.0))
+                   for r in hits.itertuples(index=False)}
+        c1, c2, c3 = st.columns([3, 1, 1])
+        mat_id = c1.selectbox("Materiale", options=list(mat_map.keys()),
+                              format_func=lambda x: f"{mat_map[x][0]} (€ {mat_map[x][1]:.2f})", key="scn_mat")
+        nuovo = c2.number_input("Prezzo ipotetico (€)", min_value=0.0, step=0.01, format="%.4f", key="scn_mat_prezzo",
+                                value=mat_map[mat_id][1] if mat_id is not None else 0.0)
+        if c3.button("➕ Aggiungi", key="scn_mat_add") and mat_id is not None:
+            prezzi[int(mat_id)] = (mat_map[mat_id][0], float(nuovo))
+            st.rerun()
+        if prezzi:
+            st.dataframe(pd.DataFrame([{"Materiale": lab, "Prezzo ipotetico (€)": p} for lab, p in prezzi.values()]),
+                         use_container_width=True, hide_index=True)
+            if st.button("🗑️ Rimuovi prezzi ipotetici", key="scn_mat_clear"):
+                prezzi.clear()
+                st.rerun()
+
+    # --- CG % / Utile % per capitolo ---
+    caps = df_capitoli()
+    with st.expander("📁 CG % / Utile % per capitolo", expanded=False):
+        st.caption("Lasciare vuoto per mantenere le percentuali delle singole voci.")
+        ed_caps = st.data_editor(
+            pd.DataFrame({
+                "id": caps["id"], "Capitolo": caps["codice"], "Nome": caps["nome"],
+                "CG % scenario": pd.Series([None] * len(caps), dtype=float),
+                "Utile % scenario": pd.Series([None] * len(caps), dtype=float),
+            }),
+            column_config={"id": None,
+                           "CG % scenario": st.column_config.NumberColumn(min_value=0.0, max_value=100.0, step=0.5),
+                           "Utile % scenario": st.column_config.NumberColumn(min_value=0.0, max_value=100.0, step=0.5)},
+            disabled=["Capitolo", "Nome"], hide_index=True, use_container_width=True, key="scn_caps")
+    cg_cap = {int(i): float(v) for i, v in zip(ed_caps["id"], ed_caps["CG % scenario"]) if pd.notna(v)}
+    ut_cap = {int(i): float(v) for i, v in zip(ed_caps["id"], ed_caps["Utile % scenario"]) if pd.notna(v)}
+
+    # --- Valutazione (vettoriale, sul modello in cache) ---
+    t0 = time.perf_counter()
+    per_voce, per_capitolo = confronta_scenario(
+        prezzi={k: p for k, (_, p) in prezzi.items()}, variazioni_categoria=variazioni,
+        cg_capitolo=cg_cap, utile_capitolo=ut_cap)
+    ms = (time.perf_counter() - t0) * 1000.0
+
+    tot_att = float(per_voce["Totale attuale (€)"].sum())
+    tot_sim = float(per_voce["Totale scenario (€)"].sum())
+    m1, m2, m3 = st.columns(3)
+    m1.metric("Totale attuale (€)", f"{tot_att:,.2f}")
+    m2.metric("Totale scenario (€)", f"{tot_sim:,.2f}")
+    m3.metric("Δ (€)", f"{tot_sim - tot_att:+,.2f}",
+              f"{(tot_sim - tot_att) / tot_att * 100.0:+.2f}%" if tot_att > 0 else None)
+    st.caption(f"Voci valutate: {len(per_voce)} in {ms:.0f} ms")
+
+    _pct = lambda x: "-" if pd.isna(x) else f"{x:+.2f}%"
+    _euro = ["Totale attuale (€)", "Totale scenario (€)", "Δ (€)"]
+
+    st.markdown("### Per capitolo")
+    view_cap = per_capitolo.drop(columns=["capitolo_id"])
+    view_cap[_euro] = view_cap[_euro].round(2)
+    view_cap["Δ (%)"] = view_cap["Δ (%)"].map(_pct)
+    st.dataframe(view_cap, use_container_width=True, hide_index=True)
+
+    st.markdown("### Per voce")
+    solo_variate = st.checkbox("Solo voci con totale variato", value=True, key="scn_solo_variate")
+    view_voci = per_voce
+    if solo_variate:
+        view_voci = view_voci[view_voci["Δ (€)"].abs() > 0.005]
+    view_voci = (view_voci.reindex(view_voci["Δ (€)"].abs().sort_values(ascending=False).index)
+                 .drop(columns=["voce_id", "capitolo_id"]))
+    view_voci[_euro] = view_voci[_euro].round(2)
+    view_voci["Δ (%)"] = view_voci["Δ (%)"].map(_pct)
+    st.caption(f"Voci in elenco: {len(view_voci)}")
+    st.dataframe(view_voci, use_container_width=True, hide_index=True, height=420)
 
 # ------------------------------------------------------------------
 # UI – Clienti (riusata nella pagina Preventivi)
@@ -1932,8 +3679,9 @@ def ui_clienti():
     # --- Elimina cliente (solo se senza preventivi) ---
     if not df.empty:
         st.divider()
-        cid = st.selectbox("Elimina cliente", options=[None] + df["id"].tolist(),
-                           format_func=lambda x: "—" if x is None else df[df["id"]==x]["nome"].iloc[0])
+        cli_map = etichette_clienti()
+        cid = st.selectbox("Elimina cliente", options=[None] + list(cli_map),
+                           format_func=lambda x: "—" if x is None else cli_map[x])
         if cid and st.button("Elimina cliente selezionato"):
             delete_cliente(int(cid))
             st.rerun()
@@ -1970,49 +3718,62 @@ def render_preventivo_view(pid: int):
             hide_index=True,
         )
 
-        by_cap = (
-            righe.groupby(["capitolo_codice", "capitolo_nome"])["prezzo_totale"]
-            .sum()
-            .reset_index()
-            .rename(columns={"prezzo_totale": "Totale (€)"})
-        )
+        by_cap = totali_per_capitolo(righe, "Totale (€)")
         st.markdown("**Totali per capitolo**")
         st.dataframe(by_cap, use_container_width=True, hide_index=True)
     else:
         st.info("Nessuna riga nel preventivo.")
 
     # Totali documento
-    imp = float(testa["imponibile"].iloc[0])
-    iva_p = float(testa["iva_percentuale"].iloc[0])
-    iva_imp = float(testa["iva_importo"].iloc[0])
-    tot = float(testa["totale"].iloc[0])
+    imp, iva_p, iva_imp, tot = totali_documento(testa, righe)
     c1, c2, c3 = st.columns(3)
     c1.metric("Imponibile (€)", f"{imp:.2f}")
     c2.metric(f"IVA {iva_p:.0f}% (€)", f"{iva_imp:.2f}")
     c3.metric("Totale documento (€)", f"{tot:.2f}")
 
-    # Pulsanti export con KEY univoche (evita StreamlitDuplicateElementId)
-    colx, coly = st.columns(2)
-
-    buf_xls = export_preventivo_excel(int(pid))
-    if buf_xls:
-        colx.download_button(
-            "⬇️ Excel",
-            data=buf_xls.getvalue(),
-            file_name=f"Preventivo_{testa['numero'].iloc[0]}.xlsx",
-            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-            key=f"dl_xls_view_{pid}",
-        )
-
-    buf_docx = export_preventivo_docx(int(pid))
-    if buf_docx:
-        coly.download_button(
-            "⬇️ Word (DOCX)",
-            data=buf_docx.getvalue(),
-            file_name=f"Preventivo_{testa['numero'].iloc[0]}.docx",
-            mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
-            key=f"dl_docx_view_{pid}",
-        )
+    # Riprezzatura col listino alla data del preventivo (storico prezzi materiali)
+    if not righe.empty:
+        data_prev = testa["data"].iloc[0]
+        with st.expander(f"🕘 Prezzi voci al {data_prev} (listino a quella data)", expanded=False):
+            try:
+                rip = riprezza_preventivo_al(int(pid))
+            except ValueError as e:
+                st.warning(f"Listino alla data del preventivo non disponibile: {e}")
+            else:
+                st.dataframe(rip.round({"prezzo_unitario_al": 2, "prezzo_totale_al": 2, "differenza": 2}),
+                             use_container_width=True, hide_index=True)
+                st.caption(f"Imponibile col listino al {data_prev}: € {rip['prezzo_totale_al'].sum():.2f} "
+                           f"(Δ € {rip['differenza'].sum():+.2f} rispetto ai prezzi salvati nelle righe)")
+
+    # Export in background: si accodano i job e si continua a lavorare;
+    # il pannello si aggiorna da solo finché c'è qualcosa in corso
+    st.markdown("**Export**")
+    jobs = export_jobs_preventivo(int(pid))
+    attivi = bool(jobs["stato"].isin(JOB_ATTIVI).any())
+    st.fragment(_pannello_export, run_every=2.0 if attivi else None)(int(pid), repr(chiave_export_preventivo(testa)), attivi)
+
+def _pannello_export(pid: int, chiave: str, attivi_al_render: bool):
+    """Stato degli export del preventivo (eseguito come fragment: polling solo con job attivi)."""
+    jobs = export_jobs_preventivo(pid).set_index("formato")
+    if attivi_al_render and not jobs["stato"].isin(JOB_ATTIVI).any():
+        st.rerun()  # finito tutto: rerun completo per fermare il polling
+    cols = st.columns(len(FORMATI_EXPORT))
+    for col, (formato, f) in zip(cols, FORMATI_EXPORT.items()):
+        # KEY univoche per preventivo (evita StreamlitDuplicateElementId)
+        job = jobs.loc[formato] if formato in jobs.index else None
+        aggiornato = job is not None and job["chiave"] == chiave
+        if aggiornato and job["stato"] in JOB_ATTIVI:
+            col.progress(float(job["progresso"]), text=f"{f['label']}: {'in coda' if job['stato'] == 'in_coda' else 'in corso'}...")
+            continue
+        if aggiornato and job["stato"] == "completato":
+            col.download_button(f"⬇️ {f['label']}", data=risultato_export_job(int(job["id"])) or b"",
+                                file_name=job["file_name"], mime=f["mime"], key=f"dl_{formato}_view_{pid}")
+            continue
+        if aggiornato and job["stato"] == "errore":
+            col.error(f"{f['label']}: {job['errore']}")
+        if col.button(f"⚙️ Genera {f['label']}", key=f"gen_{formato}_view_{pid}"):
+            avvia_export_job(pid, formato)
+            st.rerun()  # rerun completo: attiva il polling del pannello
 
 def ui_preventivi():
     st.subheader("Preventivi")
@@ -2027,14 +3788,14 @@ def ui_preventivi():
 
     # --- Tab Nuovo/Modifica ---
     with tab1:
-        cli = df_clienti()
-        if cli.empty:
+        cli_map = etichette_clienti()
+        if not cli_map:
             st.info("Inserisci almeno un Cliente nella tab 'Clienti'.")
             return
 
         st.markdown("### Testata preventivo")
         c1, c2, c3 = st.columns([2,1,1])
-        cliente_id = c1.selectbox("Cliente", options=cli["id"], format_func=lambda i: cli[cli["id"]==i]["nome"].iloc[0])
+        cliente_id = c1.selectbox("Cliente", options=list(cli_map), format_func=lambda i: cli_map[i])
         numero = c2.text_input("Numero", placeholder="2025-001")
         data = c3.text_input("Data (YYYY-MM-DD)", placeholder="2025-08-12")
         note_finali = st.text_area("Note finali (facoltative)")
@@ -2054,20 +3815,33 @@ def ui_preventivi():
         pid = st.session_state.get("preventivo_corrente")
         if pid:
             st.caption(f"Preventivo corrente: ID {pid}")
+            # unica lettura del preventivo per questo render (nessuna scrittura qui)
+            testa, righe = df_preventivo(int(pid))
+            if testa.empty:
+                st.warning("Preventivo non trovato.")
+                st.session_state.pop("preventivo_corrente", None)
+                return
+            iva_corrente = st.number_input(
+                "IVA % preventivo corrente", min_value=0.0,
+                value=float(testa["iva_percentuale"].iloc[0] or 0.0), step=1.0, key=f"iva_prev_{pid}",
+            )
+            if float(iva_corrente) != float(testa["iva_percentuale"].iloc[0] or 0.0):
+                set_iva_preventivo(int(pid), iva_corrente)
+                st.rerun()
 
             st.markdown("### Aggiungi righe")
             cap = df_capitoli()
             if cap.empty:
                 st.info("Crea almeno un capitolo e una voce nella sezione Voci di analisi.")
                 return
-            cap_map = {int(r.id): f"{r.codice} – {r.nome}" for _, r in cap.iterrows()}
+            cap_map = etichette_capitoli()
             scel_cap = st.selectbox("Capitolo", options=list(cap_map.keys()), format_func=lambda x: cap_map[x])
 
             voci = df_voci(scel_cap)
             if voci.empty:
                 st.info("Nessuna voce disponibile per questo capitolo.")
                 return
-            voce_map = {int(r.id): f"{r.codice} – {r.descrizione}" for _, r in voci.iterrows()}
+            voce_map = etichette_voci(scel_cap)
             scel_voce = st.selectbox("Voce", options=list(voce_map.keys()), format_func=lambda x: voce_map[x])
 
             v = get_voce(int(scel_voce))
@@ -2085,29 +3859,22 @@ def ui_preventivi():
                     st.warning("Quantità > 0")
                 else:
                     add_riga_preventivo(int(pid), int(scel_cap), int(scel_voce), desc, note_riga, um, qta, prezzo_u)
-                    ricalcola_totali_preventivo(int(pid), iva_percent)
+                    aggiorna_totali_preventivo(int(pid))
                     st.success("Riga aggiunta.")
                     st.rerun()
 
             # Vista righe + totali
-            testa, righe = df_preventivo(int(pid))
             if not righe.empty:
                 st.markdown("#### Righe inserite")
                 st.dataframe(righe[["capitolo_codice","capitolo_nome","voce_codice","descrizione","um","quantita","prezzo_unitario","prezzo_totale"]],
                              use_container_width=True, hide_index=True)
 
                 st.markdown("#### Totali per capitolo")
-                by_cap = (righe.groupby(["capitolo_codice","capitolo_nome"])["prezzo_totale"].sum()
-                          .reset_index().rename(columns={"prezzo_totale":"Totale (€)"}))
+                by_cap = totali_per_capitolo(righe, "Totale (€)")
                 st.dataframe(by_cap, use_container_width=True, hide_index=True)
 
-            # Totali documento
-            ricalcola_totali_preventivo(int(pid), iva_percent)
-            testa, _ = df_preventivo(int(pid))
-            imp = float(testa["imponibile"].iloc[0])
-            iva_p = float(testa["iva_percentuale"].iloc[0])
-            iva_imp = float(testa["iva_importo"].iloc[0])
-            tot = float(testa["totale"].iloc[0])
+            # Totali documento (sola lettura: i totali si aggiornano quando cambiano righe/IVA)
+            imp, iva_p, iva_imp, tot = totali_documento(testa, righe)
 
             c1, c2, c3 = st.columns(3)
             c1.metric("Imponibile (€)", f"{imp:.2f}")
@@ -2116,7 +3883,7 @@ def ui_preventivi():
 
             # --- Azioni finali ---
             if c3.button("💾 Salva e archivia"):
-                ricalcola_totali_preventivo(int(pid), iva_percent)
+                aggiorna_totali_preventivo(int(pid))
                 st.session_state["last_saved_preventivo_id"] = int(pid)
                 st.session_state.pop("preventivo_corrente", None)
                 st.success(f"Preventivo {testa['numero'].iloc[0]} salvato e archiviato. Vai nella tab 'Archivio' per vederlo.")
@@ -2125,13 +3892,13 @@ def ui_preventivi():
     # --- Tab Archivio ---
     with tab3:
         st.markdown("### Archivio preventivi")
-        cli = df_clienti()
+        cli_map = etichette_clienti()
 
         colf1, colf2, colf3, colf4 = st.columns([1,1,1,1])
         numero_like = colf1.text_input("Filtra per numero")
         data_like = colf2.text_input("Filtra per data (YYYY-MM-DD)")
-        cli_sel = colf3.selectbox("Cliente", options=[0]+cli["id"].tolist(),
-                                  format_func=lambda x: "Tutti" if x==0 else cli[cli["id"]==x]["nome"].iloc[0])
+        cli_sel = colf3.selectbox("Cliente", options=[0]+list(cli_map),
+                                  format_func=lambda x: "Tutti" if x==0 else cli_map[x])
         if colf4.button("🔄 Aggiorna elenco"):
             st.rerun()
 
@@ -2193,16 +3960,32 @@ def ui_preventivi():
 # ------------------------------------------------------------------
 # MAIN
 # ------------------------------------------------------------------
+def ui_diagnostica():
+    """Contatori tecnici in sidebar (pool connessioni, cache letture)."""
+    with st.sidebar.expander("📊 Diagnostica DB", expanded=False):
+        st.caption("Pool connessioni")
+        st.json({"backend": DIALETTO.nome, **pool_stats()})
+        if not DIALETTO.postgres:
+            pool = _sqlite_pool(DB_PATH)
+            st.caption("Profilo SQLite / manutenzione")
+            with get_con() as con:
+                profilo = {p: con.execute(f"PRAGMA {p}").fetchone()[0] for p in pool.pragmas}
+            st.json({**profilo, "manutenzione": pool.manutenzione_info or f"ogni {SQLITE_MANUTENZIONE_S:.0f} s"})
+        st.caption("Cache letture (hit rate per funzione)")
+        st.dataframe(query_cache_stats(), hide_index=True, use_container_width=True)
+        st.caption("Cache file esportati")
+        st.dataframe(_export_cache(DB_PATH).stats(), hide_index=True, use_container_width=True)
+
 def main():
     init_db()
-    ensure_is_manodopera_column() 
+    ui_diagnostica()
     st.title("🏗️ EPU Builder v1.3.2")
     st.caption("Analisi voci (CG%/Utile% capitolo), distinte, Sommario EPU, preventivi con export Excel/Word.")
 
     flash_msg("delete_msg")
 
     pagina = st.sidebar.radio("Navigazione", [
-        "Categorie", "Fornitori", "Archivio materiali", "Capitoli", "Voci di analisi", "Sommario EPU", "Preventivi"
+        "Categorie", "Fornitori", "Archivio materiali", "Capitoli", "Voci di analisi", "Sommario EPU", "Scenari what-if", "Preventivi"
     ])
 
     if pagina == "Categorie":
@@ -2217,6 +4000,8 @@ def main():
         ui_voci()
     elif pagina == "Sommario EPU":
         ui_sommario()
+    elif pagina == "Scenari what-if":
+        ui_scenari()
     elif pagina == "Preventivi":
         ui_preventivi()
 
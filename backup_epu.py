@@ -1,4 +1,4 @@
-import os, shutil, sys, subprocess
+import os, shutil, sqlite3, sys, subprocess
 from datetime import datetime
 from pathlib import Path
 
@@ -29,7 +29,14 @@ else:
     print(f"⚠️ App non trovata per backup: {APP_FILE}")
 
 if DB_FILE.exists():
-    shutil.copy2(DB_FILE, db_backup)
+    # API di backup di SQLite e non copia del file: con journal_mode=WAL le ultime
+    # transazioni possono stare ancora in epu.db-wal
+    src, dst = sqlite3.connect(DB_FILE), sqlite3.connect(db_backup)
+    try:
+        src.backup(dst)
+    finally:
+        dst.close()
+        src.close()
     print(f"✅ Backup completato:\n- {app_backup}\n- {db_backup}")
 else:
     print(f"ℹ️ Nessun DB da backuppare (creato al volo all'avvio se serve): {DB_FILE}")
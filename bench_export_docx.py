@@ -0,0 +1,95 @@
+"""
+Benchmark export DOCX preventivo: tabella righe cella per cella (python-docx,
+come prima) contro il writer a blocchi di App.build_preventivo_docx.
+
+Da lanciare nella cartella del progetto (serve .streamlit/secrets.toml per importare App.py):
+    python bench_export_docx.py [numero_righe]
+Non tocca il DB: testata e righe sono generate in memoria.
+"""
+import importlib.util
+import io
+import logging
+import sys
+import time
+import warnings
+from pathlib import Path
+
+import pandas as pd
+
+warnings.filterwarnings("ignore")
+logging.disable(logging.WARNING)  # avvisi di Streamlit in bare mode
+
+
+def _carica_app():
+    path = Path(__file__).with_name("App.py")
+    spec = importlib.util.spec_from_file_location("App", path)
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)  # main() non parte: non è __main__
+    return mod
+
+
+def _dati(n: int):
+    testa = pd.DataFrame([{
+        "id": 1, "numero": "BENCH-1", "data": "2025-01-01", "cliente_nome": "Cliente Bench",
+        "piva": "", "indirizzo": "", "cap": "", "citta": "", "provincia": "", "nazione": "Italia",
+        "email": "", "telefono": "", "note_finali": "", "iva_percentuale": 22.0,
+        "imponibile": 0.0, "iva_importo": 0.0, "totale": 0.0, "revisione": 1, "totali_revisione": 0,
+    }])
+    righe = pd.DataFrame({
+        "capitolo_codice": [f"C{i % 12:02d}" for i in range(n)],
+        "capitolo_nome": [f"Capitolo {i % 12}" for i in range(n)],
+        "voce_codice": [f"V{i:05d}" for i in range(n)],
+        "descrizione": [f"Fornitura e posa voce {i}" for i in range(n)],
+        "voce_descrizione_estesa": ["Compreso ogni onere e magistero" if i % 3 else "" for i in range(n)],
+        "note": [None if i % 10 else f"nota {i}" for i in range(n)],
+        "um": ["Mt"] * n,
+        "quantita": [1.0 + i % 7 for i in range(n)],
+        "prezzo_unitario": [10.0 + i % 50 for i in range(n)],
+    })
+    righe["prezzo_totale"] = righe["quantita"] * righe["prezzo_unitario"]
+    return testa, righe
+
+
+def _docx_cella_per_cella(testa, righe) -> bytes:
+    """Solo la parte che cambia: tabella righe come nella versione precedente."""
+    from docx import Document
+    d = Document()
+    table = d.add_table(rows=1, cols=7)
+    for _, r in righe.iterrows():
+        row = table.add_row().cells
+        row[0].text = f"{r.get('capitolo_codice','')} {r.get('capitolo_nome','')}"
+        row[1].text = str(r.get("voce_codice", ""))
+        desc_ext = str(r.get("voce_descrizione_estesa", "") or "")
+        row[2].text = str(r.get("descrizione", "") or "") + (" – " + desc_ext if desc_ext.strip() else "")
+        row[3].text = str(r.get("um", ""))
+        row[4].text = f"{float(r.get('quantita', 0.0)):.2f}"
+        row[5].text = f"{float(r.get('prezzo_unitario', 0.0)):.2f}"
+        row[6].text = f"{float(r.get('prezzo_totale', 0.0)):.2f}"
+        note_val = r.get("note", "")
+        if pd.notna(note_val) and str(note_val).strip():
+            d.add_paragraph(f"Note: {note_val}")
+    buf = io.BytesIO()
+    d.save(buf)
+    return buf.getvalue()
+
+
+def _cronometra(fn, *args, ripetizioni: int = 3) -> float:
+    tempi = []
+    for _ in range(ripetizioni):
+        t0 = time.perf_counter()
+        fn(*args)
+        tempi.append(time.perf_counter() - t0)
+    return min(tempi)
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    app = _carica_app()
+    testa, righe = _dati(n)
+    prima = _cronometra(_docx_cella_per_cella, testa, righe)
+    dopo = _cronometra(app.build_preventivo_docx, testa, righe)
+    print(f"{n} righe | cella per cella: {prima:.2f}s | a blocchi: {dopo:.2f}s | x{prima / dopo:.1f}")
+
+
+if __name__ == "__main__":
+    main()
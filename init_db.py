@@ -1,138 +1,747 @@
+"""
+Schema DB di EPU Builder come migrazioni versionate (tabella schema_version).
+
+Usato da App.py (una sola volta per processo e per file DB) e da riga di comando:
+    python init_db.py [percorso_db | postgresql://...]
+SQLite (sviluppo) e Postgres (prod) hanno ognuno la sua lista di migrazioni, con le
+stesse versioni registrate in schema_version.
+"""
+import os
 import sqlite3
+import sys
 from pathlib import Path
 
-DB_PATH = "epu.db"
-
-DDL = """
-PRAGMA foreign_keys = ON;
-
-CREATE TABLE IF NOT EXISTS categorie (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    nome TEXT NOT NULL UNIQUE
-);
-
-CREATE TABLE IF NOT EXISTS fornitori (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    nome TEXT NOT NULL,
-    codice TEXT,
-    created_at TEXT DEFAULT (datetime('now'))
-);
-
-CREATE TABLE IF NOT EXISTS materiali (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    categoria TEXT,
-    fornitore_id INTEGER REFERENCES fornitori(id) ON DELETE SET NULL,
-    codice_fornitore TEXT,
-    descrizione TEXT NOT NULL,
-    unita TEXT,
-    prezzo REAL,
-    created_at TEXT DEFAULT (datetime('now')),
-    updated_at TEXT
-);
-
-CREATE TABLE IF NOT EXISTS capitoli (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    codice TEXT,
-    nome TEXT NOT NULL,
-    cg_def REAL DEFAULT 0,
-    ut_def REAL DEFAULT 0
-);
-
-CREATE TABLE IF NOT EXISTS voci (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    capitolo_id INTEGER NOT NULL REFERENCES capitoli(id) ON DELETE CASCADE,
-    codice TEXT,
-    descrizione TEXT NOT NULL,
-    um TEXT,
-    qta_voce REAL DEFAULT 1,
-    cg_pct REAL DEFAULT 0,
-    utile_pct REAL DEFAULT 0,
-    created_at TEXT DEFAULT (datetime('now'))
-);
-
-CREATE TABLE IF NOT EXISTS distinte (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    voce_id INTEGER REFERENCES voci(id) ON DELETE CASCADE,
-    materiale_id INTEGER REFERENCES materiali(id) ON DELETE SET NULL,
-    descrizione TEXT,
-    um TEXT,
-    qta REAL,
-    prezzo_unit REAL
-);
-
-CREATE TABLE IF NOT EXISTS clienti (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    nome TEXT NOT NULL,
-    piva TEXT,
-    indirizzo TEXT,
-    cap TEXT,
-    citta TEXT,
-    provincia TEXT,
-    nazione TEXT,
-    email TEXT,
-    telefono TEXT,
-    created_at TEXT DEFAULT (datetime('now'))
-);
-
--- Testata preventivo (nota: i campi agreggati che usi nel DOCX
--- vengono calcolati via query/join; qui salviamo i "dati sorgente")
-CREATE TABLE IF NOT EXISTS preventivi (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    numero TEXT,                 -- opzionale, se lo usi
-    cliente_id INTEGER REFERENCES clienti(id) ON DELETE SET NULL,
-    data TEXT,                   -- ISO yyyy-mm-dd
-    titolo TEXT,
-    note TEXT,
-    iva_percentuale REAL DEFAULT 22,  -- alias di iva_pct per compatibilità export
-    imponibile REAL DEFAULT 0,
-    iva_importo REAL DEFAULT 0,
-    totale REAL DEFAULT 0,
-    note_finali TEXT
-);
-
-CREATE TABLE IF NOT EXISTS preventivo_righe (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    preventivo_id INTEGER REFERENCES preventivi(id) ON DELETE CASCADE,
-    voce_id INTEGER REFERENCES voci(id) ON DELETE SET NULL,
-    capitolo_codice TEXT,       -- utile per export
-    capitolo_nome TEXT,         -- utile per export
-    voce_codice TEXT,           -- utile per export
-    descrizione TEXT,
-    um TEXT,
-    quantita REAL DEFAULT 1,
-    prezzo_unitario REAL DEFAULT 0,
-    prezzo_totale REAL DEFAULT 0,
-    note TEXT
-);
-
-CREATE TABLE IF NOT EXISTS materiali_prezzi_storico (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    materiale_id INTEGER REFERENCES materiali(id) ON DELETE CASCADE,
-    prezzo_vecchio REAL NOT NULL,
-    prezzo_nuovo REAL NOT NULL,
-    changed_at TEXT DEFAULT (datetime('now'))
-);
-
--- Indici principali
-CREATE INDEX IF NOT EXISTS idx_voci_capitolo ON voci(capitolo_id);
-CREATE INDEX IF NOT EXISTS idx_distinte_voce ON distinte(voce_id);
-CREATE INDEX IF NOT EXISTS idx_distinte_materiale ON distinte(materiale_id);
-CREATE INDEX IF NOT EXISTS idx_prev_righe_prev ON preventivo_righe(preventivo_id);
-"""
+DB_PATH = os.getenv("SQLITE_PATH") or "epu.db"
 
-def main():
-    created = not Path(DB_PATH).exists()
-    con = sqlite3.connect(DB_PATH)
+
+def _columns(cur, table: str) -> set:
+    return {r[1] for r in cur.execute(f"PRAGMA table_info({table})").fetchall()}
+
+
+def _add_column(cur, table: str, column: str, ddl: str):
+    """ALTER TABLE ... ADD COLUMN solo se la colonna manca (DB creati da versioni vecchie)."""
+    if column not in _columns(cur, table):
+        cur.execute(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}")
+
+
+# ------------------------------------------------------------------
+# Migrazioni (idempotenti: i DB esistenti senza schema_version partono da 0)
+# ------------------------------------------------------------------
+def _m001_schema_base(cur):
+    # Tabelle di dominio
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS categorie (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        nome TEXT NOT NULL UNIQUE
+    )""")
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS fornitori (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        nome TEXT NOT NULL UNIQUE,
+        piva TEXT,
+        indirizzo TEXT,
+        email TEXT,
+        telefono TEXT
+    )""")
+
+    # Materiali
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS materiali_base (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        categoria_id INTEGER NOT NULL,
+        fornitore_id INTEGER NOT NULL,
+        codice_fornitore TEXT NOT NULL,
+        descrizione TEXT NOT NULL,
+        unita_misura TEXT NOT NULL,
+        quantita_default REAL DEFAULT 1.0,
+        prezzo_unitario REAL NOT NULL,
+        FOREIGN KEY(categoria_id) REFERENCES categorie(id),
+        FOREIGN KEY(fornitore_id) REFERENCES fornitori(id),
+        UNIQUE(fornitore_id, codice_fornitore)
+    )""")
+    _add_column(cur, "materiali_base", "is_manodopera", "INTEGER NOT NULL DEFAULT 0")
+
+    # Capitoli con default %SG e %Utile
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS capitoli (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        codice TEXT NOT NULL UNIQUE,
+        nome TEXT NOT NULL,
+        cg_default_percentuale REAL DEFAULT 0.0,
+        utile_default_percentuale REAL DEFAULT 0.0
+    )""")
+
+    # Voci di analisi
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS voci_analisi (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        capitolo_id INTEGER NOT NULL,
+        codice TEXT NOT NULL,
+        descrizione TEXT NOT NULL,
+        costi_generali_percentuale REAL DEFAULT 0.0,
+        utile_percentuale REAL DEFAULT 0.0,
+        voce_unita_misura TEXT,
+        voce_quantita REAL DEFAULT 1.0,
+        FOREIGN KEY(capitolo_id) REFERENCES capitoli(id),
+        UNIQUE(capitolo_id, codice)
+    )""")
+    _add_column(cur, "voci_analisi", "prezzo_riferimento", "REAL DEFAULT 0.0")
+    _add_column(cur, "voci_analisi", "descrizione_estesa", "TEXT")
+
+    # Righe distinta
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS righe_distinta (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        voce_analisi_id INTEGER NOT NULL,
+        materiale_id INTEGER NOT NULL,
+        quantita REAL NOT NULL,
+        FOREIGN KEY(voce_analisi_id) REFERENCES voci_analisi(id),
+        FOREIGN KEY(materiale_id) REFERENCES materiali_base(id)
+    )""")
+
+    # Clienti / Preventivi
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS clienti (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        nome TEXT NOT NULL,
+        piva TEXT, indirizzo TEXT, cap TEXT, citta TEXT, provincia TEXT, nazione TEXT,
+        email TEXT, telefono TEXT, note TEXT
+    )""")
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS preventivi (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        numero TEXT NOT NULL,
+        data TEXT NOT NULL,
+        cliente_id INTEGER NOT NULL,
+        note_finali TEXT,
+        iva_percentuale REAL DEFAULT 22.0,
+        imponibile REAL DEFAULT 0.0,
+        iva_importo REAL DEFAULT 0.0,
+        totale REAL DEFAULT 0.0,
+        FOREIGN KEY(cliente_id) REFERENCES clienti(id)
+    )""")
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS preventivo_righe (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        preventivo_id INTEGER NOT NULL,
+        capitolo_id INTEGER NOT NULL,
+        voce_id INTEGER NOT NULL,
+        descrizione TEXT NOT NULL,
+        note TEXT,
+        um TEXT NOT NULL,
+        quantita REAL NOT NULL,
+        prezzo_unitario REAL NOT NULL,
+        prezzo_totale REAL NOT NULL,
+        FOREIGN KEY(preventivo_id) REFERENCES preventivi(id),
+        FOREIGN KEY(capitolo_id) REFERENCES capitoli(id),
+        FOREIGN KEY(voce_id) REFERENCES voci_analisi(id)
+    )""")
+
+    # Storico prezzi materiali
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS materiali_prezzi_storico (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        materiale_id INTEGER NOT NULL,
+        prezzo_vecchio REAL NOT NULL,
+        prezzo_nuovo REAL NOT NULL,
+        changed_at TEXT NOT NULL DEFAULT (datetime('now')),
+        note TEXT,
+        FOREIGN KEY(materiale_id) REFERENCES materiali_base(id)
+    )""")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_sto_mat  ON materiali_prezzi_storico(materiale_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_sto_date ON materiali_prezzi_storico(changed_at)")
+    # Trigger: logga i cambi prezzo dei materiali
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_log_prezzo_materiale
+    AFTER UPDATE OF prezzo_unitario ON materiali_base
+    FOR EACH ROW
+    WHEN NEW.prezzo_unitario IS NOT OLD.prezzo_unitario
+    BEGIN
+        INSERT INTO materiali_prezzi_storico (materiale_id, prezzo_vecchio, prezzo_nuovo, changed_at, note)
+        VALUES (OLD.id, OLD.prezzo_unitario, NEW.prezzo_unitario, datetime('now'), 'Update da UI materiali');
+    END;
+    """)
+
+    # Seed iniziali
+    if cur.execute("SELECT COUNT(*) FROM categorie").fetchone()[0] == 0:
+        cur.execute("INSERT INTO categorie (nome) VALUES (?), (?), (?), (?)",
+                    ["Edile", "Ferramenta", "Noleggi", "Pose"])
+    if cur.execute("SELECT COUNT(*) FROM fornitori").fetchone()[0] == 0:
+        cur.execute("INSERT INTO fornitori (nome) VALUES (?)", ["Fornitore Sconosciuto"])
+
+    # --- Indici utili ---
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_materiali_base_cat ON materiali_base(categoria_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_materiali_base_forn ON materiali_base(fornitore_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_voci_cap ON voci_analisi(capitolo_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_righe_voce ON righe_distinta(voce_analisi_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_righe_mat ON righe_distinta(materiale_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_prev_cliente ON preventivi(cliente_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_prev_data ON preventivi(data)")
+
+
+def _m002_voci_totali(cur):
+    # Cache totali voce (materializzata): i trigger marcano dirty le voci toccate,
+    # refresh_voci_totali() in App.py ricalcola solo quelle (dirty: 0=ok, 1=da ricalcolare, 2=in calcolo)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS voci_totali (
+        voce_id INTEGER PRIMARY KEY,
+        costo_materie REAL NOT NULL DEFAULT 0.0,
+        costo_manodopera REAL NOT NULL DEFAULT 0.0,
+        costi_generali REAL NOT NULL DEFAULT 0.0,
+        utile REAL NOT NULL DEFAULT 0.0,
+        totale REAL NOT NULL DEFAULT 0.0,
+        prezzo_unitario REAL NOT NULL DEFAULT 0.0,
+        dirty INTEGER NOT NULL DEFAULT 1,
+        updated_at TEXT
+    )""")
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_vt_righe_ins
+    AFTER INSERT ON righe_distinta
+    FOR EACH ROW
+    BEGIN
+        UPDATE voci_totali SET dirty = 1 WHERE voce_id = NEW.voce_analisi_id;
+    END;
+    """)
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_vt_righe_upd
+    AFTER UPDATE ON righe_distinta
+    FOR EACH ROW
+    BEGIN
+        UPDATE voci_totali SET dirty = 1 WHERE voce_id IN (OLD.voce_analisi_id, NEW.voce_analisi_id);
+    END;
+    """)
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_vt_righe_del
+    AFTER DELETE ON righe_distinta
+    FOR EACH ROW
+    BEGIN
+        UPDATE voci_totali SET dirty = 1 WHERE voce_id = OLD.voce_analisi_id;
+    END;
+    """)
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_vt_materiale_upd
+    AFTER UPDATE OF prezzo_unitario, is_manodopera ON materiali_base
+    FOR EACH ROW
+    WHEN NEW.prezzo_unitario IS NOT OLD.prezzo_unitario
+      OR NEW.is_manodopera IS NOT OLD.is_manodopera
+    BEGIN
+        UPDATE voci_totali SET dirty = 1
+        WHERE voce_id IN (SELECT voce_analisi_id FROM righe_distinta WHERE materiale_id = NEW.id);
+    END;
+    """)
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_vt_voce_upd
+    AFTER UPDATE OF costi_generali_percentuale, utile_percentuale, voce_quantita ON voci_analisi
+    FOR EACH ROW
+    BEGIN
+        UPDATE voci_totali SET dirty = 1 WHERE voce_id = NEW.id;
+    END;
+    """)
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_vt_voce_del
+    AFTER DELETE ON voci_analisi
+    FOR EACH ROW
+    BEGIN
+        DELETE FROM voci_totali WHERE voce_id = OLD.id;
+    END;
+    """)
+
+
+def _m003_revisione_preventivi(cur):
+    # revisione: sale a ogni modifica di righe/IVA; totali_revisione: revisione a cui
+    # risalgono imponibile/IVA/totale salvati (diverse = totali da ricalcolare)
+    nuove = "totali_revisione" not in _columns(cur, "preventivi")
+    _add_column(cur, "preventivi", "revisione", "INTEGER NOT NULL DEFAULT 0")
+    _add_column(cur, "preventivi", "totali_revisione", "INTEGER NOT NULL DEFAULT 0")
+    if nuove:
+        # preventivi esistenti: i totali salvati non sono mai stati verificati -> ricalcolati
+        # qui dalle righe (come ricalcola_totali_preventivo), così revisione 0 = totali 0 è vero
+        cur.execute("""
+        UPDATE preventivi
+        SET imponibile = IFNULL((SELECT SUM(r.prezzo_totale) FROM preventivo_righe r
+                                 WHERE r.preventivo_id = preventivi.id), 0.0)""")
+        cur.execute("""
+        UPDATE preventivi
+        SET iva_importo = imponibile * IFNULL(iva_percentuale, 0.0) / 100.0,
+            totale = imponibile + imponibile * IFNULL(iva_percentuale, 0.0) / 100.0""")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_prev_righe_prev ON preventivo_righe(preventivo_id)")
+
+
+def _m004_export_jobs(cur):
+    # Code di export in background (App.py: avvia_export_job). chiave = revisione dei dati
+    # esportati: un job completato con la stessa chiave si riusa invece di rigenerare.
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS export_jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        preventivo_id INTEGER NOT NULL,
+        formato TEXT NOT NULL,
+        chiave TEXT NOT NULL,
+        stato TEXT NOT NULL DEFAULT 'in_coda',   -- in_coda | in_corso | completato | errore
+        progresso REAL NOT NULL DEFAULT 0.0,     -- 0..1
+        file_name TEXT,
+        risultato BLOB,
+        errore TEXT,
+        created_at TEXT NOT NULL DEFAULT (datetime('now')),
+        finished_at TEXT
+    )""")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_jobs_prev ON export_jobs(preventivo_id, formato, chiave)")
+
+
+def _m005_materiali_fts(cur):
+    # Indice full-text dei materiali (rowid = materiali_base.id) per la ricerca nel
+    # picker distinta (App.py: cerca_materiali). Tenuto allineato dai trigger.
+    # Se l'SQLite in uso non ha FTS5 la migrazione non crea nulla: App.py ripiega su LIKE.
+    try:
+        cur.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS materiali_fts USING fts5(
+            descrizione, codice_fornitore, categoria, fornitore,
+            tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3'
+        )""")
+    except sqlite3.OperationalError as e:
+        if "fts5" not in str(e).lower():
+            raise
+        return
+
+    _fts_riga = """
+        INSERT INTO materiali_fts (rowid, descrizione, codice_fornitore, categoria, fornitore)
+        VALUES (NEW.id, NEW.descrizione, NEW.codice_fornitore,
+                (SELECT nome FROM categorie WHERE id = NEW.categoria_id),
+                (SELECT nome FROM fornitori WHERE id = NEW.fornitore_id));"""
+    cur.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS trg_fts_mat_ins AFTER INSERT ON materiali_base
+    BEGIN {_fts_riga}
+    END;""")
+    cur.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS trg_fts_mat_upd
+    AFTER UPDATE OF descrizione, codice_fornitore, categoria_id, fornitore_id ON materiali_base
+    BEGIN
+        DELETE FROM materiali_fts WHERE rowid = OLD.id; {_fts_riga}
+    END;""")
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_fts_mat_del AFTER DELETE ON materiali_base
+    BEGIN
+        DELETE FROM materiali_fts WHERE rowid = OLD.id;
+    END;""")
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_fts_cat_upd AFTER UPDATE OF nome ON categorie
+    BEGIN
+        UPDATE materiali_fts SET categoria = NEW.nome
+        WHERE rowid IN (SELECT id FROM materiali_base WHERE categoria_id = NEW.id);
+    END;""")
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_fts_forn_upd AFTER UPDATE OF nome ON fornitori
+    BEGIN
+        UPDATE materiali_fts SET fornitore = NEW.nome
+        WHERE rowid IN (SELECT id FROM materiali_base WHERE fornitore_id = NEW.id);
+    END;""")
+
+    # popolamento iniziale
+    cur.execute("DELETE FROM materiali_fts")
+    cur.execute("""
+    INSERT INTO materiali_fts (rowid, descrizione, codice_fornitore, categoria, fornitore)
+    SELECT m.id, m.descrizione, m.codice_fornitore, c.nome, f.nome
+    FROM materiali_base m
+    LEFT JOIN categorie c ON c.id = m.categoria_id
+    LEFT JOIN fornitori f ON f.id = m.fornitore_id""")
+
+
+def _m006_indici_archivio_materiali(cur):
+    # Pagine dell'archivio materiali (ORDER BY categoria, fornitore, codice + LIMIT/OFFSET):
+    # con questo indice e le statistiche di ANALYZE SQLite percorre categorie e fornitori
+    # per nome e i materiali già ordinati, senza ordinare tutto l'archivio a ogni pagina.
+    cur.execute("""CREATE INDEX IF NOT EXISTS idx_mat_cat_forn_cod
+                   ON materiali_base(categoria_id, fornitore_id, codice_fornitore)""")
+    cur.execute("ANALYZE")
+
+
+def _m007_storico_prezzi_per_data(cur):
+    # Listino a una data: per ogni materiale la prima variazione successiva alla data
+    # (ROW_NUMBER per materiale in ordine di changed_at) -> indice su (materiale, data).
+    cur.execute("""CREATE INDEX IF NOT EXISTS idx_sto_mat_data
+                   ON materiali_prezzi_storico(materiale_id, changed_at)""")
+
+
+def _m008_export_jobs_processo(cur):
+    # Più processi/repliche sullo stesso DB: ogni job porta il processo server che l'ha
+    # creato (le chiavi contengono generazioni di cache locali a quel processo).
+    _add_column(cur, "export_jobs", "processo", "TEXT")
+
+
+# (versione, descrizione, funzione) — in ordine; non modificare quelle già rilasciate, aggiungerne di nuove
+MIGRATIONS = [
+    (1, "schema base", _m001_schema_base),
+    (2, "cache totali voce (voci_totali + trigger)", _m002_voci_totali),
+    (3, "revisione righe/totali preventivi", _m003_revisione_preventivi),
+    (4, "code export in background (export_jobs)", _m004_export_jobs),
+    (5, "ricerca full-text materiali (FTS5)", _m005_materiali_fts),
+    (6, "indice pagine archivio materiali", _m006_indici_archivio_materiali),
+    (7, "indice storico prezzi per materiale/data", _m007_storico_prezzi_per_data),
+    (8, "processo proprietario dei job di export", _m008_export_jobs_processo),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def current_version(con) -> int:
+    row = con.execute("SELECT IFNULL(MAX(version), 0) FROM schema_version").fetchone()
+    return int(row[0])
+
+
+def migrate(db_path: str = DB_PATH) -> int:
+    """Applica le migrazioni mancanti (ognuna nella sua transazione). Ritorna la versione finale."""
+    con = sqlite3.connect(db_path, isolation_level=None)  # transazioni gestite a mano
     try:
-        con.executescript(DDL)
-        con.commit()
-        print("✅ Schema creato/aggiornato su", DB_PATH)
-        if created:
-            print("ℹ️ Nuovo DB creato (vuoto).")
-        else:
-            print("ℹ️ DB esistente aggiornato in modo idempotente.")
+        con.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            descrizione TEXT,
+            applied_at TEXT NOT NULL DEFAULT (datetime('now'))
+        )""")
+        if current_version(con) >= SCHEMA_VERSION:
+            return current_version(con)
+
+        for version, descr, fn in MIGRATIONS:
+            cur = con.cursor()
+            cur.execute("BEGIN IMMEDIATE")  # lock in scrittura: un solo processo migra
+            try:
+                if current_version(con) >= version:
+                    cur.execute("ROLLBACK")
+                    continue
+                fn(cur)
+                cur.execute("INSERT INTO schema_version (version, descrizione) VALUES (?, ?)", (version, descr))
+                cur.execute("COMMIT")
+            except Exception:
+                cur.execute("ROLLBACK")
+                raise
+        return current_version(con)
     finally:
         con.close()
 
+
+# ------------------------------------------------------------------
+# Postgres (prod): stesse versioni e stessi oggetti, DDL e trigger (plpgsql) di Postgres.
+# Date in TIMESTAMP UTC come datetime('now') di SQLite (App.py compila datetime('now')
+# in NOW() AT TIME ZONE 'UTC'). Tabelle già create a mano restano: IF NOT EXISTS ovunque.
+# ------------------------------------------------------------------
+_PG_ORA_UTC = "(NOW() AT TIME ZONE 'UTC')"
+
+
+def _pg_ha_colonna(cur, table: str, column: str) -> bool:
+    cur.execute("""SELECT 1 FROM information_schema.columns
+                   WHERE table_schema = current_schema() AND table_name = %s AND column_name = %s""",
+                (table, column))
+    return cur.fetchone() is not None
+
+
+def _pg_trigger(cur, nome: str, tabella: str, evento: str, funzione: str, quando: str = ""):
+    """(Ri)crea un trigger di riga: DROP + CREATE, idempotente anche senza CREATE OR REPLACE TRIGGER."""
+    cur.execute(f"DROP TRIGGER IF EXISTS {nome} ON {tabella}")
+    cur.execute(f"""CREATE TRIGGER {nome} {evento} ON {tabella} FOR EACH ROW
+                    {f"WHEN ({quando})" if quando else ""} EXECUTE FUNCTION {funzione}()""")
+
+
+def _pg_m001_schema_base(cur):
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS categorie (
+        id SERIAL PRIMARY KEY,
+        nome TEXT NOT NULL UNIQUE
+    )""")
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS fornitori (
+        id SERIAL PRIMARY KEY,
+        nome TEXT NOT NULL UNIQUE,
+        piva TEXT,
+        indirizzo TEXT,
+        email TEXT,
+        telefono TEXT
+    )""")
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS materiali_base (
+        id SERIAL PRIMARY KEY,
+        categoria_id INTEGER NOT NULL REFERENCES categorie(id),
+        fornitore_id INTEGER NOT NULL REFERENCES fornitori(id),
+        codice_fornitore TEXT NOT NULL,
+        descrizione TEXT NOT NULL,
+        unita_misura TEXT NOT NULL,
+        quantita_default DOUBLE PRECISION DEFAULT 1.0,
+        prezzo_unitario DOUBLE PRECISION NOT NULL,
+        UNIQUE(fornitore_id, codice_fornitore)
+    )""")
+    cur.execute("ALTER TABLE materiali_base ADD COLUMN IF NOT EXISTS is_manodopera INTEGER NOT NULL DEFAULT 0")
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS capitoli (
+        id SERIAL PRIMARY KEY,
+        codice TEXT NOT NULL UNIQUE,
+        nome TEXT NOT NULL,
+        cg_default_percentuale DOUBLE PRECISION DEFAULT 0.0,
+        utile_default_percentuale DOUBLE PRECISION DEFAULT 0.0
+    )""")
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS voci_analisi (
+        id SERIAL PRIMARY KEY,
+        capitolo_id INTEGER NOT NULL REFERENCES capitoli(id),
+        codice TEXT NOT NULL,
+        descrizione TEXT NOT NULL,
+        costi_generali_percentuale DOUBLE PRECISION DEFAULT 0.0,
+        utile_percentuale DOUBLE PRECISION DEFAULT 0.0,
+        voce_unita_misura TEXT,
+        voce_quantita DOUBLE PRECISION DEFAULT 1.0,
+        UNIQUE(capitolo_id, codice)
+    )""")
+    cur.execute("ALTER TABLE voci_analisi ADD COLUMN IF NOT EXISTS prezzo_riferimento DOUBLE PRECISION DEFAULT 0.0")
+    cur.execute("ALTER TABLE voci_analisi ADD COLUMN IF NOT EXISTS descrizione_estesa TEXT")
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS righe_distinta (
+        id SERIAL PRIMARY KEY,
+        voce_analisi_id INTEGER NOT NULL REFERENCES voci_analisi(id),
+        materiale_id INTEGER NOT NULL REFERENCES materiali_base(id),
+        quantita DOUBLE PRECISION NOT NULL
+    )""")
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS clienti (
+        id SERIAL PRIMARY KEY,
+        nome TEXT NOT NULL,
+        piva TEXT, indirizzo TEXT, cap TEXT, citta TEXT, provincia TEXT, nazione TEXT,
+        email TEXT, telefono TEXT, note TEXT
+    )""")
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS preventivi (
+        id SERIAL PRIMARY KEY,
+        numero TEXT NOT NULL,
+        data TEXT NOT NULL,
+        cliente_id INTEGER NOT NULL REFERENCES clienti(id),
+        note_finali TEXT,
+        iva_percentuale DOUBLE PRECISION DEFAULT 22.0,
+        imponibile DOUBLE PRECISION DEFAULT 0.0,
+        iva_importo DOUBLE PRECISION DEFAULT 0.0,
+        totale DOUBLE PRECISION DEFAULT 0.0
+    )""")
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS preventivo_righe (
+        id SERIAL PRIMARY KEY,
+        preventivo_id INTEGER NOT NULL REFERENCES preventivi(id),
+        capitolo_id INTEGER NOT NULL REFERENCES capitoli(id),
+        voce_id INTEGER NOT NULL REFERENCES voci_analisi(id),
+        descrizione TEXT NOT NULL,
+        note TEXT,
+        um TEXT NOT NULL,
+        quantita DOUBLE PRECISION NOT NULL,
+        prezzo_unitario DOUBLE PRECISION NOT NULL,
+        prezzo_totale DOUBLE PRECISION NOT NULL
+    )""")
+    cur.execute(f"""
+    CREATE TABLE IF NOT EXISTS materiali_prezzi_storico (
+        id SERIAL PRIMARY KEY,
+        materiale_id INTEGER NOT NULL REFERENCES materiali_base(id),
+        prezzo_vecchio DOUBLE PRECISION NOT NULL,
+        prezzo_nuovo DOUBLE PRECISION NOT NULL,
+        changed_at TIMESTAMP NOT NULL DEFAULT {_PG_ORA_UTC},
+        note TEXT
+    )""")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_sto_mat  ON materiali_prezzi_storico(materiale_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_sto_date ON materiali_prezzi_storico(changed_at)")
+    # Trigger: logga i cambi prezzo dei materiali
+    # nota: quella della transazione (set_config('epu.nota_prezzi', ..., true), vedi rivaluta_prezzi)
+    cur.execute(f"""
+    CREATE OR REPLACE FUNCTION fn_log_prezzo_materiale() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        INSERT INTO materiali_prezzi_storico (materiale_id, prezzo_vecchio, prezzo_nuovo, changed_at, note)
+        VALUES (OLD.id, OLD.prezzo_unitario, NEW.prezzo_unitario, {_PG_ORA_UTC},
+                COALESCE(NULLIF(current_setting('epu.nota_prezzi', true), ''), 'Update da UI materiali'));
+        RETURN NULL;
+    END $$""")
+    _pg_trigger(cur, "trg_log_prezzo_materiale", "materiali_base", "AFTER UPDATE OF prezzo_unitario",
+                "fn_log_prezzo_materiale", "NEW.prezzo_unitario IS DISTINCT FROM OLD.prezzo_unitario")
+
+    # Seed iniziali
+    cur.execute("SELECT COUNT(*) FROM categorie")
+    if cur.fetchone()[0] == 0:
+        cur.execute("INSERT INTO categorie (nome) VALUES (%s), (%s), (%s), (%s)",
+                    ["Edile", "Ferramenta", "Noleggi", "Pose"])
+    cur.execute("SELECT COUNT(*) FROM fornitori")
+    if cur.fetchone()[0] == 0:
+        cur.execute("INSERT INTO fornitori (nome) VALUES (%s)", ["Fornitore Sconosciuto"])
+
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_materiali_base_cat ON materiali_base(categoria_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_materiali_base_forn ON materiali_base(fornitore_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_voci_cap ON voci_analisi(capitolo_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_righe_voce ON righe_distinta(voce_analisi_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_righe_mat ON righe_distinta(materiale_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_prev_cliente ON preventivi(cliente_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_prev_data ON preventivi(data)")
+
+
+def _pg_m002_voci_totali(cur):
+    # come _m002_voci_totali: i trigger marcano dirty le voci toccate
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS voci_totali (
+        voce_id INTEGER PRIMARY KEY,
+        costo_materie DOUBLE PRECISION NOT NULL DEFAULT 0.0,
+        costo_manodopera DOUBLE PRECISION NOT NULL DEFAULT 0.0,
+        costi_generali DOUBLE PRECISION NOT NULL DEFAULT 0.0,
+        utile DOUBLE PRECISION NOT NULL DEFAULT 0.0,
+        totale DOUBLE PRECISION NOT NULL DEFAULT 0.0,
+        prezzo_unitario DOUBLE PRECISION NOT NULL DEFAULT 0.0,
+        dirty INTEGER NOT NULL DEFAULT 1,
+        updated_at TIMESTAMP
+    )""")
+    cur.execute("""
+    CREATE OR REPLACE FUNCTION fn_vt_righe() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        IF TG_OP <> 'INSERT' THEN
+            UPDATE voci_totali SET dirty = 1 WHERE voce_id = OLD.voce_analisi_id;
+        END IF;
+        IF TG_OP <> 'DELETE' THEN
+            UPDATE voci_totali SET dirty = 1 WHERE voce_id = NEW.voce_analisi_id;
+        END IF;
+        RETURN NULL;
+    END $$""")
+    _pg_trigger(cur, "trg_vt_righe_ins", "righe_distinta", "AFTER INSERT", "fn_vt_righe")
+    _pg_trigger(cur, "trg_vt_righe_upd", "righe_distinta", "AFTER UPDATE", "fn_vt_righe")
+    _pg_trigger(cur, "trg_vt_righe_del", "righe_distinta", "AFTER DELETE", "fn_vt_righe")
+    cur.execute("""
+    CREATE OR REPLACE FUNCTION fn_vt_materiale() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        UPDATE voci_totali SET dirty = 1
+        WHERE voce_id IN (SELECT voce_analisi_id FROM righe_distinta WHERE materiale_id = NEW.id);
+        RETURN NULL;
+    END $$""")
+    _pg_trigger(cur, "trg_vt_materiale_upd", "materiali_base", "AFTER UPDATE OF prezzo_unitario, is_manodopera",
+                "fn_vt_materiale", "NEW.prezzo_unitario IS DISTINCT FROM OLD.prezzo_unitario"
+                                   " OR NEW.is_manodopera IS DISTINCT FROM OLD.is_manodopera")
+    cur.execute("""
+    CREATE OR REPLACE FUNCTION fn_vt_voce() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        IF TG_OP = 'DELETE' THEN
+            DELETE FROM voci_totali WHERE voce_id = OLD.id;
+        ELSE
+            UPDATE voci_totali SET dirty = 1 WHERE voce_id = NEW.id;
+        END IF;
+        RETURN NULL;
+    END $$""")
+    _pg_trigger(cur, "trg_vt_voce_upd", "voci_analisi",
+                "AFTER UPDATE OF costi_generali_percentuale, utile_percentuale, voce_quantita", "fn_vt_voce")
+    _pg_trigger(cur, "trg_vt_voce_del", "voci_analisi", "AFTER DELETE", "fn_vt_voce")
+
+
+def _pg_m003_revisione_preventivi(cur):
+    nuove = not _pg_ha_colonna(cur, "preventivi", "totali_revisione")
+    cur.execute("ALTER TABLE preventivi ADD COLUMN IF NOT EXISTS revisione INTEGER NOT NULL DEFAULT 0")
+    cur.execute("ALTER TABLE preventivi ADD COLUMN IF NOT EXISTS totali_revisione INTEGER NOT NULL DEFAULT 0")
+    if nuove:
+        # come _m003_revisione_preventivi: totali dei preventivi esistenti ricalcolati dalle righe
+        cur.execute("""
+        UPDATE preventivi p
+        SET imponibile = COALESCE((SELECT SUM(r.prezzo_totale) FROM preventivo_righe r
+                                   WHERE r.preventivo_id = p.id), 0.0)""")
+        cur.execute("""
+        UPDATE preventivi
+        SET iva_importo = imponibile * COALESCE(iva_percentuale, 0.0) / 100.0,
+            totale = imponibile + imponibile * COALESCE(iva_percentuale, 0.0) / 100.0""")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_prev_righe_prev ON preventivo_righe(preventivo_id)")
+
+
+def _pg_m004_export_jobs(cur):
+    cur.execute(f"""
+    CREATE TABLE IF NOT EXISTS export_jobs (
+        id SERIAL PRIMARY KEY,
+        preventivo_id INTEGER NOT NULL,
+        formato TEXT NOT NULL,
+        chiave TEXT NOT NULL,
+        stato TEXT NOT NULL DEFAULT 'in_coda',
+        progresso DOUBLE PRECISION NOT NULL DEFAULT 0.0,
+        file_name TEXT,
+        risultato BYTEA,
+        errore TEXT,
+        created_at TIMESTAMP NOT NULL DEFAULT {_PG_ORA_UTC},
+        finished_at TIMESTAMP
+    )""")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_jobs_prev ON export_jobs(preventivo_id, formato, chiave)")
+
+
+def _pg_m005_materiali_fts(cur):
+    # niente FTS5 in Postgres: la ricerca materiali usa ILIKE (vedi _fts_materiali in App.py)
+    pass
+
+
+def _pg_m006_indici_archivio_materiali(cur):
+    cur.execute("""CREATE INDEX IF NOT EXISTS idx_mat_cat_forn_cod
+                   ON materiali_base(categoria_id, fornitore_id, codice_fornitore)""")
+    cur.execute("ANALYZE")
+
+
+def _pg_m007_storico_prezzi_per_data(cur):
+    cur.execute("""CREATE INDEX IF NOT EXISTS idx_sto_mat_data
+                   ON materiali_prezzi_storico(materiale_id, changed_at)""")
+
+
+def _pg_m008_export_jobs_processo(cur):
+    cur.execute("ALTER TABLE export_jobs ADD COLUMN IF NOT EXISTS processo TEXT")
+
+
+# stesse versioni e descrizioni di MIGRATIONS
+MIGRATIONS_POSTGRES = [
+    (1, "schema base", _pg_m001_schema_base),
+    (2, "cache totali voce (voci_totali + trigger)", _pg_m002_voci_totali),
+    (3, "revisione righe/totali preventivi", _pg_m003_revisione_preventivi),
+    (4, "code export in background (export_jobs)", _pg_m004_export_jobs),
+    (5, "ricerca full-text materiali (FTS5)", _pg_m005_materiali_fts),
+    (6, "indice pagine archivio materiali", _pg_m006_indici_archivio_materiali),
+    (7, "indice storico prezzi per materiale/data", _pg_m007_storico_prezzi_per_data),
+    (8, "processo proprietario dei job di export", _pg_m008_export_jobs_processo),
+]
+assert [m[:2] for m in MIGRATIONS_POSTGRES] == [m[:2] for m in MIGRATIONS]
+
+_PG_LOCK_MIGRAZIONI = 0x45505500  # pg_advisory_xact_lock: un solo processo migra
+
+
+def _pg_versione(cur) -> int:
+    cur.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+    return int(cur.fetchone()[0])
+
+
+def migrate_postgres(dsn: str) -> int:
+    """Come migrate(), su Postgres (dsn psycopg2). Ritorna la versione finale."""
+    import psycopg2
+
+    con = psycopg2.connect(dsn)
+    try:
+        with con, con.cursor() as cur:  # `with con`: commit a fine blocco, rollback se eccezione
+            cur.execute("SELECT pg_advisory_xact_lock(%s)", (_PG_LOCK_MIGRAZIONI,))
+            cur.execute(f"""
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                descrizione TEXT,
+                applied_at TIMESTAMP NOT NULL DEFAULT {_PG_ORA_UTC}
+            )""")
+            if _pg_versione(cur) >= SCHEMA_VERSION:
+                return _pg_versione(cur)
+
+        for version, descr, fn in MIGRATIONS_POSTGRES:
+            with con, con.cursor() as cur:  # una transazione per migrazione (DDL transazionali)
+                cur.execute("SELECT pg_advisory_xact_lock(%s)", (_PG_LOCK_MIGRAZIONI,))
+                if _pg_versione(cur) >= version:
+                    continue
+                fn(cur)
+                cur.execute("INSERT INTO schema_version (version, descrizione) VALUES (%s, %s)", (version, descr))
+        with con, con.cursor() as cur:
+            return _pg_versione(cur)
+    finally:
+        con.close()
+
+
+def main():
+    db_path = sys.argv[1] if len(sys.argv) > 1 else DB_PATH
+    if db_path.startswith(("postgres://", "postgresql://")):
+        print(f"✅ Schema Postgres creato/aggiornato (versione {migrate_postgres(db_path)})")
+        return
+    created = not Path(db_path).exists()
+    version = migrate(db_path)
+    print(f"✅ Schema creato/aggiornato su {db_path} (versione {version})")
+    if created:
+        print("ℹ️ Nuovo DB creato (vuoto).")
+    else:
+        print("ℹ️ DB esistente aggiornato in modo idempotente.")
+
+
 if __name__ == "__main__":
     main()